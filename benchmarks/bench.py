@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+DMARC Analyzer ベンチマーク
+
+合成レポート（または指定ディレクトリのレポート）に対して処理の各段階を
+個別に計測し、処理時間・レコード/秒・ピークメモリを表示します。
+
+使用例:
+    python3 benchmarks/bench.py --files 300 --records 1000
+    python3 benchmarks/bench.py --dir ~/Downloads/DMARC --json result.json
+    python3 benchmarks/bench.py --files 400 --records 2500 --compare-pandas --no-memory
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATH = os.path.join(os.path.dirname(BENCH_DIR), 'dmarc-analyzer.py')
+
+sys.path.insert(0, BENCH_DIR)
+from generate_reports import generate_reports  # noqa: E402
+
+
+def load_analyzer_module():
+    """ハイフン付きのスクリプトをモジュールとして読み込む"""
+    spec = importlib.util.spec_from_file_location('dmarc_analyzer', SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def consolidate_with_pandas(dm, records: List[Any]) -> tuple:
+    """比較用: ファイル間の統合とエラー抽出をカテゴリ型の DataFrame の groupby で行う
+
+    レコードを列のリストに写し、DataFrame で統合してからレコードに戻す（結果は
+    DMARCAnalyzer.consolidate_records() と同じ）。
+    """
+    import pandas as pd
+
+    columns = {name: [getattr(record, name) for record in records] for name in dm.RECORD_COLUMNS}
+    frame = pd.DataFrame(columns)
+    for name in dm.RECORD_COLUMNS:
+        if name != 'count':
+            frame[name] = frame[name].astype('category')
+    grouped = frame.groupby(list(dm.CONSOLIDATION_KEYS), sort=False, observed=True)
+    frame = grouped.agg(count=('count', 'sum'), note=('note', 'first')).reset_index()
+    has_error = ((frame['spf_result'] != 'pass') | (frame['dkim_result'] != 'pass') |
+                 (frame['dmarc_result'] != 'pass'))
+    consolidated = [dm.EvaluatedRecord(*row) for row in
+                    frame[list(dm.RECORD_COLUMNS)].itertuples(index=False, name=None)]
+    return consolidated, [consolidated[i] for i in frame.index[has_error]]
+
+
+def run_stages(dm, dmarc_dir: str, compare_pandas: bool = False) -> List[Dict[str, Any]]:
+    """各段階を順番に実行し、段階ごとの (名前, 処理件数, 関数) を返す"""
+    analyzer = dm.DMARCAnalyzer(dmarc_dir)
+    state = {}
+
+    def collect():
+        state['sources'] = analyzer.collect_sources()
+        return len(state['sources'])
+
+    def parse():
+        state['parsed'] = [list(analyzer.iter_records(source)) for source in state['sources']]
+        return sum(map(len, state['parsed']))
+
+    def evaluate():
+        state['evaluated'] = [analyzer.evaluate_batch(records) for records in state['parsed']]
+        return sum(map(len, state['evaluated']))
+
+    def consolidate():
+        partials = [analyzer.consolidate_records(records) for records in state['evaluated']]
+        state['rows'] = [record for partial in partials for record in partial]
+        return sum(map(len, state['evaluated']))
+
+    def consolidate_files():
+        # build_result() と同じ、ファイル間の統合とエラー抽出
+        state['consolidated'] = analyzer.consolidate_records(state['rows'])
+        state['errors'] = [record for record in state['consolidated'] if dm.is_error_record(record)]
+        return len(state['rows'])
+
+    def consolidate_files_pandas():
+        consolidated, errors = consolidate_with_pandas(dm, state['rows'])
+        if len(consolidated) != len(state['consolidated']) or len(errors) != len(state['errors']):
+            raise SystemExit("❌ pandas 版の統合結果が一致しません")
+        return len(state['rows'])
+
+    def detailed_analysis():
+        analyzer.show_detailed_analysis(state['rows'])
+        return len(state['rows'])
+
+    def render():
+        state['table'] = analyzer.format_table(state['errors'])
+        return len(state['errors'])
+
+    stages = [
+        ('extract_files', collect),
+        ('parse_xml', parse),
+        ('evaluate_dmarc', evaluate),
+        ('consolidate_records', consolidate),
+        ('consolidate_files', consolidate_files),
+    ]
+    if compare_pandas:
+        stages.append(('consolidate_files_pandas', consolidate_files_pandas))
+    return stages + [
+        ('show_detailed_analysis', detailed_analysis),
+        ('format_table', render),
+    ]
+
+
+def measure(dm, dmarc_dir: str, trace_memory: bool, compare_pandas: bool = False) -> List[Dict[str, Any]]:
+    """1回分の計測（trace_memory の場合は tracemalloc でピークメモリを計測）"""
+    results = []
+    for name, stage in run_stages(dm, dmarc_dir, compare_pandas):
+        if trace_memory:
+            tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            items = stage()
+            elapsed = time.perf_counter() - started
+        result = {'stage': name, 'items': items, 'seconds': elapsed}
+        if trace_memory:
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results.append(result)
+    return results
+
+
+def run_end_to_end(dmarc_dir: str, jobs: int) -> Dict[str, Any]:
+    """CLI全体をキャッシュなしで実行した時間と最大RSS"""
+    command = [sys.executable, SCRIPT_PATH, '--dir', dmarc_dir, '--no-cache', '--jobs', str(jobs)]
+    started = time.perf_counter()
+    subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+    elapsed = time.perf_counter() - started
+    # ru_maxrss は Linux では KB、macOS ではバイト単位
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    maxrss_bytes = maxrss if sys.platform == 'darwin' else maxrss * 1024
+    return {'stage': f'end_to_end (--jobs {jobs})', 'seconds': elapsed, 'max_rss_bytes': maxrss_bytes}
+
+
+def best_of(runs: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """繰り返し計測のうち各段階の最短時間を採用"""
+    best = []
+    for stage_runs in zip(*runs):
+        result = dict(min(stage_runs, key=lambda r: r['seconds']))
+        best.append(result)
+    return best
+
+
+def format_results(results: List[Dict[str, Any]], total_records: int) -> str:
+    lines = [f"{'段階':<26}{'件数':>12}{'秒':>10}{'件/秒':>14}{'ピークメモリ':>14}"]
+    for result in results:
+        items = result.get('items', total_records)
+        rate = items / result['seconds'] if result['seconds'] > 0 else float('inf')
+        memory = result.get('peak_bytes', result.get('max_rss_bytes'))
+        memory_text = f"{memory / 1024 / 1024:.1f} MB" if memory is not None else '-'
+        lines.append(f"{result['stage']:<26}{items:>12}{result['seconds']:>10.3f}{rate:>14,.0f}{memory_text:>14}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DMARC Analyzer ベンチマーク')
+    parser.add_argument('--dir', help='計測に使うレポートディレクトリ（省略時は合成レポートを生成）')
+    parser.add_argument('--files', type=int, default=100, help='生成するレポート数 (デフォルト: 100)')
+    parser.add_argument('--records', type=int, default=500, help='1レポートあたりのレコード数 (デフォルト: 500)')
+    parser.add_argument('--format', choices=['xml', 'zip', 'gz', 'mixed'], default='mixed',
+                        help='生成するファイル形式 (デフォルト: mixed)')
+    parser.add_argument('--domains', type=int, default=5, help='Header From ドメイン数 (デフォルト: 5)')
+    parser.add_argument('--external-domains', type=int, default=50, help='外部ドメイン数 (デフォルト: 50)')
+    parser.add_argument('--ips', type=int, default=5000, help='送信元IPアドレス数 (デフォルト: 5000)')
+    parser.add_argument('--fail-rate', type=float, default=0.2, help='SPF/DKIM の失敗率 (デフォルト: 0.2)')
+    parser.add_argument('--seed', type=int, default=1, help='乱数シード (デフォルト: 1)')
+    parser.add_argument('--repeat', type=int, default=3, help='計測回数（最短時間を採用, デフォルト: 3）')
+    parser.add_argument('--no-memory', action='store_true', help='ピークメモリの計測を省略する')
+    parser.add_argument('--end-to-end', action='store_true', help='CLI全体の実行時間と最大RSSも計測する')
+    parser.add_argument('--jobs', type=int, default=1, help='--end-to-end で使うプロセス数 (デフォルト: 1)')
+    parser.add_argument('--compare-pandas', action='store_true',
+                        help='ファイル間の統合を pandas の groupby で行った場合も計測して比較する（pandas が必要）')
+    parser.add_argument('--json', help='結果をJSONで保存するパス')
+    args = parser.parse_args()
+
+    dm = load_analyzer_module()
+
+    with tempfile.TemporaryDirectory(prefix='dmarc-bench-') as tmp_dir:
+        dmarc_dir = args.dir or tmp_dir
+        if not args.dir:
+            started = time.perf_counter()
+            paths = generate_reports(
+                tmp_dir, files=args.files, records=args.records, packaging=args.format,
+                seed=args.seed, domains=args.domains, external_domains=args.external_domains,
+                ips=args.ips, fail_rate=args.fail_rate,
+            )
+            size = sum(os.path.getsize(path) for path in paths)
+            print(f"📦 合成レポート {len(paths)}件 ({size / 1024 / 1024:.1f} MB) を生成 "
+                  f"({time.perf_counter() - started:.1f}秒)")
+
+        runs = [measure(dm, dmarc_dir, trace_memory=False, compare_pandas=args.compare_pandas)
+                for _ in range(args.repeat)]
+        results = best_of(runs)
+        if not args.no_memory:
+            memory = measure(dm, dmarc_dir, trace_memory=True, compare_pandas=args.compare_pandas)
+            for result, traced in zip(results, memory):
+                result['peak_bytes'] = traced['peak_bytes']
+
+        total_records = next(r['items'] for r in results if r['stage'] == 'parse_xml')
+        if args.end_to_end:
+            results.append(run_end_to_end(dmarc_dir, args.jobs))
+
+    print(format_results(results, total_records))
+    if args.compare_pandas:
+        seconds = {result['stage']: result['seconds'] for result in results}
+        print(f"🐼 ファイル間の統合: 辞書 {seconds['consolidate_files']:.3f}秒 / "
+              f"pandas {seconds['consolidate_files_pandas']:.3f}秒 "
+              f"({seconds['consolidate_files_pandas'] / seconds['consolidate_files']:.2f}倍)")
+
+    if args.json:
+        document = {
+            'python': sys.version.split()[0],
+            'dir': args.dir,
+            'options': {k: v for k, v in vars(args).items() if k not in ('json', 'dir')},
+            'records': total_records,
+            'stages': results,
+        }
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(document, f, ensure_ascii=False, indent=2)
+        print(f"💾 結果を保存しました: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
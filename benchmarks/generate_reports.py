@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+DMARC 集約レポートの合成データ生成ツール
+
+ベンチマーク用に、実際の受信側（Google, Microsoft など）が送ってくる形式に
+近い集約レポートを生成します。レコード数・ドメイン数・pass/fail の比率・
+ファイル形式（XML/ZIP/GZ）を指定できます。
+
+使用例:
+    python3 benchmarks/generate_reports.py --out /tmp/dmarc-bench --files 200 --records 500
+"""
+
+import argparse
+import gzip
+import os
+import random
+import zipfile
+from typing import Iterator, List
+
+# レポート送信元の組織
+REPORTERS = [
+    ('google.com', 'noreply-dmarc-support@google.com'),
+    ('Outlook.com', 'dmarcreport@microsoft.com'),
+    ('Yahoo', 'dmarchelp@yahooinc.com'),
+    ('Mail.Ru', 'dmarc_support@corp.mail.ru'),
+    ('Enterprise Outlook', 'dmarcreport@microsoft.com'),
+]
+
+# 外部の送信サービス（{n} は番号付きのサブドメイン）
+ESP_DOMAINS = [
+    'sendgrid.net',
+    'o{n}.ptr{n}.sendgrid.net',
+    'amazonses.com',
+    'mail{n}.us-west-2.amazonses.com',
+    'bnc{n}.bnc.salesforce.com',
+    'mktomail.com',
+    'mcsv.net',
+    'servers.mcsv.net',
+]
+
+SPF_FAILURES = ['fail', 'softfail', 'none', 'neutral', 'temperror', 'permerror']
+DKIM_FAILURES = ['fail', 'none', 'temperror', 'policy']
+DAY = 86400
+
+
+class ReportGenerator:
+    """合成レポートの生成器"""
+
+    def __init__(self, seed: int = 1, domains: int = 5, external_domains: int = 50,
+                 ips: int = 5000, fail_rate: float = 0.2, ipv6_rate: float = 0.1,
+                 policy_evaluated_rate: float = 0.9):
+        self.random = random.Random(seed)
+        self.fail_rate = fail_rate
+        self.ipv6_rate = ipv6_rate
+        self.policy_evaluated_rate = policy_evaluated_rate
+        self.domains = [f"example{i}.{tld}" for i, tld in
+                        zip(range(domains), ['com', 'co.jp', 'net', 'org', 'co.uk'] * domains)]
+        self.external_domains = [
+            ESP_DOMAINS[i % len(ESP_DOMAINS)].format(n=i) for i in range(external_domains)
+        ]
+        self.ips = [self.random_ip() for _ in range(ips)]
+
+    def random_ip(self) -> str:
+        if self.random.random() < self.ipv6_rate:
+            return '2001:db8:%x:%x::%x' % (self.random.randrange(0x10000),
+                                           self.random.randrange(0x10000),
+                                           self.random.randrange(1, 0x10000))
+        return '%d.%d.%d.%d' % (self.random.choice([192, 198, 203, 209]),
+                                self.random.randrange(256), self.random.randrange(256),
+                                self.random.randrange(1, 255))
+
+    def result(self, failures: List[str]) -> str:
+        if self.random.random() < self.fail_rate:
+            return self.random.choice(failures)
+        return 'pass'
+
+    def record(self, policy_domain: str) -> str:
+        rnd = self.random
+        header_from = policy_domain if rnd.random() < 0.8 else rnd.choice(self.domains)
+        spf_domain = header_from if rnd.random() < 0.5 else rnd.choice(self.external_domains)
+        spf_result = self.result(SPF_FAILURES)
+        dkim = [(header_from, self.result(DKIM_FAILURES), 'google')]
+        if rnd.random() < 0.4:
+            dkim.append((rnd.choice(self.external_domains), self.result(DKIM_FAILURES), 's%d' % rnd.randrange(4)))
+
+        parts = [
+            '<record><row>',
+            f'<source_ip>{rnd.choice(self.ips)}</source_ip>',
+            f'<count>{max(1, int(rnd.expovariate(0.2)))}</count>',
+        ]
+        if rnd.random() < self.policy_evaluated_rate:
+            dkim_eval = 'pass' if any(r == 'pass' for _, r, _ in dkim) else 'fail'
+            spf_eval = 'pass' if spf_result == 'pass' and spf_domain == header_from else 'fail'
+            disposition = 'none' if 'pass' in (dkim_eval, spf_eval) else rnd.choice(['none', 'quarantine', 'reject'])
+            parts.append(f'<policy_evaluated><disposition>{disposition}</disposition>'
+                         f'<dkim>{dkim_eval}</dkim><spf>{spf_eval}</spf></policy_evaluated>')
+        parts.append(f'</row><identifiers><header_from>{header_from}</header_from>'
+                     f'<envelope_from>{spf_domain}</envelope_from></identifiers><auth_results>')
+        for domain, result, selector in dkim:
+            parts.append(f'<dkim><domain>{domain}</domain><result>{result}</result>'
+                         f'<selector>{selector}</selector></dkim>')
+        parts.append(f'<spf><domain>{spf_domain}</domain><result>{spf_result}</result></spf>')
+        parts.append('</auth_results></record>\n')
+        return ''.join(parts)
+
+    def report(self, index: int, records: int, begin: int) -> Iterator[str]:
+        """1レポート分のXMLを断片ごとに返す（巨大なレポートもメモリに載せない）"""
+        org_name, email = self.random.choice(REPORTERS)
+        policy_domain = self.random.choice(self.domains)
+        yield '<?xml version="1.0" encoding="UTF-8" ?>\n<feedback>\n<version>1.0</version>\n'
+        yield (f'<report_metadata><org_name>{org_name}</org_name><email>{email}</email>'
+               f'<report_id>{index}{self.random.randrange(10 ** 12)}</report_id>'
+               f'<date_range><begin>{begin}</begin><end>{begin + DAY - 1}</end></date_range>'
+               '</report_metadata>\n')
+        yield (f'<policy_published><domain>{policy_domain}</domain>'
+               f'<adkim>{self.random.choice("rs")}</adkim><aspf>{self.random.choice("rs")}</aspf>'
+               '<p>none</p><sp>none</sp><pct>100</pct></policy_published>\n')
+        for _ in range(records):
+            yield self.record(policy_domain)
+        yield '</feedback>\n'
+
+
+def write_report(path: str, packaging: str, member: str, chunks: Iterator[str]) -> str:
+    """レポートを指定形式で書き出し、作成したファイルのパスを返す"""
+    if packaging == 'zip':
+        path += '.zip'
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+            with zip_ref.open(member, 'w') as f:
+                for chunk in chunks:
+                    f.write(chunk.encode())
+    elif packaging == 'gz':
+        path += '.xml.gz'
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            f.writelines(chunks)
+    else:
+        path += '.xml'
+        with open(path, 'w', encoding='utf-8') as f:
+            f.writelines(chunks)
+    return path
+
+
+def generate_reports(out_dir: str, files: int = 100, records: int = 200, packaging: str = 'mixed',
+                     seed: int = 1, start: int = 1749772800, **options) -> List[str]:
+    """out_dir に合成レポートを生成し、作成したファイルのパス一覧を返す"""
+    os.makedirs(out_dir, exist_ok=True)
+    generator = ReportGenerator(seed=seed, **options)
+    kinds = ['xml', 'zip', 'gz']
+    paths = []
+    for index in range(files):
+        kind = kinds[index % 3] if packaging == 'mixed' else packaging
+        begin = start + DAY * (index % 30)
+        org_name, _ = generator.random.choice(REPORTERS)
+        name = f"{org_name.lower().replace(' ', '')}!example!{begin}!{begin + DAY - 1}!{index}"
+        chunks = generator.report(index, records, begin)
+        paths.append(write_report(os.path.join(out_dir, name), kind, name + '.xml', chunks))
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DMARC 集約レポートの合成データ生成')
+    parser.add_argument('--out', required=True, help='出力ディレクトリ')
+    parser.add_argument('--files', type=int, default=100, help='レポートファイル数 (デフォルト: 100)')
+    parser.add_argument('--records', type=int, default=200, help='1レポートあたりのレコード数 (デフォルト: 200)')
+    parser.add_argument('--format', choices=['xml', 'zip', 'gz', 'mixed'], default='mixed',
+                        help='ファイル形式 (デフォルト: mixed = XML/ZIP/GZ を順番に)')
+    parser.add_argument('--domains', type=int, default=5, help='Header From ドメイン数 (デフォルト: 5)')
+    parser.add_argument('--external-domains', type=int, default=50,
+                        help='外部送信サービスのドメイン数 (デフォルト: 50)')
+    parser.add_argument('--ips', type=int, default=5000, help='送信元IPアドレス数 (デフォルト: 5000)')
+    parser.add_argument('--fail-rate', type=float, default=0.2, help='SPF/DKIM の失敗率 (デフォルト: 0.2)')
+    parser.add_argument('--seed', type=int, default=1, help='乱数シード (デフォルト: 1)')
+    args = parser.parse_args()
+
+    paths = generate_reports(
+        args.out, files=args.files, records=args.records, packaging=args.format, seed=args.seed,
+        domains=args.domains, external_domains=args.external_domains, ips=args.ips,
+        fail_rate=args.fail_rate,
+    )
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    print(f"✅ {len(paths)}個のレポートを生成しました: {args.out} ({total_bytes / 1024 / 1024:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+DMARC Analyzer JSON API 負荷テスト
+
+合成レポートに対して `serve` を起動し（--url 指定時は起動済みのサーバーを使用）、
+複数のクライアントプロセスから keep-alive 接続で各エンドポイントへ並行して
+リクエストを送り、エンドポイントごとのレイテンシ（p50 / p95 / p99）と
+スループットを表示します。--add-files を指定すると、計測中にレポートを追加して
+集計の更新中も応答が滞らないかを確認できます。--target-p99-ms を指定すると、
+いずれかのエンドポイントの p99 が目標を超えた場合に終了コード 1 で終了します。
+
+使用例:
+    python3 benchmarks/loadtest.py --clients 16 --duration 10 --target-p99-ms 20
+    python3 benchmarks/loadtest.py --no-etag --add-files 20
+    python3 benchmarks/loadtest.py --url http://127.0.0.1:8080
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATH = os.path.join(os.path.dirname(BENCH_DIR), 'dmarc-analyzer.py')
+
+sys.path.insert(0, BENCH_DIR)
+from generate_reports import generate_reports  # noqa: E402
+
+ENDPOINTS = ['/api/status', '/api/errors', '/api/records', '/api/header-domains',
+             '/api/domain-groups', '/api/statistics', '/metrics']
+
+
+def free_port() -> int:
+    """空いている TCP ポートを返す"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(host: str, port: int, timeout: float) -> None:
+    """/api/status が ready を返すまで待つ"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=5)
+            conn.request('GET', '/api/status')
+            if json.loads(conn.getresponse().read()).get('ready'):
+                return
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"❌ {timeout:.0f} 秒以内にサーバーの準備ができませんでした")
+
+
+def run_client(host: str, port: int, paths: List[str], duration: float, use_etag: bool,
+               offset: int) -> Dict[str, Tuple[List[float], Dict[int, int]]]:
+    """duration 秒間リクエストを送り続け、パスごとの (レイテンシ[ms] 一覧, ステータス別件数) を返す"""
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    etags = {}
+    results = {path: ([], {}) for path in paths}
+    deadline = time.perf_counter() + duration
+    index = offset
+    while time.perf_counter() < deadline:
+        path = paths[index % len(paths)]
+        index += 1
+        headers = {'Accept-Encoding': 'gzip'}
+        if use_etag and path in etags:
+            headers['If-None-Match'] = etags[path]
+        started = time.perf_counter()
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        elapsed = (time.perf_counter() - started) * 1000
+        latencies, statuses = results[path]
+        latencies.append(elapsed)
+        statuses[response.status] = statuses.get(response.status, 0) + 1
+        if response.getheader('ETag'):
+            etags[path] = response.getheader('ETag')
+    conn.close()
+    return results
+
+
+def percentile(values: List[float], ratio: float) -> float:
+    """values（昇順）の ratio 分位点"""
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DMARC Analyzer JSON API 負荷テスト')
+    parser.add_argument('--url', type=str, help='起動済みのサーバー（例: http://127.0.0.1:8080）。省略時は合成レポートで serve を起動')
+    parser.add_argument('--files', type=int, default=100, help='生成するレポート数 (デフォルト: 100)')
+    parser.add_argument('--records', type=int, default=200, help='1レポートあたりのレコード数 (デフォルト: 200)')
+    parser.add_argument('--clients', type=int, default=8, help='並行クライアント数 (デフォルト: 8)')
+    parser.add_argument('--duration', type=float, default=5.0, help='計測時間（秒, デフォルト: 5）')
+    parser.add_argument('--paths', nargs='+', default=ENDPOINTS, help='リクエストするエンドポイント (デフォルト: 全て)')
+    parser.add_argument('--no-etag', action='store_true', help='If-None-Match を送らず、毎回本文を受け取る')
+    parser.add_argument('--add-files', type=int, default=0,
+                        help='計測中に追加するレポート数（集計の更新中の応答を確認, --url 指定時は無効）')
+    parser.add_argument('--target-p99-ms', type=float, help='p99 の目標（ミリ秒）。超えた場合は終了コード 1')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='dmarc-loadtest-') as tmp_dir:
+        server = None
+        if args.url:
+            url = urlsplit(args.url)
+            host, port = url.hostname, url.port or 80
+        else:
+            dmarc_dir = os.path.join(tmp_dir, 'reports')
+            generate_reports(dmarc_dir, files=args.files, records=args.records)
+            host, port = '127.0.0.1', free_port()
+            server = subprocess.Popen(
+                [sys.executable, SCRIPT_PATH, 'serve', '--dir', dmarc_dir,
+                 '--cache-dir', os.path.join(tmp_dir, 'cache'), '--port', str(port),
+                 '--watch-interval', '0.5', '--debounce', '0.2'],
+                stdout=subprocess.DEVNULL)
+        try:
+            wait_ready(host, port, timeout=300)
+            with ProcessPoolExecutor(max_workers=args.clients) as executor:
+                futures = [executor.submit(run_client, host, port, args.paths, args.duration,
+                                           not args.no_etag, index)
+                           for index in range(args.clients)]
+                if server is not None and args.add_files:
+                    # 計測の途中でレポートを追加する（別の seed で新しいレポートにする）
+                    time.sleep(args.duration / 3)
+                    generate_reports(dmarc_dir, files=args.add_files, records=args.records, seed=2,
+                                     start=1749772800 + 86400 * 60)
+                results = [future.result() for future in futures]
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    exceeded = False
+    total = 0
+    print(f"{'エンドポイント':<22}{'件数':>8}{'req/s':>10}{'p50(ms)':>10}{'p95(ms)':>10}"
+          f"{'p99(ms)':>10}{'最大(ms)':>10}  ステータス")
+    for path in args.paths:
+        latencies = sorted(value for result in results for value in result[path][0])
+        statuses = {}
+        for result in results:
+            for status, count in result[path][1].items():
+                statuses[status] = statuses.get(status, 0) + count
+        if not latencies:
+            continue
+        total += len(latencies)
+        p99 = percentile(latencies, 0.99)
+        status_text = ', '.join(f"{status}: {count}" for status, count in sorted(statuses.items()))
+        print(f"{path:<22}{len(latencies):>8}{len(latencies) / args.duration:>10.0f}"
+              f"{statistics.median(latencies):>10.2f}{percentile(latencies, 0.95):>10.2f}"
+              f"{p99:>10.2f}{latencies[-1]:>10.2f}  {status_text}")
+        if args.target_p99_ms is not None and p99 > args.target_p99_ms:
+            exceeded = True
+    print(f"合計 {total}件 ({total / args.duration:.0f} req/s, クライアント {args.clients})")
+
+    if exceeded:
+        print(f"❌ p99 の目標 {args.target_p99_ms:.1f} ms を超えました")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+DMARC Analyzer 起動時間ベンチマーク
+
+`--help` と、前回から変更のないディレクトリに対する再実行（キャッシュ済みの
+分析結果を表示するだけの実行）の所要時間を計測します。--target-ms を
+指定すると、中央値が目標を超えた場合に終了コード 1 で終了します。
+
+使用例:
+    python3 benchmarks/startup.py --target-ms 300
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATH = os.path.join(os.path.dirname(BENCH_DIR), 'dmarc-analyzer.py')
+
+sys.path.insert(0, BENCH_DIR)
+from generate_reports import generate_reports  # noqa: E402
+
+
+def time_command(args: List[str], repeat: int) -> List[float]:
+    """コマンドを repeat 回実行し、各回の所要時間（ミリ秒）を返す"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, SCRIPT_PATH] + args, stdout=subprocess.DEVNULL, check=True)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DMARC Analyzer 起動時間ベンチマーク')
+    parser.add_argument('--files', type=int, default=50, help='生成するレポート数 (デフォルト: 50)')
+    parser.add_argument('--records', type=int, default=200, help='1レポートあたりのレコード数 (デフォルト: 200)')
+    parser.add_argument('--repeat', type=int, default=5, help='計測回数（中央値を採用, デフォルト: 5）')
+    parser.add_argument('--target-ms', type=float, help='中央値の目標（ミリ秒）。超えた場合は終了コード 1')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='dmarc-startup-') as tmp_dir:
+        dmarc_dir = os.path.join(tmp_dir, 'reports')
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        generate_reports(dmarc_dir, files=args.files, records=args.records)
+        cached_run = ['--dir', dmarc_dir, '--cache-dir', cache_dir]
+
+        # 1回目でキャッシュを作成（計測対象外）
+        subprocess.run([sys.executable, SCRIPT_PATH] + cached_run, stdout=subprocess.DEVNULL, check=True)
+
+        results = [
+            ('--help', time_command(['--help'], args.repeat)),
+            ('cached (変更なし)', time_command(cached_run, args.repeat)),
+        ]
+
+    exceeded = False
+    print(f"{'コマンド':<24}{'中央値(ms)':>12}{'最短(ms)':>12}")
+    for name, timings in results:
+        median = statistics.median(timings)
+        print(f"{name:<24}{median:>12.1f}{min(timings):>12.1f}")
+        if args.target_ms is not None and median > args.target_ms:
+            exceeded = True
+
+    if exceeded:
+        print(f"❌ 目標 {args.target_ms:.0f} ms を超えました")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,6 @@
 # /// script
 # requires-python = ">=3.10"
 # dependencies = [
-#     "pandas",
 #     "tabulate",
 #     "colorama",
 # ]
@@ -18,216 +17,2985 @@ import os
 import xml.etree.ElementTree as ET
 import zipfile
 import gzip
+import io
+import hashlib
+import heapq
+import importlib
+import marshal
 import glob
 import argparse
+import contextlib
+import ipaddress
+import struct
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
+from operator import attrgetter
+from sys import intern
 from pathlib import Path
 import json
 import shutil
-from typing import List, Dict, Any, Optional
+import signal
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional, Union, BinaryIO, Iterable, Iterator, NamedTuple
+
+# 評価ロジックのバージョン（評価・統合の結果や保存形式が変わる変更をしたら上げる。キャッシュが無効化される）
+EVALUATION_VERSION = 3
+
+# 分析結果キャッシュ（統合済みレコードと統計）の形式のバージョン
+RESULT_VERSION = 3
+
+# スクリプト本体のディレクトリ（シンボリックリンク経由の実行でも同梱ファイルを参照できるようにする）
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# OSのパッケージで提供される Public Suffix List（Debian/Ubuntu の publicsuffix パッケージ）
+SYSTEM_PUBLIC_SUFFIX_LIST = '/usr/share/publicsuffix/public_suffix_list.dat'
+
+# 組織ドメインのLRUキャッシュ件数
+ORG_DOMAIN_CACHE_SIZE = 65536
+
+# DMARC評価結果のLRUキャッシュ件数と、まとめて評価するレコード数
+EVALUATION_CACHE_SIZE = 65536
+EVALUATION_BATCH_SIZE = 4096
+
+# 評価済みレコードの列
+RECORD_COLUMNS = (
+    'source_ip', 'count', 'header_from', 'spf_domain', 'spf_result',
+    'dkim_domain', 'dkim_result', 'dkim_selector', 'dmarc_result', 'note'
+)
+
+# 統合キー（この値がすべて同じレコードは件数を合算して1行にまとめる）
+CONSOLIDATION_KEYS = (
+    'source_ip', 'header_from', 'spf_domain', 'spf_result',
+    'dkim_domain', 'dkim_result', 'dkim_selector', 'dmarc_result'
+)
+
+# 外部ドメイン分析の集計項目
+EXTERNAL_STAT_KEYS = (
+    'spf_pass', 'spf_softfail', 'spf_fail', 'spf_none', 'spf_other',
+    'dkim_pass', 'dkim_fail', 'dkim_other'
+)
+
+# Header From ドメイン別の集計項目（行数・DMARC失敗行数・メッセージ数・DMARC失敗メッセージ数）
+HEADER_STAT_KEYS = ('total', 'fails', 'messages', 'fail_messages')
+
+# 外部ドメイン分析で個別に数える結果（それ以外は other）
+EXTERNAL_KNOWN_RESULTS = (
+    ('spf', ('pass', 'softfail', 'fail', 'none')),
+    ('dkim', ('pass', 'fail')),
+)
+
+# パトリシア木のノード（リスト）の各要素。ラベルが None のノードは分岐のためだけの中間ノード
+NODE_PREFIX, NODE_LENGTH, NODE_ZERO, NODE_ONE, NODE_LABEL = range(5)
+
+# IPv4 アドレスを IPv6 と同じ128ビット空間に置くための IPv4射影アドレス (::ffff:0:0/96)
+IPV4_MAPPED_PREFIX = 0xffff << 32
+
+# 逆引き (PTR) 結果のキャッシュ形式のバージョンと、名前がなかった場合にキャッシュする秒数
+RDNS_CACHE_VERSION = 1
+RDNS_NEGATIVE_TTL = 3600
+
+# --profile の計測結果（JSON）の形式のバージョン
+PROFILE_VERSION = 2
+
+# --profile で計測する段階（表示順）
+PROFILE_STAGES = ('extract', 'dedup', 'load_cache', 'load_result', 'load_store',
+                  'parse', 'evaluate', 'consolidate_file', 'consolidate', 'render', 'detailed_analysis')
+
+# map で書き出す部分集計ファイルの識別子と形式のバージョン
+PARTIAL_FORMAT = 'dmarc-analyzer-partial'
+PARTIAL_VERSION = 2
+
+# serve モードで提供する JSON API のエンドポイント（/metrics は Prometheus のテキスト形式）
+API_ENDPOINTS = ('/api/status', '/api/errors', '/api/records', '/api/header-domains',
+                 '/api/domain-groups', '/api/statistics', '/metrics')
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# メトリクスのラベルに使う結果（それ以外は other。結果がなければ none）
+METRIC_RESULTS = {
+    'spf': ('pass', 'fail', 'softfail', 'neutral', 'none', 'temperror', 'permerror'),
+    'dkim': ('pass', 'fail', 'neutral', 'none', 'policy', 'temperror', 'permerror'),
+    'disposition': ('none', 'quarantine', 'reject'),
+}
+
+# ラベルの値の数が上限を超えた後の値をまとめるラベル
+METRIC_OTHER_LABEL = '_other'
+
+# 重複としてスキップしたレポートを個別に表示する最大件数
+DUPLICATE_DISPLAY_LIMIT = 10
+
+# --profile で外れ値とみなすファイル処理時間（中央値の倍数）と、記録する最大件数
+PROFILE_OUTLIER_FACTOR = 3.0
+PROFILE_OUTLIER_LIMIT = 20
+
+# 分析対象のファイル拡張子
+REPORT_EXTENSIONS = ('.xml', '.zip', '.gz')
+
+# ファイル名から形式が分からない添付ファイルの Content-Type と拡張子
+ATTACHMENT_TYPES = {
+    'application/zip': '.zip',
+    'application/x-zip-compressed': '.zip',
+    'application/gzip': '.gz',
+    'application/x-gzip': '.gz',
+    'application/xml': '.xml',
+    'text/xml': '.xml',
+}
+
+# メールボックス走査結果の保存形式のバージョン
+MAILBOX_INDEX_VERSION = 1
+
+# SQLite レポートストアのスキーマ（reports: レポート単位、records: レポート内で統合済みの評価レコード）
+STORE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL UNIQUE,
+    org_name TEXT NOT NULL,
+    report_id TEXT NOT NULL,
+    date_begin INTEGER,
+    date_end INTEGER,
+    source TEXT NOT NULL,
+    evaluation_version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS records (
+    report INTEGER NOT NULL REFERENCES reports(id),
+    source_ip TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    header_from TEXT NOT NULL,
+    spf_domain TEXT NOT NULL,
+    spf_result TEXT NOT NULL,
+    dkim_domain TEXT NOT NULL,
+    dkim_result TEXT NOT NULL,
+    dkim_selector TEXT NOT NULL,
+    dmarc_result TEXT NOT NULL,
+    note TEXT NOT NULL,
+    ip_key BLOB
+);
+CREATE INDEX IF NOT EXISTS reports_date_range ON reports(date_begin, date_end);
+CREATE INDEX IF NOT EXISTS records_report ON records(report);
+CREATE INDEX IF NOT EXISTS records_ip_key ON records(ip_key);
+CREATE INDEX IF NOT EXISTS records_header_from ON records(header_from COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS records_spf_domain ON records(spf_domain COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS records_dkim_selector ON records(dkim_selector);
+CREATE INDEX IF NOT EXISTS records_dmarc_result ON records(dmarc_result);
+'''
+
+# 期間別の集計（rollups）: 期間の単位・開始時刻・Header From・送信元組織ごとの件数
+# messages などは count で重み付けしたメッセージ数、rows は統合済みレコード数
+ROLLUP_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rollups (
+    period TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    header_from TEXT NOT NULL,
+    org_name TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    messages INTEGER NOT NULL,
+    spf_fails INTEGER NOT NULL,
+    dkim_fails INTEGER NOT NULL,
+    dmarc_fails INTEGER NOT NULL,
+    PRIMARY KEY (period, bucket, header_from, org_name)
+) WITHOUT ROWID;
+'''
+
+# 期間の単位ごとの区切り（レポート期間の開始時刻 UTC で振り分け、週は月曜始まり。1970-01-01 は木曜）
+ROLLUP_BUCKETS = {
+    'day': 'reports.date_begin - reports.date_begin % 86400',
+    'week': 'reports.date_begin - (reports.date_begin + 3 * 86400) % (7 * 86400)',
+}
+
+# ストアのスキーマのバージョン（PRAGMA user_version）
+STORE_VERSION = 2
 
 # 依存関係チェック
-def check_dependencies():
-    """必要なライブラリの存在チェック"""
-    missing_libs = []
+@lru_cache(maxsize=None)
+def require(name: str):
+    """ライブラリを読み込む（インストールされていなければ案内を表示して終了）
+    
+    起動時にまとめて確認せず、実際に使う処理から呼び出す（serve・merge・--export やキャッシュ済みの
+    結果の表示など、使わない処理はライブラリがなくても動く）。
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        print("❌ 必要なライブラリがインストールされていません:")
+        print(f"不足ライブラリ: {name}")
+        print("\n以下のコマンドでインストールしてください:")
+        print(f"pip install {name}")
+        print("\nまたは:")
+        print(f"pip3 install {name}")
+        sys.exit(1)
+
+@lru_cache(maxsize=None)
+def load_colorama() -> tuple:
+    """coloramaを読み込んで初期化（カラー表示する場合のみ）"""
+    colorama = require('colorama')
+    colorama.init(autoreset=True)
+    return colorama.Fore, colorama.Style
+
+def local_name(tag: str) -> str:
+    """名前空間を除いたタグ名を返す"""
+    return tag.rpartition('}')[2]
+
+def element_text(elem) -> str:
+    """要素のテキストを前後の空白を除いて返す"""
+    return (elem.text or '').strip()
+
+def child_texts(elem, names: tuple) -> Dict[str, str]:
+    """子要素のテキストを1回の走査でまとめて取得"""
+    values = {}
+    for child in elem:
+        tag = local_name(child.tag)
+        # find() と同じく最初に出現した要素を採用
+        if tag in names and tag not in values:
+            values[tag] = element_text(child)
+    for name in names:
+        values.setdefault(name, '')
+    return values
+
+class PolicyPublished:
+    """policy_published 情報（同じレポートの全レコードで共有する）"""
+    __slots__ = ('domain', 'adkim', 'aspf', 'p')
+    
+    def __init__(self, domain: str = '', adkim: str = '', aspf: str = '', p: str = ''):
+        self.domain = intern(domain)
+        self.adkim = intern(adkim or 'r')  # デフォルトはrelaxed
+        self.aspf = intern(aspf or 'r')
+        self.p = intern(p)
+
+class AuthResult(NamedTuple):
+    """SPF/DKIM の認証結果（SPFの selector は空）"""
+    domain: str
+    result: str
+    selector: str = ''
+    
+    @classmethod
+    def from_element(cls, elem) -> 'AuthResult':
+        values = child_texts(elem, ('domain', 'result', 'selector'))
+        return cls(intern(values['domain']), intern(values['result']), intern(values['selector']))
+
+EMPTY_AUTH_RESULT = AuthResult('', '', '')
+
+class DMARCRecord:
+    """XMLから読み込んだ1レコード（文字列はインターン済み）"""
+    __slots__ = (
+        'source_ip', 'count', 'header_from', 'envelope_from',
+        'disposition', 'policy_dkim', 'policy_spf',
+        'spf_results', 'dkim_results', 'policy_published', 'report_metadata'
+    )
+    
+    def __init__(self, policy_published: PolicyPublished, report_metadata: Optional[Dict[str, str]] = None):
+        self.source_ip = ''
+        self.count = 1
+        self.header_from = ''
+        self.envelope_from = ''
+        # policy_evaluated の値（要素がなければ空）
+        self.disposition = ''
+        self.policy_dkim = ''
+        self.policy_spf = ''
+        self.spf_results = ()
+        self.dkim_results = ()
+        self.policy_published = policy_published
+        self.report_metadata = report_metadata  # 同じレポートの全レコードで共有
+
+class EvaluatedRecord:
+    """DMARC評価済みの1レコード（統合・表示の単位）"""
+    __slots__ = RECORD_COLUMNS
+    
+    def __init__(self, source_ip: str, count: int, header_from: str, spf_domain: str,
+                 spf_result: str, dkim_domain: str, dkim_result: str, dkim_selector: str,
+                 dmarc_result: str, note: str):
+        self.source_ip = source_ip
+        self.count = count
+        self.header_from = header_from
+        self.spf_domain = spf_domain
+        self.spf_result = spf_result
+        self.dkim_domain = dkim_domain
+        self.dkim_result = dkim_result
+        self.dkim_selector = dkim_selector
+        self.dmarc_result = dmarc_result
+        self.note = note
+    
+    def as_tuple(self) -> tuple:
+        """RECORD_COLUMNS 順のタプル（キャッシュ・プロセス間転送用）"""
+        return (self.source_ip, self.count, self.header_from, self.spf_domain,
+                self.spf_result, self.dkim_domain, self.dkim_result, self.dkim_selector,
+                self.dmarc_result, self.note)
+    
+    def copy(self) -> 'EvaluatedRecord':
+        return EvaluatedRecord(*self.as_tuple())
+    
+    def __reduce__(self):
+        return (EvaluatedRecord, self.as_tuple())
+    
+    def __repr__(self) -> str:
+        return f"EvaluatedRecord{self.as_tuple()!r}"
+
+# Public Suffix List のトライ木で使う印（ラベルは文字列なので整数キーとは衝突しない）
+PSL_RULE = 0       # このノードで終わる通常ルール
+PSL_EXCEPTION = 1  # このノードで終わる例外ルール（!city.kawasaki.jp など）
+
+def default_public_suffix_list_path() -> str:
+    """同梱のPublic Suffix Listのパス（なければOSのパッケージ版）"""
+    bundled = os.path.join(SCRIPT_DIR, 'data', 'public_suffix_list.dat')
+    if os.path.exists(bundled) or not os.path.exists(SYSTEM_PUBLIC_SUFFIX_LIST):
+        return bundled
+    return SYSTEM_PUBLIC_SUFFIX_LIST
+
+class PublicSuffixList:
+    """Public Suffix List を右端のラベルから辿るトライ木で保持し、組織ドメインを求める"""
+    
+    def __init__(self, trie: Dict):
+        self.trie = trie
+        self.org_domain = lru_cache(maxsize=ORG_DOMAIN_CACHE_SIZE)(self._org_domain)
+    
+    @classmethod
+    def load(cls, path: str, cache_dir: Optional[str] = None) -> 'PublicSuffixList':
+        """リストを読み込む。コンパイル済みスナップショットがあればそちらを使う"""
+        stat = os.stat(path)
+        snapshot_path = None
+        if cache_dir:
+            snapshot_path = os.path.join(
+                cache_dir, f"psl-{stat.st_size}-{stat.st_mtime_ns}.marshal")
+            try:
+                with open(snapshot_path, 'rb') as f:
+                    return cls(marshal.loads(f.read()))
+            except (OSError, EOFError, ValueError, TypeError):
+                pass
+        
+        with open(path, 'r', encoding='utf-8') as f:
+            trie = cls.build_trie(f)
+        
+        if snapshot_path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f"{snapshot_path}.tmp{os.getpid()}"
+                with open(tmp_path, 'wb') as f:
+                    marshal.dump(trie, f)
+                os.replace(tmp_path, snapshot_path)
+            except OSError:
+                pass
+        return cls(trie)
+    
+    @staticmethod
+    def build_trie(lines: Iterable[str]) -> Dict:
+        """リストの各ルールをラベルを逆順にしたトライ木に登録"""
+        trie = {}
+        for line in lines:
+            rule = line.strip().split(' ', 1)[0]
+            if not rule or rule.startswith('//'):
+                continue
+            marker = PSL_RULE
+            if rule.startswith('!'):
+                marker = PSL_EXCEPTION
+                rule = rule[1:]
+            node = trie
+            for label in reversed(rule.lower().split('.')):
+                node = node.setdefault(label, {})
+            node[marker] = True
+        return trie
+    
+    def public_suffix_length(self, labels: List[str]) -> int:
+        """パブリックサフィックスに当たる右端のラベル数を返す"""
+        node = self.trie
+        length = 1  # どのルールにも一致しなければ "*"（TLDのみ）
+        for depth, label in enumerate(reversed(labels), start=1):
+            child = node.get(label)
+            if child is not None and PSL_EXCEPTION in child:
+                # 例外ルールは常に優先され、そのラベルを除いた部分がサフィックス
+                return depth - 1
+            wildcard = node.get('*')
+            if (child is not None and PSL_RULE in child) or (wildcard is not None and PSL_RULE in wildcard):
+                length = depth
+            node = child if child is not None else wildcard
+            if node is None:
+                break
+        return length
+    
+    def _org_domain(self, domain: str) -> str:
+        """組織ドメイン（パブリックサフィックス + 1ラベル）を返す"""
+        domain = domain.lower().rstrip('.')
+        labels = domain.split('.')
+        suffix_length = self.public_suffix_length(labels)
+        if len(labels) <= suffix_length:
+            return domain
+        return '.'.join(labels[-suffix_length - 1:])
+
+_public_suffix_list: Optional[PublicSuffixList] = None
+_public_suffix_list_path: Optional[str] = None
+_public_suffix_list_cache_dir: Optional[str] = None
+
+def configure_public_suffix_list(path: Optional[str], cache_dir: Optional[str] = None) -> None:
+    """使用するPublic Suffix Listのパスと、コンパイル済みスナップショットの保存先を設定
+    （読み込みは最初の利用時。cache_dir が None ならスナップショットを使わない）"""
+    global _public_suffix_list, _public_suffix_list_path, _public_suffix_list_cache_dir
+    _public_suffix_list = None
+    _public_suffix_list_path = path
+    _public_suffix_list_cache_dir = cache_dir
+
+def public_suffix_list() -> PublicSuffixList:
+    """設定された Public Suffix List（最初の利用時に読み込む）"""
+    global _public_suffix_list
+    if _public_suffix_list is None:
+        _public_suffix_list = PublicSuffixList.load(
+            _public_suffix_list_path or default_public_suffix_list_path(), _public_suffix_list_cache_dir)
+    return _public_suffix_list
+
+def public_suffix_list_signature() -> str:
+    """設定された Public Suffix List のパス・サイズ・更新時刻（組織ドメインの判定が変わりうるかの判定用）"""
+    path = os.path.abspath(_public_suffix_list_path or default_public_suffix_list_path())
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def org_domain(domain: str) -> str:
+    """ドメインの組織ドメインを返す（結果はLRUキャッシュされる）"""
+    return public_suffix_list().org_domain(domain)
+
+@lru_cache(maxsize=ORG_DOMAIN_CACHE_SIZE)
+def is_public_suffix(domain: str) -> bool:
+    """ドメイン全体がパブリックサフィックス（com, co.jp など）か"""
+    labels = domain.lower().rstrip('.').split('.')
+    return public_suffix_list().public_suffix_length(labels) >= len(labels)
+
+class DomainGroup(NamedTuple):
+    """ドメイン一覧の1行（ドメインまたは "*.サフィックス" のグループ）"""
+    name: str
+    stats: Dict[str, int]  # EXTERNAL_STAT_KEYS ごとの件数
+    volume: int            # 件数の合計
+    first_seen: int        # 最初に出現したドメインの順番（同じ件数の並び順）
+
+class DomainTrie:
+    """ドメインをラベルの逆順（右端から）に辿るトライ木
+    
+    葉から根に向かって部分木の統計を集計し、しきい値を満たす部分木を "*.サフィックス" の
+    1行にまとめる。まとめる単位は深さを問わず、パブリックサフィックス（*.com など）だけは
+    まとめない。
+    """
+    
+    def __init__(self):
+        self.root = {}  # ラベル → 子ノード。ノードのドメイン自体の統計は None キーに置く
+        self.size = 0
+    
+    def insert(self, domain: str, stats: Dict[str, int]) -> None:
+        node = self.root
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        node[None] = DomainGroup(domain, stats, sum(stats.values()), self.size)
+        self.size += 1
+    
+    def groups(self, min_domains: int = 3, tail_volume: int = 0) -> List[DomainGroup]:
+        """ドメイン一覧の行を返す
+        
+        各ノードの下にある行（まとめ済みのグループは1行と数える）が min_domains 以上、
+        または2行以上で件数の合計が tail_volume 以下であれば、それらを1つのグループにまとめる。
+        """
+        def collapse(node: Dict, suffix: str) -> List[DomainGroup]:
+            below = []
+            for label, child in node.items():
+                if label is not None:
+                    below.extend(collapse(child, f"{label}.{suffix}" if suffix else label))
+            if len(below) >= 2 and suffix and not is_public_suffix(suffix):
+                volume = sum(group.volume for group in below)
+                if len(below) >= min_domains or volume <= tail_volume:
+                    stats = dict.fromkeys(EXTERNAL_STAT_KEYS, 0)
+                    for group in below:
+                        for key, value in group.stats.items():
+                            stats[key] += value
+                    below = [DomainGroup(f"*.{suffix}", stats, volume, min(g.first_seen for g in below))]
+            own = node.get(None)
+            if own is not None:
+                below.append(own)
+            return below
+        
+        return collapse(self.root, '')
+
+class ReportSource:
+    """DMARC レポートの読み込み元（XMLファイル / ZIPメンバー / GZファイル）"""
+    
+    def __init__(self, path: str, member: Optional[str] = None):
+        self.path = path
+        self.member = member  # ZIPアーカイブ内のメンバー名
+    
+    @property
+    def is_archive(self) -> bool:
+        """元ファイルがZIP/GZアーカイブかどうか"""
+        return self.member is not None or self.path.endswith('.gz')
+    
+    @property
+    def name(self) -> str:
+        """表示用のXMLファイル名"""
+        if self.member is not None:
+            return os.path.basename(self.member)
+        return os.path.basename(self.path).removesuffix('.gz')
+    
+    @property
+    def location(self) -> tuple:
+        """読み込み元の位置（同じファイル・メンバーなら内容が書き換えられても同じ値）"""
+        return os.path.abspath(self.path), self.member
+    
+    def signature(self) -> List[int]:
+        """変更検知用のファイルサイズと更新時刻"""
+        stat = os.stat(self.path)
+        return [stat.st_size, stat.st_mtime_ns]
+    
+    def open(self) -> BinaryIO:
+        """解凍済みXMLのバイトストリームを開く（ディスクには展開しない）"""
+        if self.member is not None:
+            # ZipFileを閉じてもメンバーのストリームは読み終わるまで有効
+            with zipfile.ZipFile(self.path, 'r') as zip_ref:
+                return zip_ref.open(self.member)
+        if self.path.endswith('.gz'):
+            return gzip.open(self.path, 'rb')
+        return open(self.path, 'rb')
+    
+    def __repr__(self) -> str:
+        return f"ReportSource({self.path!r}, {self.member!r})"
+
+class MailSource(ReportSource):
+    """メールボックス（Maildir / mbox）のメッセージに添付されたレポート
+    
+    member は「メッセージキー/パート番号/添付ファイル名[/ZIPメンバー名]」。
+    メッセージキーは Maildir ではファイル名の一意部分、mbox では Message-ID のハッシュ。
+    """
+    
+    def __init__(self, path: str, member: str, span: Optional[List[int]] = None):
+        super().__init__(path, member)
+        self.span = span  # mbox 内のメッセージ位置 [開始, 終了]
+    
+    @property
+    def is_archive(self) -> bool:
+        # メールボックス自体は削除しない
+        return False
+    
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.member.split('/', 3)[-1]).removesuffix('.gz')
+    
+    def signature(self) -> List[int]:
+        # 配送済みのメッセージは変更されないため、member だけで内容が決まる
+        return []
+    
+    def open(self) -> BinaryIO:
+        """メッセージの添付ファイルをメモリ上でデコード・解凍して開く"""
+        key, part, attachment, *zip_member = self.member.split('/', 3)
+        if self.span is not None:
+            raw = read_mbox_message(self.path, self.span)
+        else:
+            with open_maildir(self.path).get_file(key) as f:
+                raw = f.read()
+        payload = list(parse_message(raw).walk())[int(part)].get_payload(decode=True) or b''
+        return open_attachment(payload, attachment, zip_member[0] if zip_member else None)
+    
+    def __repr__(self) -> str:
+        return f"MailSource({self.path!r}, {self.member!r}, {self.span!r})"
+
+def parse_message(raw: bytes):
+    """メッセージのバイト列をパース"""
+    from email import message_from_bytes
+    return message_from_bytes(raw)
+
+@lru_cache(maxsize=None)
+def open_maildir(path: str):
+    """Maildir をプロセスごとに1回だけ開く（キーからファイルへの対応表を使い回す）"""
+    import mailbox
+    return mailbox.Maildir(path, factory=None, create=False)
+
+def message_identity(message, raw: bytes) -> str:
+    """Message-ID（ない場合はメッセージ全体のハッシュ）"""
+    message_id = (message.get('Message-ID') or '').strip()
+    return message_id or hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def read_mbox_message(path: str, span: List[int]) -> bytes:
+    """mbox から1メッセージ分を読み、先頭の From_ 行を除いて返す"""
+    with open(path, 'rb') as f:
+        f.seek(span[0])
+        raw = f.read(span[1] - span[0])
+    return raw.partition(b'\n')[2]
+
+def iter_mbox_spans(f: BinaryIO, offset: int = 0) -> Iterator[List[int]]:
+    """mbox の offset 以降のメッセージ位置 [開始, 終了] を順に返す（From_ 行で区切る）"""
+    f.seek(offset)
+    start = None
+    position = offset
+    for line in f:
+        if line.startswith(b'From '):
+            if start is not None:
+                yield [start, position]
+            start = position
+        position += len(line)
+    if start is not None:
+        yield [start, position]
+
+def report_attachments(message) -> Iterator[tuple]:
+    """レポートらしい添付ファイルの (パート番号, ファイル名) を列挙"""
+    for index, part in enumerate(message.walk()):
+        if part.is_multipart():
+            continue
+        name = os.path.basename((part.get_filename() or '').replace('\\', '/'))
+        if not name.lower().endswith(REPORT_EXTENSIONS):
+            extension = ATTACHMENT_TYPES.get(part.get_content_type())
+            if extension is None:
+                continue
+            name = f"part{index}{extension}"
+        yield index, name
+
+def open_attachment(payload: bytes, name: str, member: Optional[str] = None) -> BinaryIO:
+    """デコード済みの添付ファイルから解凍済みXMLのストリームを開く"""
+    stream = io.BytesIO(payload)
+    lower_name = name.lower()
+    if lower_name.endswith('.zip'):
+        with zipfile.ZipFile(stream) as zip_ref:
+            return zip_ref.open(member)
+    if lower_name.endswith('.gz'):
+        return gzip.GzipFile(fileobj=stream)
+    return stream
+
+def attachment_members(payload: bytes, name: str) -> List[Optional[str]]:
+    """添付ファイル内のXML（ZIPならXMLメンバー名、それ以外は None）"""
+    if not name.lower().endswith('.zip'):
+        return [None]
+    with zipfile.ZipFile(io.BytesIO(payload)) as zip_ref:
+        return [member for member in zip_ref.namelist() if member.endswith('.xml')]
+
+class HashingReader:
+    """読み込んだバイト列でハッシュを更新するストリームラッパー（stats['bytes'] に読み込んだバイト数を加算）"""
+    
+    def __init__(self, stream: BinaryIO, digest, stats: Optional[Dict[str, Any]] = None):
+        self.stream = stream
+        self.digest = digest
+        self.stats = stats if stats is not None else {}
+        self.stats.setdefault('bytes', 0)
+    
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.digest.update(data)
+        self.stats['bytes'] += len(data)
+        return data
+    
+    def close(self) -> None:
+        self.stream.close()
+
+def parse_report_metadata(elem) -> Dict[str, str]:
+    """report_metadata要素から送信元組織・レポートID・期間を取得"""
+    metadata = child_texts(elem, ('org_name', 'email', 'report_id'))
+    metadata.update(begin='', end='')
+    for child in elem:
+        if local_name(child.tag) == 'date_range':
+            metadata.update(child_texts(child, ('begin', 'end')))
+            break
+    return metadata
+
+def report_identity(metadata: Dict[str, str]) -> Optional[tuple]:
+    """再送されたレポートを見分けるキー（送信元組織, レポートID, 期間の開始, 終了）。レポートIDがなければ None"""
+    report_id = metadata.get('report_id', '')
+    if not report_id:
+        return None
+    return (metadata.get('org_name', ''), report_id,
+            ReportStore.timestamp(metadata.get('begin', '')), ReportStore.timestamp(metadata.get('end', '')))
+
+def read_report_metadata(source: ReportSource) -> Dict[str, str]:
+    """report_metadata 要素だけを読んで返す（record は解析しない。読めなければ空の辞書）"""
+    try:
+        with source.open() as stream:
+            for _, elem in ET.iterparse(stream, events=('end',)):
+                tag = local_name(elem.tag)
+                if tag == 'report_metadata':
+                    return parse_report_metadata(elem)
+                if tag in ('policy_published', 'record'):
+                    break
+    except Exception:
+        # 壊れたファイルは本処理でエラーとして表示する
+        pass
+    return {}
+
+def content_digest(source: ReportSource) -> Optional[str]:
+    """解凍後の内容のハッシュ（ProcessedReport.digest と同じ値。読めなければ None）"""
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        with source.open() as stream:
+            for chunk in iter(lambda: stream.read(1 << 16), b''):
+                digest.update(chunk)
+    except Exception:
+        # 壊れたファイルは本処理でエラーとして表示する
+        return None
+    return digest.hexdigest()
+
+class ProcessedReport(NamedTuple):
+    """1ファイル分の処理結果"""
+    records: List['EvaluatedRecord']  # ファイル内で統合済みの評価レコード
+    report_metadata: Dict[str, str]
+    digest: Optional[str]  # 解凍後の内容のハッシュ（失敗時はNone）
+    stats: Dict[str, Any]  # 処理件数・解凍後のバイト数・段階ごとの処理時間
+
+class StageTimer:
+    """区間ごとの実時間と CPU 時間を段階名ごとに積算する（1ファイルの処理内訳の計測用）"""
+    
+    def __init__(self):
+        self.timings = {}  # 段階名 -> [実時間, CPU時間]
+        self.wall, self.cpu = time.perf_counter(), time.process_time()
+    
+    def lap(self, name: str) -> None:
+        """前回の lap() からの経過時間を段階 name に加算"""
+        wall, cpu = time.perf_counter(), time.process_time()
+        timing = self.timings.setdefault(name, [0.0, 0.0])
+        timing[0] += wall - self.wall
+        timing[1] += cpu - self.cpu
+        self.wall, self.cpu = wall, cpu
+
+def iter_batches(iterable: Iterable, size: int) -> Iterator[List]:
+    """iterable を size 件ずつのリストに分割"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+def evaluation_key(record: DMARCRecord) -> tuple:
+    """DMARC評価結果を決める認証情報の組み合わせ（source_ip と count は含まない）"""
+    policy_published = record.policy_published
+    return (record.header_from, record.policy_dkim, record.policy_spf,
+            record.spf_results, record.dkim_results,
+            policy_published.adkim, policy_published.aspf)
+
+class EvaluationCache:
+    """認証情報の組み合わせごとの評価結果を保持するLRUキャッシュ（ファイルをまたいで利用）"""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.records = 0      # 評価したレコード数
+        self.evaluations = 0  # 実際に評価した組み合わせ数（キャッシュミス）
+    
+    def get(self, key: tuple) -> Optional[tuple]:
+        outcome = self.entries.get(key)
+        if outcome is not None:
+            self.entries.move_to_end(key)
+        return outcome
+    
+    def put(self, key: tuple, outcome: tuple) -> None:
+        self.entries[key] = outcome
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+    
+    @property
+    def hit_rate(self) -> float:
+        """評価を省略できたレコードの割合"""
+        return 1 - self.evaluations / self.records if self.records else 0.0
+
+class AnalysisResult(NamedTuple):
+    """ファイル間で統合した最終的な分析結果"""
+    records: List['EvaluatedRecord']        # 統合済みの全レコード
+    error_records: List['EvaluatedRecord']  # そのうちエラーのあるレコード
+    statistics: Dict[str, Any]              # StatisticsAggregator.as_dict() の結果
+
+@lru_cache(maxsize=None)
+def external_stat(kind: str, result: str) -> str:
+    """外部ドメイン分析の集計項目名（既知の結果以外は other）"""
+    result = result.lower()
+    return f'{kind}_{result}' if result in dict(EXTERNAL_KNOWN_RESULTS)[kind] else f'{kind}_other'
+
+# レコードから統合キーのタプルを取り出す
+consolidation_key = attrgetter(*CONSOLIDATION_KEYS)
+
+def is_error_record(record: 'EvaluatedRecord') -> bool:
+    """SPF/DKIM/DMARC のいずれかが pass でないレコードか"""
+    return record.spf_result != 'pass' or record.dkim_result != 'pass' or record.dmarc_result != 'pass'
+
+class StatisticsAggregator:
+    """詳細分析の統計を1回の走査で集計する
+    
+    行数はファイル間で統合した表の行（統合キーごとに1回）、メッセージ数は count の合計で数える。
+    レコードを1件ずつ加えることも、別のファイル・プロセス・マシンで作った集計を merge() で
+    合算することもできる。merge() は結合的で、a に b を合算した結果は a のレコードの後に
+    b のレコードを順に加えた結果と（ドメインの出現順も含めて）一致する。
+    """
+    
+    def __init__(self):
+        self.keys = {}  # 統合キー → None（出現順を保つ集合）
+        self.total_records = 0
+        self.spf_fails = 0
+        self.dkim_fails = 0
+        self.dmarc_fails = 0
+        self.messages = 0
+        self.spf_fail_messages = 0
+        self.dkim_fail_messages = 0
+        self.dmarc_fail_messages = 0
+        self.header_domains = {}     # Header From → HEADER_STAT_KEYS
+        self.external_domains = {}   # 外部ドメイン → EXTERNAL_STAT_KEYS ごとの行数
+        self.external_messages = {}  # 外部ドメイン → EXTERNAL_STAT_KEYS ごとのメッセージ数
+    
+    def add(self, record: 'EvaluatedRecord') -> None:
+        """レコードを1件加える（統合キーが初出の場合のみ行数に数える）"""
+        key = consolidation_key(record)
+        if key in self.keys:
+            self.accumulate(key, 0, record.count)
+        else:
+            self.keys[key] = None
+            self.accumulate(key, 1, record.count)
+    
+    def update(self, records: Iterable['EvaluatedRecord']) -> 'StatisticsAggregator':
+        for record in records:
+            self.add(record)
+        return self
+    
+    def accumulate(self, key: tuple, rows: int, messages: int) -> None:
+        """統合キーから分かる結果を、rows 行・messages 通として加える"""
+        _, header_from, spf_domain, spf_result, dkim_domain, dkim_result, _, dmarc_result = key
+        spf_failed = spf_result != 'pass'
+        dkim_failed = dkim_result != 'pass'
+        dmarc_failed = dmarc_result != 'pass'
+        if rows:
+            self.total_records += rows
+            self.spf_fails += spf_failed
+            self.dkim_fails += dkim_failed
+            self.dmarc_fails += dmarc_failed
+        self.messages += messages
+        if spf_failed:
+            self.spf_fail_messages += messages
+        if dkim_failed:
+            self.dkim_fail_messages += messages
+        if dmarc_failed:
+            self.dmarc_fail_messages += messages
+        
+        header = self.header_domains.get(header_from)
+        if header is None:
+            header = self.header_domains[header_from] = dict.fromkeys(HEADER_STAT_KEYS, 0)
+        header['total'] += rows
+        header['messages'] += messages
+        if dmarc_failed:
+            header['fails'] += rows
+            header['fail_messages'] += messages
+        
+        if spf_domain and spf_domain != header_from:
+            self.accumulate_external(spf_domain, external_stat('spf', spf_result), rows, messages)
+        if dkim_domain and dkim_domain != header_from:
+            self.accumulate_external(dkim_domain, external_stat('dkim', dkim_result), rows, messages)
+    
+    def accumulate_external(self, domain: str, stat: str, rows: int, messages: int) -> None:
+        if rows:
+            stats = self.external_domains.get(domain)
+            if stats is None:
+                stats = self.external_domains[domain] = dict.fromkeys(EXTERNAL_STAT_KEYS, 0)
+            stats[stat] += rows
+        stats = self.external_messages.get(domain)
+        if stats is None:
+            stats = self.external_messages[domain] = dict.fromkeys(EXTERNAL_STAT_KEYS, 0)
+        stats[stat] += messages
+    
+    def merge(self, other: 'StatisticsAggregator') -> 'StatisticsAggregator':
+        """別の集計を合算する（other は変更しない）"""
+        # メッセージ数は単純な和。ドメインは other での出現順に追加される
+        self.messages += other.messages
+        self.spf_fail_messages += other.spf_fail_messages
+        self.dkim_fail_messages += other.dkim_fail_messages
+        self.dmarc_fail_messages += other.dmarc_fail_messages
+        for domain, stats in other.header_domains.items():
+            header = self.header_domains.setdefault(domain, dict.fromkeys(HEADER_STAT_KEYS, 0))
+            header['messages'] += stats['messages']
+            header['fail_messages'] += stats['fail_messages']
+        for domain, stats in other.external_messages.items():
+            target = self.external_messages.setdefault(domain, dict.fromkeys(EXTERNAL_STAT_KEYS, 0))
+            for stat, value in stats.items():
+                target[stat] += value
+        
+        # 行数は、まだ数えていない統合キーの分だけを加える
+        for key in other.keys:
+            if key not in self.keys:
+                self.keys[key] = None
+                self.accumulate(key, 1, 0)
+        return self
+    
+    def reorder(self, records: Iterable['EvaluatedRecord']) -> 'StatisticsAggregator':
+        """統合キーとドメインの並びを records での出現順にそろえる（件数は変えない）
+        
+        同じ一覧を分割した部分集計を merge() した後、1台で順に加えた場合と同じ並びにするために使う。
+        """
+        keys, header_domains, external_domains = {}, {}, {}
+        for record in records:
+            keys[consolidation_key(record)] = None
+            header_domains[record.header_from] = None
+            for domain in (record.spf_domain, record.dkim_domain):
+                if domain and domain != record.header_from:
+                    external_domains[domain] = None
+        
+        def ordered(values: Dict, order: Dict) -> Dict:
+            return {**{key: values[key] for key in order if key in values}, **values}
+        
+        self.keys = ordered(self.keys, keys)
+        self.header_domains = ordered(self.header_domains, header_domains)
+        self.external_domains = ordered(self.external_domains, external_domains)
+        self.external_messages = ordered(self.external_messages, external_domains)
+        return self
+    
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'total_records': self.total_records,
+            'spf_fails': self.spf_fails,
+            'dkim_fails': self.dkim_fails,
+            'dmarc_fails': self.dmarc_fails,
+            'messages': self.messages,
+            'spf_fail_messages': self.spf_fail_messages,
+            'dkim_fail_messages': self.dkim_fail_messages,
+            'dmarc_fail_messages': self.dmarc_fail_messages,
+            'header_domains': self.header_domains,
+            'external_domains': self.external_domains,
+            'external_messages': self.external_messages,
+        }
+    
+    def to_state(self) -> Dict[str, Any]:
+        """JSON で保存・転送できる形式（統合キーも含むため、別の集計と合算できる）"""
+        return {**self.as_dict(), 'keys': list(self.keys)}
+    
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> 'StatisticsAggregator':
+        aggregator = cls()
+        for name, value in state.items():
+            if name != 'keys':
+                setattr(aggregator, name, value)
+        aggregator.keys = dict.fromkeys(map(tuple, state['keys']))
+        return aggregator
+
+def record_dict(record: 'EvaluatedRecord') -> Dict[str, Any]:
+    """評価済みレコードを列名をキーとする辞書に変換（JSON 出力用）"""
+    return dict(zip(RECORD_COLUMNS, record.as_tuple()))
+
+class RecordWriter:
+    """評価済みレコードを JSON Lines / CSV で1行ずつ書き出す（下流のパイプライン向け）
+    
+    JSON Lines は各行が {"type": "record", 列名: 値...}、最後の行が統計の
+    {"type": "summary", ...}。CSV は RECORD_COLUMNS のヘッダー行とレコード行のみで、
+    統計は summary_path を指定した場合に JSON ファイルとして書き出す。
+    """
+    
+    def __init__(self, stream, output_format: str, summary_path: Optional[str] = None):
+        self.stream = stream
+        self.format = output_format
+        self.summary_path = summary_path
+        self.csv = None
+        if output_format == 'csv':
+            import csv
+            self.csv = csv.writer(stream)
+            self.csv.writerow(RECORD_COLUMNS)
+    
+    def write(self, records: Iterable['EvaluatedRecord']) -> None:
+        if self.csv is not None:
+            self.csv.writerows(record.as_tuple() for record in records)
+            return
+        for record in records:
+            self.stream.write(json.dumps({'type': 'record', **record_dict(record)}, ensure_ascii=False) + '\n')
+    
+    def write_summary(self, statistics: Dict[str, Any]) -> None:
+        """StatisticsAggregator.as_dict() の統計を書き出す"""
+        if self.format == 'jsonl':
+            self.stream.write(json.dumps({'type': 'summary', **statistics}, ensure_ascii=False) + '\n')
+        self.stream.flush()
+        if self.summary_path:
+            with open(self.summary_path, 'w', encoding='utf-8') as f:
+                json.dump(statistics, f, ensure_ascii=False, indent=2)
+
+def peak_rss_bytes(children: bool = False) -> Optional[int]:
+    """自プロセス（children の場合は終了済みの子プロセスの最大）の最大常駐メモリ（取得できなければ None）"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # Linux はキロバイト、macOS はバイト単位
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+class Profiler:
+    """--profile で段階ごとの実時間・CPU時間・スループット・最大メモリを計測し、JSON で書き出す
+    
+    parse / evaluate / consolidate はファイルごとの計測値（ProcessedReport.stats）の合計のため、
+    並列処理ではワーカー全体の合計となり、全体の実時間を超えることがある。
+    各段階の peak_rss_bytes はその段階の終了時点での親プロセスの最大常駐メモリ。
+    """
+    
+    def __init__(self, path: str, jobs: int = 1, cprofile_path: Optional[str] = None):
+        self.path = path
+        self.jobs = jobs
+        self.cprofile_path = cprofile_path
+        self.stages = {}
+        self.files = []  # (名前, 実時間, CPU時間, レコード数, バイト数)
+        self.cached_files = 0
+        self.failed_files = 0
+        self.started_at = datetime.now(timezone.utc)
+        self.wall, self.cpu = time.perf_counter(), time.process_time()
+    
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[Dict[str, int]]:
+        """with 文の範囲を段階 name の時間として加算（yield した辞書の records に処理件数を入れる）"""
+        counters = {}
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield counters
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu, **counters)
+    
+    def add(self, name: str, wall_seconds: float, cpu_seconds: float, records: int = 0, size: int = 0) -> None:
+        stage = self.stages.setdefault(name, {
+            'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'records': 0, 'bytes': 0,
+        })
+        stage['calls'] += 1
+        stage['wall_seconds'] += wall_seconds
+        stage['cpu_seconds'] += cpu_seconds
+        stage['records'] += records
+        stage['bytes'] += size
+        stage['peak_rss_bytes'] = peak_rss_bytes()
+    
+    def add_file(self, source: ReportSource, report: ProcessedReport) -> None:
+        """1ファイル分の処理内訳を parse / evaluate / consolidate_file に加える"""
+        stats = report.stats
+        if report.digest is None:
+            self.failed_files += 1
+            return
+        records, size = stats.get('records', 0), stats.get('bytes', 0)
+        wall = cpu = 0.0
+        for name, (stage_wall, stage_cpu) in stats.get('timings', {}).items():
+            self.add(name, stage_wall, stage_cpu, records, size if name == 'parse' else 0)
+            wall += stage_wall
+            cpu += stage_cpu
+        self.files.append((source.name, wall, cpu, records, size))
+    
+    def file_metrics(self) -> Dict[str, Any]:
+        """ファイルごとの処理時間の分布と外れ値（中央値の PROFILE_OUTLIER_FACTOR 倍を超えるもの）"""
+        timings = sorted(entry[1] for entry in self.files)
+        metrics = {
+            'processed': len(self.files),
+            'cached': self.cached_files,
+            'failed': self.failed_files,
+            'records': sum(entry[3] for entry in self.files),
+            'bytes': sum(entry[4] for entry in self.files),
+        }
+        if not timings:
+            return metrics
+        median = timings[len(timings) // 2]
+        metrics['seconds'] = {
+            'median': median,
+            'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            'max': timings[-1],
+        }
+        outliers = heapq.nlargest(PROFILE_OUTLIER_LIMIT,
+                                  (entry for entry in self.files if entry[1] > median * PROFILE_OUTLIER_FACTOR),
+                                  key=lambda entry: entry[1])
+        metrics['outliers'] = [{
+            'source': name,
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'records': records,
+            'bytes': size,
+            'records_per_second': records / wall if wall else None,
+        } for name, wall, cpu, records, size in outliers]
+        return metrics
+    
+    def document(self) -> Dict[str, Any]:
+        """計測結果を JSON にできる辞書で返す"""
+        import platform
+        
+        stages = {}
+        for name in sorted(self.stages, key=lambda name: (
+                PROFILE_STAGES.index(name) if name in PROFILE_STAGES else len(PROFILE_STAGES))):
+            stage = dict(self.stages[name])
+            wall = stage['wall_seconds']
+            stage['records_per_second'] = stage['records'] / wall if wall and stage['records'] else None
+            stage['bytes_per_second'] = stage['bytes'] / wall if wall and stage['bytes'] else None
+            stages[name] = stage
+        times = os.times()
+        return {
+            'version': PROFILE_VERSION,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'command': sys.argv[1:],
+            'python': platform.python_version(),
+            'platform': sys.platform,
+            'jobs': self.jobs,
+            'wall_seconds': time.perf_counter() - self.wall,
+            'cpu_seconds': time.process_time() - self.cpu,
+            'children_cpu_seconds': times.children_user + times.children_system,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'children_peak_rss_bytes': peak_rss_bytes(children=True),
+            'stages': stages,
+            'files': self.file_metrics(),
+            'cprofile': self.cprofile_path,
+        }
+    
+    def write(self) -> None:
+        """計測結果を書き出す（パスが "-" の場合は標準エラー出力）"""
+        document = json.dumps(self.document(), ensure_ascii=False, indent=2)
+        if self.path == '-':
+            sys.stderr.write(document + '\n')
+            return
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.write(document + '\n')
+        except OSError as e:
+            print(f"⚠️  プロファイル書き込みエラー: {e}")
+            return
+        print(f"📈 プロファイルを書き出しました: {self.path}")
+
+def default_cache_dir() -> str:
+    """キャッシュディレクトリのデフォルトパス"""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'dmarc-analyzer')
+
+class ReportCache:
+    """評価済みレコードのディスクキャッシュ
+    
+    レポートの内容ハッシュごとに評価済みレコードを保存し、送信元組織・
+    レポートID・期間を合わせて記録する（重複レポートの判定に使う）。ファイルのサイズと更新時刻が変わらなければ
+    再解凍・再解析せずにキャッシュから読み込む。EVALUATION_VERSION か、アライメントの判定に使う
+    Public Suffix List が変わるとキャッシュ全体を破棄する。
+    """
+    
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.records_dir = os.path.join(cache_dir, 'records')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.result_path = os.path.join(cache_dir, 'result.json')
+        self.psl = public_suffix_list_signature()
+        self.index = self.load_index()
+        self.dirty = False
+    
+    def load_index(self) -> Dict[str, Any]:
+        """インデックスを読み込み、評価ロジックのバージョンか Public Suffix List が異なれば破棄"""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('version') == EVALUATION_VERSION and index.get('psl') == self.psl:
+                return index
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️  キャッシュを読み込めないため作り直します: {e}")
+        
+        shutil.rmtree(self.records_dir, ignore_errors=True)
+        return {'version': EVALUATION_VERSION, 'psl': self.psl, 'files': {}, 'reports': {}}
+    
+    @staticmethod
+    def source_key(source: ReportSource) -> str:
+        """読み込み元を一意に識別するキー"""
+        path = os.path.abspath(source.path)
+        return f"{path}#{source.member}" if source.member is not None else path
+    
+    @staticmethod
+    def source_stat(source: ReportSource) -> List[int]:
+        """変更検知用のファイルサイズと更新時刻"""
+        return source.signature()
+    
+    def records_path(self, digest: str) -> str:
+        return os.path.join(self.records_dir, f"{digest}.json")
+    
+    def entry_for(self, source: ReportSource) -> Optional[Dict[str, Any]]:
+        """変更されていないファイルのインデックスのエントリを返す（なければNone）"""
+        entry = self.index['files'].get(self.source_key(source))
+        if entry is None:
+            return None
+        try:
+            if entry['stat'] != self.source_stat(source):
+                return None
+        except OSError:
+            return None
+        return entry
+    
+    def digest_for(self, source: ReportSource) -> Optional[str]:
+        """変更されていないファイルの内容ハッシュを返す（なければNone）"""
+        entry = self.entry_for(source)
+        return entry.get('digest') if entry else None
+    
+    def failed(self, source: ReportSource) -> bool:
+        """前回解析に失敗し、その後変更されていないファイルか"""
+        entry = self.entry_for(source)
+        return bool(entry and entry.get('failed'))
+    
+    def load(self, source: ReportSource) -> Optional[List['EvaluatedRecord']]:
+        """変更されていないファイルの評価済みレコードを返す（なければNone）"""
+        digest = self.digest_for(source)
+        if digest is None:
+            return None
+        try:
+            with open(self.records_path(digest), 'r', encoding='utf-8') as f:
+                return [EvaluatedRecord(*row) for row in json.load(f)]
+        except (OSError, ValueError):
+            return None
+    
+    def result_key(self, digests: List[str], variant: str = '') -> str:
+        """ファイル構成（内容ハッシュの並び）・評価ロジックのバージョン・Public Suffix List・
+        表示の集計方法から作るキー"""
+        key = hashlib.blake2b(digest_size=16)
+        key.update(f"{EVALUATION_VERSION}\0{RESULT_VERSION}\0{self.psl}\0{variant}\0".encode())
+        for digest in digests:
+            key.update(digest.encode())
+        return key.hexdigest()
+    
+    def load_result(self, digests: List[str], variant: str = '') -> Optional['AnalysisResult']:
+        """前回と同じファイル構成・集計方法であれば、統合・集計済みの分析結果を返す"""
+        try:
+            with open(self.result_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('key') != self.result_key(digests, variant):
+                return None
+            records = [EvaluatedRecord(*row) for row in data['records']]
+            return AnalysisResult(records, [records[i] for i in data['errors']], data['statistics'])
+        except (OSError, ValueError, KeyError, IndexError, TypeError):
+            return None
+    
+    def store_result(self, digests: List[str], result: 'AnalysisResult', error_indexes: List[int],
+                     variant: str = '') -> None:
+        """分析結果を次回の高速表示用に保存"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            write_json_atomic(self.result_path, {
+                'key': self.result_key(digests, variant),
+                'records': [record.as_tuple() for record in result.records],
+                'errors': error_indexes,
+                'statistics': result.statistics,
+            })
+        except OSError as e:
+            print(f"⚠️  キャッシュ書き込みエラー: {e}")
+    
+    def identity_for(self, digest: str) -> Optional[tuple]:
+        """内容ハッシュのレポートの report_identity()（期間を記録していない古いエントリは None）"""
+        entry = self.index['reports'].get(digest)
+        if entry is None or 'begin' not in entry:
+            return None
+        return report_identity(entry)
+    
+    def metadata_for(self, digest: str) -> Dict[str, Any]:
+        """内容ハッシュのレポートについて記録したメタデータ（なければ空）"""
+        return self.index['reports'].get(digest) or {}
+    
+    def remember_metadata(self, digest: str, metadata: Dict[str, Any]) -> None:
+        """内容ハッシュのレポートの送信元組織・レポートID・期間（解析時は処置の内訳と統合前のレコード数も）を記録"""
+        entry = {name: metadata.get(name, '') for name in ('org_name', 'report_id', 'begin', 'end')}
+        for name in ('dispositions', 'records'):
+            value = metadata.get(name, self.metadata_for(digest).get(name))
+            if value is not None:
+                entry[name] = value
+        self.index['reports'][digest] = entry
+        self.dirty = True
+    
+    def store(self, source: ReportSource, report: ProcessedReport) -> None:
+        """処理結果を保存（解析に失敗したファイルは、変更されるまで解析し直さないよう失敗を記録）"""
+        if report.digest is None:
+            try:
+                self.index['files'][self.source_key(source)] = {
+                    'path': os.path.abspath(source.path),
+                    'stat': self.source_stat(source),
+                    'failed': True,
+                }
+                self.dirty = True
+            except OSError:
+                pass
+            return
+        try:
+            # 同じ内容のレポートはファイル名が違っても1つのエントリを共有する
+            if report.digest not in self.index['reports']:
+                os.makedirs(self.records_dir, exist_ok=True)
+                write_json_atomic(self.records_path(report.digest),
+                                  [record.as_tuple() for record in report.records])
+            # 処置の内訳を記録していない古いエントリは、解析し直した結果で補う
+            if 'dispositions' not in self.metadata_for(report.digest):
+                self.remember_metadata(report.digest, report.report_metadata)
+            self.index['files'][self.source_key(source)] = {
+                'path': os.path.abspath(source.path),
+                'stat': self.source_stat(source),
+                'digest': report.digest,
+            }
+            self.dirty = True
+        except OSError as e:
+            print(f"⚠️  キャッシュ書き込みエラー {source.name}: {e}")
+    
+    def retain_members(self, path: str, members: Iterable[str]) -> None:
+        """path のエントリのうち members にないもの（削除されたメッセージ）を整理"""
+        prefix = f"{os.path.abspath(path)}#"
+        keep = {prefix + member for member in members}
+        files = self.index['files']
+        for key in [k for k in files if k.startswith(prefix) and k not in keep]:
+            del files[key]
+            self.dirty = True
+    
+    def save(self) -> None:
+        """存在しなくなったファイルのエントリを整理してインデックスを保存"""
+        files = self.index['files']
+        for key in [k for k, entry in files.items() if not os.path.exists(entry['path'])]:
+            del files[key]
+            self.dirty = True
+        if not self.dirty:
+            return
+        
+        referenced = {entry['digest'] for entry in files.values() if 'digest' in entry}
+        for digest in [d for d in self.index['reports'] if d not in referenced]:
+            del self.index['reports'][digest]
+            try:
+                os.remove(self.records_path(digest))
+            except OSError:
+                pass
+        
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            write_json_atomic(self.index_path, self.index)
+            self.dirty = False
+        except OSError as e:
+            print(f"⚠️  キャッシュ書き込みエラー: {e}")
+
+class MailboxIndex:
+    """メールボックスの走査結果
+    
+    メッセージごとに Message-ID とレポート添付（MailSource の member）を記録し、
+    再走査では新しいメッセージだけを開く。mbox は前回読み終えた位置から続きを読む。
+    path が None の場合は保存しない。
+    """
+    
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.data = self.load()
+    
+    def load(self) -> Dict[str, Any]:
+        if self.path:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == MAILBOX_INDEX_VERSION:
+                    return data
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"⚠️  メールボックスの走査結果を読み込めないため作り直します: {e}")
+        return {'version': MAILBOX_INDEX_VERSION, 'mailboxes': {}}
+    
+    def mailbox(self, path: str) -> Dict[str, Any]:
+        """メールボックスごとの記録（messages: キー → {id, members[, span]}）"""
+        return self.data['mailboxes'].setdefault(os.path.abspath(path), {'messages': {}})
+    
+    def save(self) -> None:
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_json_atomic(self.path, self.data)
+        except OSError as e:
+            print(f"⚠️  キャッシュ書き込みエラー: {e}")
+
+@lru_cache(maxsize=ORG_DOMAIN_CACHE_SIZE)
+def ip_key(address: str) -> Optional[bytes]:
+    """IPアドレスを大小比較できる16バイトに変換（IPv4 は IPv4射影アドレス、不正な値は None）"""
+    try:
+        ip = ipaddress.ip_address(address.strip())
+    except ValueError:
+        return None
+    if ip.version == 4:
+        return b'\0' * 10 + b'\xff\xff' + ip.packed
+    return ip.packed
+
+def parse_date(value: str) -> int:
+    """YYYY-MM-DD（または ISO 8601 日時）を UNIX 時刻に変換（タイムゾーン省略時は UTC）"""
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+def prefix_mask(length: int) -> int:
+    """128ビット空間で先頭 length ビットが1のマスク"""
+    return ((1 << length) - 1) << (128 - length)
+
+def format_network(prefix: int, length: int) -> str:
+    """128ビット空間のプレフィックスを CIDR 表記に戻す（IPv4射影アドレスは IPv4 で表記）"""
+    if length >= 96 and prefix & prefix_mask(96) == IPV4_MAPPED_PREFIX:
+        return str(ipaddress.IPv4Network((prefix & 0xffffffff, length - 96)))
+    return str(ipaddress.IPv6Network((prefix, length)))
+
+class PrefixTree:
+    """送信元アドレス範囲を保持するパトリシア木（経路圧縮した二分基数木）
+    
+    IPv4 は IPv4射影アドレスとして IPv6 と同じ128ビット空間に入れる。ノードは marshal で
+    スナップショットを保存できるよう [プレフィックス, 長さ, 子0, 子1, ラベル] のリストで表す。
+    """
+    
+    def __init__(self, root: Optional[list] = None):
+        self.root = root or [0, 0, None, None, None]
+    
+    @classmethod
+    def load(cls, paths: List[str], cache_dir: Optional[str] = None) -> 'PrefixTree':
+        """ネットワーク一覧ファイルを読み込む（後のファイルの同じプレフィックスが優先）。
+        コンパイル済みスナップショットがあればそちらを使う"""
+        key = hashlib.blake2b(digest_size=16)
+        for path in paths:
+            stat = os.stat(path)
+            key.update(f"{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+        snapshot_path = os.path.join(cache_dir, f"networks-{key.hexdigest()}.marshal") if cache_dir else None
+        if snapshot_path:
+            try:
+                with open(snapshot_path, 'rb') as f:
+                    return cls(marshal.loads(f.read()))
+            except (OSError, EOFError, ValueError, TypeError):
+                pass
+        
+        tree = cls()
+        for path in paths:
+            invalid = 0
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    try:
+                        entry = cls.parse_line(line)
+                    except ValueError:
+                        invalid += 1
+                        continue
+                    if entry is not None:
+                        tree.insert(*entry)
+            if invalid:
+                print(f"⚠️  {path}: 解釈できない{invalid}行を無視しました")
+        
+        if snapshot_path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f"{snapshot_path}.tmp{os.getpid()}"
+                with open(tmp_path, 'wb') as f:
+                    marshal.dump(tree.root, f)
+                os.replace(tmp_path, snapshot_path)
+            except OSError:
+                pass
+        return tree
+    
+    @staticmethod
+    def parse_line(line: str) -> Optional[tuple]:
+        """ネットワーク一覧の1行を (プレフィックス, 長さ, ラベル) に変換（空行・コメントは None）
+        
+        "CIDR [ラベル]" 形式と、CAIDA pfx2as 形式の "アドレス プレフィックス長 AS番号" を受け付ける。
+        数字だけのラベルは AS番号として "AS" を付ける。
+        """
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            return None
+        if len(fields) >= 2 and '/' not in fields[0] and fields[1].isdigit():
+            fields = [f"{fields[0]}/{fields[1]}"] + fields[2:]
+        network = ipaddress.ip_network(fields[0], strict=False)
+        label = ' '.join(fields[1:])
+        if label.replace('_', '').replace(',', '').isdigit():
+            label = f"AS{label}"
+        if network.version == 4:
+            return IPV4_MAPPED_PREFIX | int(network.network_address), network.prefixlen + 96, label
+        return int(network.network_address), network.prefixlen, label
+    
+    def insert(self, prefix: int, length: int, label: str) -> None:
+        """プレフィックスを登録（同じプレフィックスは後から登録したラベルで上書き）"""
+        node = self.root
+        while True:
+            # ここでは node が prefix を含み、node の長さ <= length が成り立つ
+            if node[NODE_LENGTH] == length:
+                node[NODE_LABEL] = label
+                return
+            branch = NODE_ZERO + ((prefix >> (127 - node[NODE_LENGTH])) & 1)
+            child = node[branch]
+            if child is None:
+                node[branch] = [prefix, length, None, None, label]
+                return
+            # 子ノードと先頭から一致するビット数
+            limit = min(child[NODE_LENGTH], length)
+            common = limit - ((child[NODE_PREFIX] ^ prefix) >> (128 - limit)).bit_length()
+            if common == child[NODE_LENGTH]:
+                node = child
+                continue
+            # 一致する部分までの中間ノードを挟んで分岐させる
+            middle = [prefix & prefix_mask(common), common, None, None, None]
+            node[branch] = middle
+            middle[NODE_ZERO + ((child[NODE_PREFIX] >> (127 - common)) & 1)] = child
+            if common == length:
+                middle[NODE_LABEL] = label
+            else:
+                middle[NODE_ZERO + ((prefix >> (127 - common)) & 1)] = [prefix, length, None, None, label]
+            return
+    
+    def longest_match(self, address: int) -> Optional[list]:
+        """アドレスを含む最長のプレフィックスのノードを返す（なければ None）。辿るのは最大でプレフィックス長の段数"""
+        node = self.root
+        found = None
+        while node is not None:
+            length = node[NODE_LENGTH]
+            if length and (node[NODE_PREFIX] ^ address) >> (128 - length):
+                break
+            if node[NODE_LABEL] is not None:
+                found = node
+            if length == 128:
+                break
+            node = node[NODE_ZERO + ((address >> (127 - length)) & 1)]
+        return found
+
+class NetworkGrouping:
+    """送信元IPアドレスを、ネットワーク一覧の最長一致（ラベルがあれば所有者ラベル）または
+    既定のプレフィックス長のネットワークにまとめる"""
+    
+    def __init__(self, tree: PrefixTree, ipv4_prefix: int = 24, ipv6_prefix: int = 64, signature: str = ''):
+        self.tree = tree
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        # 分析結果キャッシュのキーに含める設定内容
+        self.signature = f"{signature}/{ipv4_prefix}/{ipv6_prefix}"
+        self.group = lru_cache(maxsize=ORG_DOMAIN_CACHE_SIZE)(self._group)
+    
+    @classmethod
+    def load(cls, paths: Optional[List[str]], ipv4_prefix: int = 24, ipv6_prefix: int = 64,
+             cache_dir: Optional[str] = None) -> 'NetworkGrouping':
+        """ネットワーク一覧ファイルを読み込んで作成（一覧の指定がなければ既定のプレフィックスのみ）"""
+        paths = paths or []
+        signature = hashlib.blake2b(digest_size=16)
+        for path in paths:
+            stat = os.stat(path)
+            signature.update(f"{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+        tree = PrefixTree.load(paths, cache_dir) if paths else PrefixTree()
+        return cls(tree, ipv4_prefix, ipv6_prefix, signature.hexdigest())
+    
+    def _group(self, address: str) -> str:
+        key = ip_key(address)
+        if key is None:
+            return address
+        value = int.from_bytes(key, 'big')
+        node = self.tree.longest_match(value)
+        if node is not None:
+            return node[NODE_LABEL] or format_network(node[NODE_PREFIX], node[NODE_LENGTH])
+        length = 96 + self.ipv4_prefix if value & prefix_mask(96) == IPV4_MAPPED_PREFIX else self.ipv6_prefix
+        if length == 128:
+            return address
+        return format_network(value & prefix_mask(length), length)
+    
+    def regroup(self, records: Iterable['EvaluatedRecord']) -> None:
+        """レコードの送信元IPアドレスをネットワーク（またはラベル）に置き換える"""
+        group = self.group
+        for record in records:
+            record.source_ip = group(record.source_ip)
+
+class RecordQuery(NamedTuple):
+    """ストアのレコード検索条件（None の項目は絞り込まない）"""
+    ip: Optional[str] = None
+    cidr: Optional[str] = None
+    header_from: Optional[str] = None
+    spf_domain: Optional[str] = None
+    dkim_selector: Optional[str] = None
+    since: Optional[int] = None   # この時刻以降に終わるレポート
+    until: Optional[int] = None   # この時刻より前に始まるレポート
+    result: Optional[str] = None  # DMARC結果
+    
+    def where(self) -> tuple:
+        """WHERE 句と引数（いずれもインデックスで引ける条件）"""
+        clauses = []
+        params = []
+        if self.ip is not None:
+            clauses.append('records.ip_key = ?')
+            params.append(ip_key(self.ip))
+        if self.cidr is not None:
+            network = ipaddress.ip_network(self.cidr, strict=False)
+            clauses.append('records.ip_key BETWEEN ? AND ?')
+            params.extend((ip_key(str(network[0])), ip_key(str(network[-1]))))
+        for column in ('header_from', 'spf_domain'):
+            if getattr(self, column) is not None:
+                clauses.append(f'records.{column} = ? COLLATE NOCASE')
+                params.append(getattr(self, column))
+        if self.dkim_selector is not None:
+            clauses.append('records.dkim_selector = ?')
+            params.append(self.dkim_selector)
+        if self.since is not None:
+            clauses.append('reports.date_end >= ?')
+            params.append(self.since)
+        if self.until is not None:
+            clauses.append('reports.date_begin < ?')
+            params.append(self.until)
+        if self.result is not None:
+            clauses.append('records.dmarc_result = ?')
+            params.append(self.result)
+        return ' AND '.join(clauses) or '1', params
+    
+    def describe(self) -> str:
+        """表示用の検索条件"""
+        parts = []
+        for name, value in self._asdict().items():
+            if value is None:
+                continue
+            if name in ('since', 'until'):
+                value = datetime.fromtimestamp(value, timezone.utc).strftime('%Y-%m-%d %H:%M')
+            parts.append(f"{name}={value}")
+        return ', '.join(parts)
+
+def sql_statements(script: str) -> List[str]:
+    """スキーマのスクリプトを文ごとに分ける（文字列リテラルに ; を含まないスクリプト用）"""
+    return [statement.strip() for statement in script.split(';') if statement.strip()]
+
+class ReportStore:
+    """評価済みレコードを蓄積する SQLite ストア
+    
+    レポートの内容ハッシュごとに1回だけ保存するため、同じレポートを何度処理しても
+    重複しない。送信元組織・レポートID・期間が同じ再送レポートも保存しない。
+    元のXMLを削除しても履歴として残る。
+    """
+    
+    def __init__(self, path: str):
+        import sqlite3
+        
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.migrate()
+        self.digests = set()
+        self.identities = set()
+        for digest, *identity in self.connection.execute(
+                'SELECT digest, org_name, report_id, date_begin, date_end FROM reports'):
+            self.digests.add(digest)
+            if identity[1]:
+                self.identities.add(tuple(identity))
+    
+    def migrate(self) -> None:
+        """スキーマを作成し、古いバージョンのストアを更新
+        
+        途中で中断しても古いバージョンのまま残るよう、列の追加・既存行の更新・索引と集計表の作成・
+        user_version の更新を1つのトランザクションで行う（executescript() は実行前に COMMIT するため使わない）。
+        """
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] == STORE_VERSION:
+            return
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            # 書き込みロックを取った後に読み直す（他のプロセスが先に更新していれば何もしない）
+            version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+            if version != STORE_VERSION:
+                self.migrate_from(version)
+        except BaseException:
+            self.connection.rollback()
+            raise
+        self.connection.commit()
+    
+    def migrate_from(self, version: int) -> None:
+        """バージョン version のストアを更新（トランザクション内で呼び出す）"""
+        columns = {row[1] for row in self.connection.execute('PRAGMA table_info(records)')}
+        if columns and 'ip_key' not in columns:
+            # バージョン0: ip_key 列がなく、header_from の索引が大文字小文字を区別する
+            self.connection.create_function('ip_key', 1, ip_key, deterministic=True)
+            self.connection.execute('ALTER TABLE records ADD COLUMN ip_key BLOB')
+            self.connection.execute('UPDATE records SET ip_key = ip_key(source_ip)')
+            self.connection.execute('DROP INDEX IF EXISTS records_source_ip')
+            self.connection.execute('DROP INDEX IF EXISTS records_header_from')
+        for statement in sql_statements(STORE_SCHEMA):
+            self.connection.execute(statement)
+        if version < 2:
+            # バージョン1以前: 期間別の集計がないため既存のレコードから作る
+            for statement in sql_statements(ROLLUP_SCHEMA):
+                self.connection.execute(statement)
+            self.update_rollups()
+        self.connection.execute(f'PRAGMA user_version = {STORE_VERSION}')
+    
+    def has(self, digest: Optional[str], identity: Optional[tuple] = None) -> bool:
+        """同じ内容、または同じ送信元組織・レポートID・期間のレポートが保存済みか"""
+        return digest in self.digests or identity in self.identities
+    
+    def update_rollups(self, report_id: Optional[int] = None) -> None:
+        """レポート（省略時は全レポート）のレコードを期間別の集計に加算"""
+        where = 'reports.id = ?' if report_id is not None else '1'
+        params = (report_id,) if report_id is not None else ()
+        for period, bucket in ROLLUP_BUCKETS.items():
+            self.connection.execute(f'''
+                INSERT INTO rollups
+                SELECT '{period}', {bucket}, records.header_from, reports.org_name, COUNT(*),
+                       SUM(records.count),
+                       SUM(CASE WHEN records.spf_result != 'pass' THEN records.count ELSE 0 END),
+                       SUM(CASE WHEN records.dkim_result != 'pass' THEN records.count ELSE 0 END),
+                       SUM(CASE WHEN records.dmarc_result != 'pass' THEN records.count ELSE 0 END)
+                FROM records JOIN reports ON reports.id = records.report
+                WHERE {where} AND reports.date_begin IS NOT NULL
+                GROUP BY 1, 2, 3, 4
+                ON CONFLICT (period, bucket, header_from, org_name) DO UPDATE SET
+                    rows = rows + excluded.rows,
+                    messages = messages + excluded.messages,
+                    spf_fails = spf_fails + excluded.spf_fails,
+                    dkim_fails = dkim_fails + excluded.dkim_fails,
+                    dmarc_fails = dmarc_fails + excluded.dmarc_fails
+            ''', params)
+    
+    def rollups(self, period: str, group_by: Optional[str] = None,
+                header_from: Optional[str] = None, since: Optional[int] = None,
+                until: Optional[int] = None) -> List[tuple]:
+        """期間別の集計を (期間の開始時刻, グループ, rows, messages, spf_fails, dkim_fails, dmarc_fails) で返す"""
+        clauses = ['period = ?']
+        params = [period]
+        if header_from is not None:
+            clauses.append('header_from = ? COLLATE NOCASE')
+            params.append(header_from)
+        if since is not None:
+            clauses.append('bucket >= ?')
+            params.append(since - since % 86400 if period == 'day' else since - (since + 3 * 86400) % (7 * 86400))
+        if until is not None:
+            clauses.append('bucket < ?')
+            params.append(until)
+        group = group_by or "''"
+        return self.connection.execute(f'''
+            SELECT bucket, {group}, SUM(rows), SUM(messages), SUM(spf_fails), SUM(dkim_fails), SUM(dmarc_fails)
+            FROM rollups WHERE {' AND '.join(clauses)}
+            GROUP BY bucket, {group} ORDER BY bucket, SUM(messages) DESC
+        ''', params).fetchall()
+    
+    @staticmethod
+    def timestamp(value: str) -> Optional[int]:
+        """date_range の UNIX 時刻（数値でなければ None）"""
+        value = value.strip()
+        return int(value) if value.isdigit() else None
+    
+    def add(self, source: ReportSource, report: ProcessedReport) -> None:
+        """1レポート分のレコードを追加（commit() までは確定しない）"""
+        identity = report_identity(report.report_metadata)
+        if report.digest is None or self.has(report.digest, identity):
+            return
+        metadata = report.report_metadata
+        cursor = self.connection.execute(
+            'INSERT INTO reports (digest, org_name, report_id, date_begin, date_end, source, evaluation_version)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (report.digest, metadata.get('org_name', ''), metadata.get('report_id', ''),
+             self.timestamp(metadata.get('begin', '')), self.timestamp(metadata.get('end', '')),
+             ReportCache.source_key(source), EVALUATION_VERSION))
+        report_id = cursor.lastrowid
+        columns = ', '.join(RECORD_COLUMNS)
+        self.connection.executemany(
+            f'INSERT INTO records (report, {columns}, ip_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(report_id,) + record.as_tuple() + (ip_key(record.source_ip),) for record in report.records])
+        self.update_rollups(report_id)
+        self.digests.add(report.digest)
+        if identity is not None:
+            self.identities.add(identity)
+    
+    def commit(self) -> None:
+        self.connection.commit()
+    
+    def report_count(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM reports').fetchone()[0]
+    
+    def iter_records(self, query: Optional[RecordQuery] = None) -> Iterator['EvaluatedRecord']:
+        """条件に合う保存済みのレコードを保存順に返す"""
+        columns = ', '.join(f'records.{name}' for name in RECORD_COLUMNS)
+        where, params = (query or RecordQuery()).where()
+        sql = (f'SELECT {columns} FROM records JOIN reports ON reports.id = records.report'
+               f' WHERE {where} ORDER BY records.rowid')
+        for row in self.connection.execute(sql, params):
+            yield EvaluatedRecord(*row)
+    
+    def close(self) -> None:
+        self.connection.close()
+
+def write_json_atomic(path: str, data: Any) -> None:
+    """JSONを一時ファイル経由で書き込み、途中で中断しても壊れないようにする"""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def shard_index(key: str, count: int) -> int:
+    """key を count 個のシャードに振り分けた番号（0始まり。ホストやプロセスが違っても同じ値になる）"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big') % count
+
+def parse_shard(text: str) -> tuple:
+    """--shard の "K/N" を (K, N) に変換（1 <= K <= N でなければ ValueError）"""
+    index, _, count = text.partition('/')
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        raise ValueError(text)
+    return index, count
+
+def write_partial(path: str, partial: Dict[str, Any]) -> None:
+    """部分集計を gzip 圧縮した JSON として書き出す（途中で失敗しても既存のファイルを壊さない）"""
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+        json.dump(partial, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def load_partial(path: str) -> Dict[str, Any]:
+    """部分集計ファイルを読み込む（形式やバージョンが異なれば ValueError）"""
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            partial = json.load(f)
+    except (OSError, EOFError, ValueError) as e:
+        raise ValueError(f"部分集計ファイルを読み込めません {path}: {e}") from e
+    if not isinstance(partial, dict) or partial.get('format') != PARTIAL_FORMAT:
+        raise ValueError(f"部分集計ファイルではありません: {path}")
+    if partial.get('version') != PARTIAL_VERSION or partial.get('evaluation_version') != EVALUATION_VERSION:
+        raise ValueError(f"バージョンの異なる部分集計ファイルです（同じバージョンの map で作り直してください）: {path}")
+    return partial
+
+def default_dns_server() -> str:
+    """/etc/resolv.conf の最初の nameserver（なければ 127.0.0.1）"""
+    try:
+        with open('/etc/resolv.conf', 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    return fields[1]
+    except OSError:
+        pass
+    return '127.0.0.1'
+
+def parse_dns_server(text: str) -> tuple:
+    """HOST, HOST:PORT, [IPv6]:PORT 形式を (ホスト, ポート) に変換"""
+    if text.startswith('['):
+        host, _, port = text[1:].partition(']')
+        port = port.lstrip(':')
+    elif text.count(':') == 1:
+        host, _, port = text.partition(':')
+    else:
+        host, port = text, ''
+    return host, int(port) if port else 53
+
+def build_ptr_query(query_id: int, address: str) -> bytes:
+    """IPアドレスの逆引き (PTR) 問い合わせのDNSメッセージ（再帰要求あり）"""
+    name = ipaddress.ip_address(address).reverse_pointer
+    question = b''.join(bytes([len(label)]) + label.encode('ascii') for label in name.split('.'))
+    return struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + question + b'\0' + struct.pack('!HH', 12, 1)
+
+def read_dns_name(data: bytes, offset: int) -> tuple:
+    """圧縮ポインタを辿ってドメイン名を読み、(名前, 次の位置) を返す"""
+    labels = []
+    end = None
+    for _ in range(128):  # ポインタのループ対策
+        length = data[offset]
+        if length & 0xc0 == 0xc0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3f) << 8) | data[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            return '.'.join(labels), end if end is not None else offset
+        labels.append(data[offset:offset + length].decode('ascii', 'replace'))
+        offset += length
+    raise ValueError('DNS名の圧縮ポインタが多すぎます')
+
+def parse_ptr_response(data: bytes) -> tuple:
+    """DNS応答から (RCODE, PTRの名前一覧, 最小TTL) を取り出す"""
+    _, flags, questions, answers = struct.unpack('!HHHH', data[:8])
+    offset = 12
+    for _ in range(questions):
+        offset = read_dns_name(data, offset)[1] + 4
+    names = []
+    ttl = None
+    for _ in range(answers):
+        offset = read_dns_name(data, offset)[1]
+        rtype, _, record_ttl, length = struct.unpack('!HHIH', data[offset:offset + 10])
+        offset += 10
+        if rtype == 12:
+            names.append(read_dns_name(data, offset)[0])
+            ttl = record_ttl if ttl is None else min(ttl, record_ttl)
+        offset += length
+    return flags & 0x0f, names, ttl
+
+class DNSClientProtocol:
+    """1つのUDPソケットで複数の問い合わせを並行して送り、応答を問い合わせIDで振り分ける
+    （asyncio のデータグラムプロトコル。asyncio は逆引きする場合のみ読み込む）"""
+    
+    def __init__(self):
+        self.transport = None
+        self.pending = {}  # 問い合わせID → 応答を待つ Future
+    
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+    
+    def datagram_received(self, data: bytes, addr) -> None:
+        if len(data) < 12:
+            return
+        future = self.pending.pop(int.from_bytes(data[:2], 'big'), None)
+        if future is not None and not future.done():
+            future.set_result(data)
+    
+    def error_received(self, exc) -> None:
+        pass  # 応答のない問い合わせはタイムアウトとして扱う
+    
+    def connection_lost(self, exc) -> None:
+        pass
+    
+    async def query(self, message_for, timeout: float) -> bytes:
+        """未使用の問い合わせIDでメッセージを送り、応答を待つ"""
+        import asyncio
+        
+        query_id = int.from_bytes(os.urandom(2), 'big')
+        while query_id in self.pending:
+            query_id = int.from_bytes(os.urandom(2), 'big')
+        future = asyncio.get_running_loop().create_future()
+        self.pending[query_id] = future
+        try:
+            self.transport.sendto(message_for(query_id))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(query_id, None)
+
+class ReverseDNSResolver:
+    """送信元IPアドレスの逆引き (PTR)
+    
+    未解決のアドレスを asyncio でまとめて問い合わせ（同時問い合わせ数とタイムアウトを制限）、
+    応答の TTL までディスクにキャッシュする。名前がないアドレス（NXDOMAIN など）も
+    RDNS_NEGATIVE_TTL 秒キャッシュし、タイムアウトやサーバーエラーはキャッシュしない。
+    cache_path が None の場合は保存しない。
+    """
+    
+    def __init__(self, server: Optional[str] = None, timeout: float = 2.0, concurrency: int = 50,
+                 cache_path: Optional[str] = None):
+        self.server = parse_dns_server(server or default_dns_server())
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.cache_path = cache_path
+        self.entries = self.load()  # アドレス → [名前, 有効期限の UNIX 時刻]
+    
+    def load(self) -> Dict[str, list]:
+        if self.cache_path:
+            try:
+                with open(self.cache_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == RDNS_CACHE_VERSION:
+                    return data['entries']
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"⚠️  逆引きキャッシュを読み込めないため作り直します: {e}")
+        return {}
+    
+    def save(self) -> None:
+        if not self.cache_path:
+            return
+        now = time.time()
+        entries = {address: entry for address, entry in self.entries.items() if entry[1] > now}
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            write_json_atomic(self.cache_path, {'version': RDNS_CACHE_VERSION, 'entries': entries})
+        except OSError as e:
+            print(f"⚠️  キャッシュ書き込みエラー: {e}")
+    
+    def resolve(self, addresses: Iterable[str]) -> Dict[str, str]:
+        """アドレス → ホスト名（名前がなければ空文字列）。IPアドレスでない値と、解決できなかったアドレスは含まない"""
+        now = time.time()
+        names = {}
+        missing = []
+        for address in dict.fromkeys(addresses):
+            if ip_key(address) is None:
+                continue
+            entry = self.entries.get(address)
+            if entry is not None and entry[1] > now:
+                names[address] = entry[0]
+            else:
+                missing.append(address)
+        if not missing:
+            return names
+        
+        import asyncio
+        
+        started = time.perf_counter()
+        answers = asyncio.run(self.lookup_all(missing))
+        now = time.time()
+        failed = 0
+        for address, answer in zip(missing, answers):
+            if answer is None:
+                failed += 1
+                continue
+            name, ttl = answer
+            self.entries[address] = [name, now + ttl]
+            names[address] = name
+        print(f"🌐 逆引き: {len(missing)}件を問い合わせ (キャッシュ済み {len(names) - len(missing) + failed}件, "
+              f"失敗 {failed}件, {time.perf_counter() - started:.1f}秒)")
+        self.save()
+        return names
+    
+    async def lookup_all(self, addresses: List[str]) -> List[Optional[tuple]]:
+        """全アドレスを同時問い合わせ数の上限内で並行して逆引きする"""
+        import asyncio
+        
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(DNSClientProtocol, remote_addr=self.server)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def bounded(address: str) -> Optional[tuple]:
+            async with semaphore:
+                return await self.lookup(protocol, address)
+        
+        try:
+            return await asyncio.gather(*(bounded(address) for address in addresses))
+        finally:
+            transport.close()
+    
+    async def lookup(self, protocol: DNSClientProtocol, address: str) -> Optional[tuple]:
+        """1件を逆引きして (名前, TTL) を返す（タイムアウト・サーバーエラーは None）"""
+        import asyncio
+        
+        try:
+            data = await protocol.query(lambda query_id: build_ptr_query(query_id, address), self.timeout)
+            rcode, names, ttl = parse_ptr_response(data)
+        except (asyncio.TimeoutError, OSError):
+            return None
+        except (IndexError, ValueError, struct.error):
+            return None  # 壊れた応答
+        if rcode == 0 and names:
+            return names[0].rstrip('.'), ttl
+        if rcode in (0, 3):  # 名前なし / NXDOMAIN
+            return '', RDNS_NEGATIVE_TTL
+        return None
+
+class DirectoryWatcher:
+    """ディレクトリに追加・更新されたレポートファイルを検出
+    
+    watchdog がインストールされていればファイルシステムの通知を使い、
+    なければ interval 秒ごとに mtime とサイズを比較する。書き込み中のファイルを
+    拾わないよう、変化が debounce 秒止まったファイルだけを返す。
+    """
+    
+    def __init__(self, directory: str, interval: float = 2.0, debounce: float = 1.0):
+        self.directory = directory
+        self.interval = interval
+        self.debounce = debounce
+        self.seen = {}     # 処理済みのパス → (サイズ, mtime)
+        self.pending = {}  # 書き込み完了待ちのパス → ((サイズ, mtime), 最後に変化を検出した時刻)
+        self.events = set()  # watchdog から通知されたパス
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.observer = None
+    
+    @staticmethod
+    def is_report_file(name: str) -> bool:
+        """collect_sources() の glob と同じく、隠しファイル以外の XML/ZIP/GZ"""
+        return not name.startswith('.') and name.endswith(REPORT_EXTENSIONS)
+    
+    @staticmethod
+    def signature(path: str) -> Optional[tuple]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+    
+    def start(self) -> str:
+        """監視を開始し、使用する方式の名前を返す"""
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            return 'mtime ポーリング'
+        
+        watcher = self
+        
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if not event.is_directory:
+                    watcher.notify(event.src_path)
+                    watcher.notify(getattr(event, 'dest_path', ''))
+        
+        self.observer = Observer()
+        self.observer.schedule(Handler(), self.directory, recursive=False)
+        self.observer.start()
+        return 'watchdog'
+    
+    def stop(self) -> None:
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+    
+    def notify(self, path: str) -> None:
+        """watchdog のスレッドから呼ばれる"""
+        name = os.path.basename(path)
+        if not path or os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.directory):
+            return
+        if self.is_report_file(name):
+            with self.lock:
+                # collect_sources() / scan() と同じ形式のパスにそろえる（キャッシュのキーになる）
+                self.events.add(os.path.join(self.directory, name))
+            self.wakeup.set()
+    
+    def mark_seen(self, paths: Iterable[str]) -> None:
+        """処理済みとして登録（変更がない限り再度返さない）"""
+        for path in paths:
+            self.seen[path] = self.signature(path)
+    
+    def scan(self) -> List[str]:
+        """ディレクトリ内のレポートファイルを列挙"""
+        try:
+            with os.scandir(self.directory) as entries:
+                return [entry.path for entry in entries
+                        if self.is_report_file(entry.name) and entry.is_file()]
+        except OSError:
+            return []
+    
+    def check(self, paths: Iterable[str], now: float) -> None:
+        """変化のあったパスを書き込み完了待ちに加え、待機中のパスの変化を更新"""
+        for path in set(paths).union(self.pending):
+            signature = self.signature(path)
+            if signature is None:
+                self.pending.pop(path, None)
+                self.seen.pop(path, None)
+            elif path in self.pending:
+                if self.pending[path][0] != signature:
+                    self.pending[path] = (signature, now)
+            elif self.seen.get(path) != signature:
+                self.pending[path] = (signature, now)
+    
+    def wait(self, limit: int) -> List[str]:
+        """書き込みが完了したファイルを最大 limit 件、検出順に返す（残りは次回に持ち越す）"""
+        while True:
+            now = time.monotonic()
+            if self.observer is not None:
+                with self.lock:
+                    events, self.events = self.events, set()
+                self.check(events, now)
+            else:
+                self.check(self.scan(), now)
+            
+            ready = sorted((changed_at, path) for path, (_, changed_at) in self.pending.items()
+                           if now - changed_at >= self.debounce)
+            if ready:
+                paths = [path for _, path in ready[:limit]]
+                for path in paths:
+                    self.seen[path] = self.pending.pop(path)[0]
+                return paths
+            
+            # 書き込み完了待ちがあれば debounce 間隔で確認する
+            timeout = min(self.interval, self.debounce) if self.pending else self.interval
+            if self.observer is not None:
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+            else:
+                time.sleep(timeout)
+    
+    def backlog(self) -> int:
+        """処理待ちのファイル数"""
+        return len(self.pending)
+
+def metric_result(kind: str, result: str) -> str:
+    """メトリクスのラベルに使う結果（METRIC_RESULTS 以外は other）"""
+    result = result.lower() or 'none'
+    return result if result in METRIC_RESULTS[kind] else 'other'
+
+def escape_label_value(value: str) -> str:
+    """Prometheus のテキスト形式のラベル値をエスケープ"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class ReportMetrics:
+    """Prometheus 形式で公開するメッセージ数（count で重み付け）のカウンター
+    
+    レポートを取り込むたびにそのレポートの分だけ加算し、スクレイプ時は保持している値を
+    書き出すだけにする。Header From と送信元組織のラベルの値は最初に現れた max_labels 個までとし、
+    それ以降の値は METRIC_OTHER_LABEL にまとめる（件数の順位で選ぶと、既存の系列の値が減ったり
+    別の系列に移ったりしてカウンターとして扱えなくなるため）。
+    """
+    
+    def __init__(self, max_labels: int = 100):
+        self.max_labels = max_labels
+        self.lock = threading.Lock()  # 取り込みと書き出しを排他
+        self.label_values = {'header_from': {}, 'org': {}}  # ラベル名 -> 値の集合（出現順）
+        self.reports = 0
+        self.records = 0
+        self.messages = {}      # (Header From, DMARC結果) -> メッセージ数
+        self.spf = {}           # (Header From, SPF結果)
+        self.dkim = {}          # (Header From, DKIM結果)
+        self.dispositions = {}  # (Header From, 処置)
+        self.reporters = {}     # (送信元組織, DMARC結果)
+        self.last_ingest = None
+        self.latest_report_end = None
+    
+    def label(self, name: str, value: str) -> str:
+        """上限までは値をそのまま、超えた後の新しい値は METRIC_OTHER_LABEL を返す"""
+        values = self.label_values[name]
+        if value in values:
+            return value
+        if len(values) < self.max_labels:
+            values[value] = None
+            return value
+        return METRIC_OTHER_LABEL
+    
+    @staticmethod
+    def increment(counters: Dict[tuple, int], key: tuple, value: int) -> None:
+        counters[key] = counters.get(key, 0) + value
+    
+    def add_report(self, records: List['EvaluatedRecord'], metadata: Dict[str, Any]) -> None:
+        """1レポート分の評価済みレコードと、メタデータ（送信元組織・期間・処置の内訳・統合前のレコード数）を加える
+        
+        records はファイル内で統合済みのため、レコード数はメタデータの値を使う（ない場合は統合後の行数）。
+        """
+        with self.lock:
+            org = self.label('org', metadata.get('org_name') or 'unknown')
+            for record in records:
+                header_from = self.label('header_from', record.header_from)
+                dmarc = 'pass' if record.dmarc_result == 'pass' else 'fail'
+                self.increment(self.messages, (header_from, dmarc), record.count)
+                self.increment(self.spf, (header_from, metric_result('spf', record.spf_result)), record.count)
+                self.increment(self.dkim, (header_from, metric_result('dkim', record.dkim_result)), record.count)
+                self.increment(self.reporters, (org, dmarc), record.count)
+            for header_from, disposition, messages in metadata.get('dispositions', ()):
+                key = (self.label('header_from', header_from), metric_result('disposition', disposition))
+                self.increment(self.dispositions, key, messages)
+            self.reports += 1
+            self.records += metadata.get('records', len(records))
+            self.last_ingest = time.time()
+            end = ReportStore.timestamp(metadata.get('end', ''))
+            if end is not None and (self.latest_report_end is None or end > self.latest_report_end):
+                self.latest_report_end = end
+    
+    def render(self) -> str:
+        """Prometheus のテキスト形式で書き出す"""
+        lines = []
+        
+        def family(name: str, kind: str, help_text: str, samples: Iterable[tuple]) -> None:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{escape_label_value(str(label))}"' for key, label in labels)
+                lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+        
+        def labelled(counters: Dict[tuple, int], names: tuple) -> Iterator[tuple]:
+            for key, value in sorted(counters.items()):
+                yield tuple(zip(names, key)), value
+        
+        with self.lock:
+            family('dmarc_reports_ingested_total', 'counter', 'Number of aggregate reports ingested.',
+                   [((), self.reports)])
+            family('dmarc_records_ingested_total', 'counter',
+                   'Number of report records ingested (before consolidating rows with the same content).',
+                   [((), self.records)])
+            family('dmarc_messages_total', 'counter', 'Messages reported, by header_from and DMARC result.',
+                   labelled(self.messages, ('header_from', 'dmarc')))
+            family('dmarc_spf_messages_total', 'counter', 'Messages reported, by header_from and SPF result.',
+                   labelled(self.spf, ('header_from', 'result')))
+            family('dmarc_dkim_messages_total', 'counter', 'Messages reported, by header_from and DKIM result.',
+                   labelled(self.dkim, ('header_from', 'result')))
+            family('dmarc_disposition_messages_total', 'counter',
+                   'Messages reported, by header_from and disposition applied by the receiver.',
+                   labelled(self.dispositions, ('header_from', 'disposition')))
+            family('dmarc_reporter_messages_total', 'counter',
+                   'Messages reported, by reporting organization and DMARC result.',
+                   labelled(self.reporters, ('org', 'dmarc')))
+            
+            totals = {}
+            for (header_from, dmarc), value in self.messages.items():
+                counts = totals.setdefault(header_from, [0, 0])
+                counts[0] += value
+                counts[1] += value if dmarc == 'fail' else 0
+            family('dmarc_fail_ratio', 'gauge',
+                   'Cumulative share of messages failing DMARC over all reports ingested since the server '
+                   'started, by header_from. For a ratio over a time window, divide increase() of '
+                   'dmarc_messages_total{dmarc="fail"} by increase() of dmarc_messages_total.',
+                   [((('header_from', header_from),), round(fails / total, 6) if total else 0)
+                    for header_from, (total, fails) in sorted(totals.items())])
+            family('dmarc_label_values', 'gauge',
+                   f'Distinct values tracked per label (at most {self.max_labels}, then "{METRIC_OTHER_LABEL}").',
+                   [((('label', name),), len(values)) for name, values in self.label_values.items()])
+            if self.last_ingest is not None:
+                family('dmarc_last_ingest_timestamp_seconds', 'gauge', 'Time the last report was ingested.',
+                       [((), round(self.last_ingest, 3))])
+            if self.latest_report_end is not None:
+                family('dmarc_latest_report_end_timestamp_seconds', 'gauge',
+                       'Latest end of the date range covered by an ingested report.',
+                       [((), self.latest_report_end)])
+        return '\n'.join(lines) + '\n'
+
+class LiveAggregate:
+    """serve モードで保持する、ファイル間で統合済みのレコードと統計
+    
+    新しいファイルのレコードを加えた分だけ更新する。統合の順序とエラーレコードの並びは
+    build_result() と同じ（出現順）。
+    """
+    
+    def __init__(self):
+        self.consolidated = {}  # 統合キー -> レコード
+        self.errors = []        # エラーのあるレコード（consolidated の値と同じオブジェクト）
+        self.statistics = StatisticsAggregator()
+        self.sources = 0
+    
+    def add(self, records: List['EvaluatedRecord']) -> None:
+        """1ファイル分のレコードを加える"""
+        self.statistics.update(records)
+        for record in records:
+            key = consolidation_key(record)
+            existing = self.consolidated.get(key)
+            if existing is not None:
+                existing.count += record.count
+                continue
+            record = self.consolidated[key] = record.copy()
+            if is_error_record(record):
+                self.errors.append(record)
+        self.sources += 1
+
+class AnalysisAPI:
+    """serve モードの JSON API
+    
+    集計（LiveAggregate）は新しいレポートが届いた時だけ更新して世代を進める。各エンドポイントの
+    レスポンスは版ごとに1回だけ作り、ETag とともに使い回す（gzip 版は要求された時に1回だけ作る）。
+    そのため同じ版への繰り返しのリクエストは辞書の参照だけで返せる。版は通常は世代だが、状態と
+    メトリクスは集計の途中（初回の集計中や大きな更新中）も進むよう、取り込んだ件数で決める。
+    """
+    
+    def __init__(self, analyzer: 'DMARCAnalyzer'):
+        self.analyzer = analyzer
+        self.aggregate = LiveAggregate()
+        self.lock = threading.RLock()  # 集計の更新とレスポンスの作成を排他
+        self.generation = 0  # 初回の集計が終わるまでは 0（データのエンドポイントは 503 を返す）
+        self.updated_at = None
+        self.responses = {}  # (パス, gzip) -> (版, 本文, ETag)
+        self.builders = {
+            '/api/status': self.status,
+            '/api/errors': lambda: {'records': [record_dict(record) for record in self.aggregate.errors]},
+            '/api/records': lambda: {'records': [record_dict(record)
+                                                 for record in self.aggregate.consolidated.values()]},
+            '/api/header-domains': self.header_domains,
+            '/api/domain-groups': self.domain_groups,
+            '/api/statistics': lambda: self.aggregate.statistics.as_dict(),
+            '/metrics': lambda: analyzer.metrics.render(),
+        }
+        # 世代以外で版を決めるエンドポイント（取り込むたびに進むカウンター）
+        self.versions = {
+            '/api/status': lambda: (self.generation, self.aggregate.sources),
+            '/metrics': lambda: (analyzer.metrics.reports, analyzer.metrics.records),
+        }
     
-    try:
-        import pandas as pd
-    except ImportError:
-        missing_libs.append('pandas')
+    def update(self, batches: Iterable[List['EvaluatedRecord']]) -> int:
+        """ファイルごとのレコードを集計に加えて世代を進め、加えたレコード数を返す"""
+        added = 0
+        for records in batches:
+            with self.lock:
+                self.aggregate.add(records)
+            added += len(records)
+        with self.lock:
+            self.generation += 1
+            self.updated_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        return added
     
-    try:
-        from tabulate import tabulate
-    except ImportError:
-        missing_libs.append('tabulate')
+    def status(self) -> Dict[str, Any]:
+        statistics = self.aggregate.statistics
+        return {
+            'ready': self.generation > 0,
+            'generation': self.generation,
+            'updated_at': self.updated_at,
+            'directory': self.analyzer.dmarc_dir,
+            'sources': self.aggregate.sources,
+            'records': statistics.total_records,
+            'error_records': len(self.aggregate.errors),
+            'messages': statistics.messages,
+        }
     
-    try:
-        from colorama import Fore, Style, init
-    except ImportError:
-        missing_libs.append('colorama')
+    def header_domains(self) -> Dict[str, Any]:
+        return {'domains': [{'domain': domain, **stats}
+                            for domain, stats in self.aggregate.statistics.header_domains.items()]}
     
-    if missing_libs:
-        print("❌ 必要なライブラリがインストールされていません:")
-        print(f"不足ライブラリ: {', '.join(missing_libs)}")
-        print("\n以下のコマンドでインストールしてください:")
-        print(f"pip install {' '.join(missing_libs)}")
-        print("\nまたは:")
-        print(f"pip3 install {' '.join(missing_libs)}")
-        sys.exit(1)
+    def domain_groups(self) -> Dict[str, Any]:
+        """詳細分析のドメイン一覧と同じ順序（件数の多い順。--top-domains 指定時は上位のみ）"""
+        analyzer = self.analyzer
+        groups = analyzer.group_similar_domains(self.aggregate.statistics.external_domains)
+        order = lambda group: (group.volume, -group.first_seen)
+        if analyzer.top_domains and len(groups) > analyzer.top_domains:
+            shown = heapq.nlargest(analyzer.top_domains, groups, key=order)
+        else:
+            shown = sorted(groups, key=order, reverse=True)
+        return {
+            'groups': [{'name': group.name, 'volume': group.volume, 'stats': group.stats} for group in shown],
+            'omitted': {'groups': len(groups) - len(shown),
+                        'volume': sum(group.volume for group in groups) - sum(group.volume for group in shown)},
+        }
     
-    return True
-
-# 依存関係チェック実行
-check_dependencies()
-
-# 依存関係チェック後にインポート
-import pandas as pd
-from tabulate import tabulate
-from colorama import Fore, Style, init
+    def version(self, path: str) -> Any:
+        """path のレスポンスの版（これが変わるまでは作り直さない）"""
+        versions = self.versions.get(path)
+        return versions() if versions is not None else self.generation
+    
+    def response(self, path: str, use_gzip: bool = False) -> Optional[tuple]:
+        """(版, 本文, ETag) を返す（不明なパスは None）"""
+        if path not in self.builders:
+            return None
+        key = (path, use_gzip)
+        cached = self.responses.get(key)
+        if cached is not None and cached[0] == self.version(path):
+            return cached
+        with self.lock:
+            # 同じ版のレスポンスを他のリクエストが作り終えていればそれを使う
+            cached = self.responses.get(key)
+            if cached is None or cached[0] != self.version(path):
+                cached = self.responses[key] = self.render(path, use_gzip)
+        return cached
+    
+    def render(self, path: str, use_gzip: bool) -> tuple:
+        """現在の版のレスポンスを作る（lock を保持した状態で呼び出す）"""
+        if use_gzip:
+            version, body, etag = self.response(path)
+            return version, gzip.compress(body, compresslevel=6), f'{etag[:-1]}-gzip"'
+        # 版は作り始める前に読む（作成中に進んだ場合は次のリクエストで作り直す）
+        version = self.version(path)
+        data = self.builders[path]()
+        if isinstance(data, str):
+            body = data.encode()
+        else:
+            body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+        return version, body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
 
-# colorama初期化
-init(autoreset=True)
+def make_api_handler(api: AnalysisAPI):
+    """AnalysisAPI のレスポンスを返す HTTP リクエストハンドラーのクラスを作る"""
+    from http.server import BaseHTTPRequestHandler
+    
+    class Handler(BaseHTTPRequestHandler):
+        # keep-alive で接続を使い回せるようにする
+        protocol_version = 'HTTP/1.1'
+        
+        def do_GET(self):
+            self.respond(send_body=True)
+        
+        def do_HEAD(self):
+            self.respond(send_body=False)
+        
+        def respond(self, send_body: bool) -> None:
+            path = self.path.split('?', 1)[0].rstrip('/') or '/'
+            if path == '/':
+                self.send_json(200, {'endpoints': list(API_ENDPOINTS)}, send_body)
+                return
+            # 状態とメトリクス（取り込んだ分のカウンター）は初回の集計中も返す
+            if path not in ('/api/status', '/metrics') and path in api.builders and not api.generation:
+                self.send_json(503, {'error': 'loading'}, send_body, {'Retry-After': '1'})
+                return
+            use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+            response = api.response(path, use_gzip)
+            if response is None:
+                self.send_json(404, {'error': 'not found', 'endpoints': list(API_ENDPOINTS)}, send_body)
+                return
+            _, body, etag = response
+            headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+            if_none_match = self.headers.get('If-None-Match')
+            if if_none_match and (if_none_match.strip() == '*' or
+                                  etag in (tag.strip() for tag in if_none_match.split(','))):
+                self.send(304, b'', headers, send_body=False)
+                return
+            if use_gzip:
+                headers['Content-Encoding'] = 'gzip'
+            if path == '/metrics':
+                headers['Content-Type'] = METRICS_CONTENT_TYPE
+            self.send(200, body, headers, send_body)
+        
+        def send_json(self, status: int, data: Dict[str, Any], send_body: bool,
+                      headers: Optional[Dict[str, str]] = None) -> None:
+            self.send(status, json.dumps(data).encode(), headers or {}, send_body)
+        
+        def send(self, status: int, body: bytes, headers: Dict[str, str], send_body: bool) -> None:
+            self.send_response(status)
+            if status != 304 and 'Content-Type' not in headers:
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)) if status != 304 else '0')
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            # アクセスログは出さない（集計の更新だけを表示する）
+            pass
+    
+    return Handler
 
 class DMARCAnalyzer:
     """DMARC レポート分析クラス"""
     
-    def __init__(self, dmarc_dir: str = None):
+    def __init__(self, dmarc_dir: str = None, delete_archives: bool = False, jobs: int = 1,
+                 cache_dir: Optional[str] = None, mailboxes: Optional[List[str]] = None,
+                 store_path: Optional[str] = None, networks: Optional[NetworkGrouping] = None,
+                 resolver: Optional[ReverseDNSResolver] = None, writer: Optional[RecordWriter] = None,
+                 group_min_domains: int = 3, group_tail_volume: int = 0, top_domains: int = 0,
+                 profiler: Optional[Profiler] = None):
         self.dmarc_dir = dmarc_dir or os.path.expanduser("~/Downloads/DMARC")
-        self.temp_files = []  # 解凍したファイルを追跡
+        self.mailboxes = mailboxes or []  # Maildir ディレクトリ / mbox ファイル
+        # メールボックスだけを指定した場合はディレクトリを走査しない
+        self.scan_directory = dmarc_dir is not None or not self.mailboxes
+        self.mailbox_index = MailboxIndex(os.path.join(cache_dir, 'mailboxes.json') if cache_dir else None)
+        self.delete_archives = delete_archives  # 処理後にZIP/GZを削除するか
+        self.jobs = jobs or os.cpu_count() or 1  # 0 の場合はCPUコア数
+        self.cache = ReportCache(cache_dir) if cache_dir else None  # 評価済みレコードのキャッシュ
+        self.evaluation_cache = EvaluationCache(EVALUATION_CACHE_SIZE)  # 認証情報の組み合わせごとの評価結果
+        self.store = ReportStore(store_path) if store_path else None  # 評価済みレコードの SQLite ストア
+        self.networks = networks  # 指定時は送信元IPアドレスをネットワーク単位にまとめて表示
+        self.resolver = resolver  # 指定時は表に送信元IPアドレスの逆引き結果を加える
+        self.writer = writer  # 指定時は表の代わりにレコードを JSON Lines / CSV で書き出す
+        self.group_min_domains = group_min_domains  # この行数以上のサブドメインを "*.サフィックス" にまとめる
+        self.group_tail_volume = group_tail_volume  # 件数の合計がこれ以下のサブドメインもまとめる
+        self.top_domains = top_domains  # ドメイン一覧に表示する行数（0 は全件）
+        self.profiler = profiler  # 指定時は段階ごとの処理時間などを計測する
+        self.metrics = None  # serve で Prometheus 形式のメトリクスを公開する場合の ReportMetrics
+        self.failed_sources = set()  # 解析に失敗したアーカイブのパス
+        self.seen_digests = {}  # 処理対象にしたレポートの内容ハッシュ -> 読み込み元
+        self.seen_reports = {}  # 処理対象にしたレポートの report_identity() -> 読み込み元
+        self.executor = None  # 監視モードで使い回すプロセスプール
         
-    def extract_files(self) -> List[str]:
-        """ZIP/GZ ファイルを解凍してXMLファイルのパスを返す"""
-        xml_files = []
+    def collect_sources(self) -> List[ReportSource]:
+        """XML/ZIP/GZ ファイルを検出して読み込み元の一覧を返す"""
+        sources = []
         
         if not os.path.exists(self.dmarc_dir):
             print(f"❌ ディレクトリが見つかりません: {self.dmarc_dir}")
-            return xml_files
-        
+            return sources
         
         # 既存のXMLファイルを取得
         existing_xml = glob.glob(os.path.join(self.dmarc_dir, "*.xml"))
-        xml_files.extend(existing_xml)
+        sources.extend(ReportSource(path) for path in existing_xml)
         if existing_xml:
             print(f"📄 既存XMLファイル: {[os.path.basename(f) for f in existing_xml]}")
         
-        # ZIPファイルを解凍
+        # ZIPファイル内のXMLメンバーを列挙
         zip_files = glob.glob(os.path.join(self.dmarc_dir, "*.zip"))
         
         for zip_path in zip_files:
-            try:
-                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                    for member in zip_ref.namelist():
-                        if member.endswith('.xml'):
-                            extract_path = os.path.join(self.dmarc_dir, member)
-                            zip_ref.extract(member, self.dmarc_dir)
-                            xml_files.append(extract_path)
-                            self.temp_files.append(extract_path)
-                
-                # 解凍後にZIPファイルを削除
-                os.remove(zip_path)
-                
-            except Exception as e:
-                print(f"❌ ZIP解凍エラー {zip_path}: {e}")
+            sources.extend(self.sources_for_path(zip_path))
         
-        # GZファイルを解凍
+        # GZファイルはストリームで解凍する
         gz_files = glob.glob(os.path.join(self.dmarc_dir, "*.gz"))
+        sources.extend(ReportSource(gz_path) for gz_path in gz_files)
+        
+        print(f"📊 最終的に見つかったXMLファイル数: {len(sources)}")
+        if sources:
+            print(f"📄 XMLファイル一覧: {[source.name for source in sources]}")
+        
+        return sources
+    
+    def collect_mail_sources(self, path: str, seen_ids: set) -> List[MailSource]:
+        """Maildir / mbox のメッセージに添付されたレポートの一覧を返す
+        
+        seen_ids に含まれる Message-ID のメッセージ（重複配送）は除外し、取り込んだ分を追加する。
+        """
+        if not os.path.exists(path):
+            print(f"❌ メールボックスが見つかりません: {path}")
+            return []
+        
+        state = self.mailbox_index.mailbox(path)
+        try:
+            if os.path.isdir(path):
+                new_messages = self.scan_maildir(path, state)
+            else:
+                new_messages = self.scan_mbox(path, state)
+        except Exception as e:
+            print(f"❌ メールボックス読み込みエラー {path}: {e}")
+            return []
+        self.mailbox_index.save()
+        
+        sources = []
+        duplicates = 0
+        for message in state['messages'].values():
+            if not message['members']:
+                continue
+            if message['id'] in seen_ids:
+                duplicates += 1
+                continue
+            seen_ids.add(message['id'])
+            sources.extend(MailSource(path, member, message.get('span')) for member in message['members'])
         
-        for gz_path in gz_files:
+        if self.cache:
+            self.cache.retain_members(path, [member for message in state['messages'].values()
+                                             for member in message['members']])
+        print(f"📬 {path}: メッセージ {len(state['messages'])}件（新規 {new_messages}件）, "
+              f"レポート {len(sources)}件" + (f"（重複 {duplicates}件を除外）" if duplicates else ""))
+        return sources
+    
+    def scan_message(self, raw: bytes, key: Optional[str] = None) -> Dict[str, Any]:
+        """新しいメッセージを開き、レポート添付の一覧を作る"""
+        message = parse_message(raw)
+        message_id = message_identity(message, raw)
+        if key is None:
+            key = hashlib.blake2b(message_id.encode(), digest_size=8).hexdigest()
+        
+        members = []
+        parts = list(message.walk())
+        for index, name in report_attachments(message):
             try:
-                xml_path = gz_path.replace('.gz', '')
-                with gzip.open(gz_path, 'rb') as gz_file:
-                    with open(xml_path, 'wb') as xml_file:
-                        shutil.copyfileobj(gz_file, xml_file)
-                
-                xml_files.append(xml_path)
-                self.temp_files.append(xml_path)
-                
-                # 解凍後にGZファイルを削除
-                os.remove(gz_path)
-                
+                payload = parts[index].get_payload(decode=True) or b''
+                for member in attachment_members(payload, name):
+                    members.append(f"{key}/{index}/{name}" + (f"/{member}" if member else ''))
             except Exception as e:
-                print(f"❌ GZ解凍エラー {gz_path}: {e}")
+                print(f"❌ 添付ファイル読み込みエラー {name}: {e}")
+        return {'key': key, 'id': message_id, 'members': members}
+    
+    def scan_maildir(self, path: str, state: Dict[str, Any]) -> int:
+        """Maildir を走査し、新しいメッセージ数を返す"""
+        maildir = open_maildir(path)
+        # キーは配送時刻から始まるため、並べ替えると概ね配送順になる
+        keys = sorted(maildir.keys())
+        previous = state['messages']
+        messages = {}
+        new_messages = 0
+        for key in keys:
+            if key in previous:
+                messages[key] = previous[key]
+                continue
+            with maildir.get_file(key) as f:
+                scanned = self.scan_message(f.read(), key)
+            messages[key] = {'id': scanned['id'], 'members': scanned['members']}
+            new_messages += 1
+        state['messages'] = messages
+        return new_messages
+    
+    def scan_mbox(self, path: str, state: Dict[str, Any]) -> int:
+        """mbox を走査し、新しいメッセージ数を返す（追記分だけを読む）"""
+        from email.parser import BytesHeaderParser
         
-        print(f"📊 最終的に見つかったXMLファイル数: {len(xml_files)}")
-        if xml_files:
-            print(f"📄 XMLファイル一覧: {[os.path.basename(f) for f in xml_files]}")
+        new_messages = 0
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = state.get('size', 0)
+            f.seek(offset)
+            # 前回の続きが From_ 行で始まらなければ書き換えられたとみなして全体を読み直す
+            if offset > size or (offset < size and f.read(5) != b'From '):
+                offset = 0
+            previous = state['messages'] if offset else {}
+            by_id = {message['id']: (key, message) for key, message in state['messages'].items()}
+            messages = dict(previous)
+            # 走査済みのメッセージ（追記分だけを読む場合、前回までのメッセージの再配送も重複とする）
+            scanned_ids = {message['id'] for message in previous.values()}
+            
+            for span in list(iter_mbox_spans(f, offset)):
+                f.seek(span[0])
+                raw = f.read(span[1] - span[0]).partition(b'\n')[2]
+                message_id = message_identity(BytesHeaderParser().parsebytes(raw), raw)
+                if message_id in scanned_ids:
+                    # 同じメッセージが重複して配送されている場合は最初のものだけを使う
+                    continue
+                scanned_ids.add(message_id)
+                if message_id in by_id:
+                    # 読み直しの場合、既知のメッセージは位置だけ更新する
+                    key, message = by_id[message_id]
+                    messages[key] = dict(message, span=span)
+                    continue
+                scanned = self.scan_message(raw)
+                messages[scanned['key']] = {'id': scanned['id'], 'members': scanned['members'], 'span': span}
+                new_messages += 1
         
-        return xml_files
+        state['messages'] = messages
+        state['size'] = size
+        return new_messages
     
-    def parse_xml(self, xml_path: str) -> List[Dict[str, Any]]:
-        """XMLファイルをパースしてレコード情報を取得"""
-        records = []
+    def sources_for_path(self, path: str) -> List[ReportSource]:
+        """1ファイル分の読み込み元（ZIPの場合はXMLメンバーごと）"""
+        if not path.endswith('.zip'):
+            return [ReportSource(path)]
         
         try:
-            tree = ET.parse(xml_path)
-            root = tree.getroot()
-            
-            # policy_published情報を取得
-            policy_published = {}
-            policy_elem = root.find('policy_published')
-            if policy_elem is not None:
-                policy_published = {
-                    'domain': policy_elem.find('domain').text if policy_elem.find('domain') is not None else '',
-                    'adkim': policy_elem.find('adkim').text if policy_elem.find('adkim') is not None else 'r',
-                    'aspf': policy_elem.find('aspf').text if policy_elem.find('aspf') is not None else 'r',
-                    'p': policy_elem.find('p').text if policy_elem.find('p') is not None else '',
-                }
-            
-            # 各レコードを処理
-            for record in root.findall('record'):
-                record_data = self.parse_record(record, policy_published)
-                if record_data:
-                    records.append(record_data)
-                    
+            with zipfile.ZipFile(path, 'r') as zip_ref:
+                return [ReportSource(path, member) for member in zip_ref.namelist()
+                        if member.endswith('.xml')]
         except Exception as e:
-            print(f"❌ XML解析エラー {xml_path}: {e}")
-            
-        return records
+            print(f"❌ ZIP読み込みエラー {path}: {e}")
+            return []
     
-    def parse_record(self, record_elem, policy_published: Dict) -> Optional[Dict[str, Any]]:
-        """個別レコードをパース"""
+    def parse_xml(self, source: Union[str, ReportSource]) -> List['DMARCRecord']:
+        """XMLをパースしてレコード情報を取得"""
+        if isinstance(source, str):
+            source = ReportSource(source)
+        
         try:
-            # 基本情報
-            row = record_elem.find('row')
-            source_ip = row.find('source_ip').text if row.find('source_ip') is not None else ''
-            count = int(row.find('count').text) if row.find('count') is not None else 1
-            
-            # policy_evaluated情報
-            policy_evaluated = {}
-            policy_eval_elem = row.find('policy_evaluated')
-            if policy_eval_elem is not None:
-                policy_evaluated = {
-                    'disposition': policy_eval_elem.find('disposition').text if policy_eval_elem.find('disposition') is not None else '',
-                    'dkim': policy_eval_elem.find('dkim').text if policy_eval_elem.find('dkim') is not None else '',
-                    'spf': policy_eval_elem.find('spf').text if policy_eval_elem.find('spf') is not None else '',
-                }
-            
-            # identifiers
-            identifiers = record_elem.find('identifiers')
-            header_from = identifiers.find('header_from').text if identifiers.find('header_from') is not None else ''
-            envelope_from = identifiers.find('envelope_from').text if identifiers.find('envelope_from') is not None else ''
-            
-            # auth_results
-            auth_results = record_elem.find('auth_results')
-            
-            # SPF結果
-            spf_results = []
-            if auth_results is not None:
-                for spf in auth_results.findall('spf'):
-                    spf_domain = spf.find('domain').text if spf.find('domain') is not None else ''
-                    spf_result = spf.find('result').text if spf.find('result') is not None else ''
-                    spf_results.append({'domain': spf_domain, 'result': spf_result})
+            return list(self.iter_records(source))
+        except Exception as e:
+            print(f"❌ XML解析エラー {source.name}: {e}")
+            self.failed_sources.add(source.path)
+            return []
+    
+    def iter_records(self, source: ReportSource, report_metadata: Optional[Dict[str, str]] = None,
+                     digest=None, stats: Optional[Dict[str, Any]] = None) -> Iterator['DMARCRecord']:
+        """XMLを逐次パースしてレコードを1件ずつ返す（メモリ使用量は一定）
+        
+        各レコードはレポートのメタデータ（送信元組織・レポートID・期間）を共有する。
+        report_metadata を渡すとその辞書を更新し、
+        digest（hashlibオブジェクト）を渡すと解凍後のバイト列でハッシュを更新する
+        （stats も渡すと解凍後のバイト数を stats['bytes'] に加算する）。
+        """
+        policy_published = PolicyPublished()
+        if report_metadata is None:
+            report_metadata = {}
+        
+        with source.open() as stream:
+            if digest is not None:
+                stream = HashingReader(stream, digest, stats)
+            context = ET.iterparse(stream, events=('start', 'end'))
+            _, root = next(context)
             
-            # DKIM結果
-            dkim_results = []
-            if auth_results is not None:
-                for dkim in auth_results.findall('dkim'):
-                    dkim_domain = dkim.find('domain').text if dkim.find('domain') is not None else ''
-                    dkim_result = dkim.find('result').text if dkim.find('result') is not None else ''
-                    dkim_selector = dkim.find('selector').text if dkim.find('selector') is not None else ''
-                    dkim_results.append({
-                        'domain': dkim_domain, 
-                        'result': dkim_result, 
-                        'selector': dkim_selector
-                    })
+            for event, elem in context:
+                if event != 'end':
+                    continue
+                tag = local_name(elem.tag)
+                
+                if tag == 'report_metadata':
+                    # report_metadata は record より前に出現する
+                    report_metadata.update(parse_report_metadata(elem))
+                    root.clear()
+                elif tag == 'policy_published':
+                    # policy_published情報を取得（recordより前に出現する）
+                    # 同じレポートの全レコードで1つのオブジェクトを共有する
+                    policy_published = PolicyPublished(**child_texts(elem, ('domain', 'adkim', 'aspf', 'p')))
+                    root.clear()
+                elif tag == 'record':
+                    record = self.parse_record(elem, policy_published, report_metadata)
+                    # 処理済みの要素を解放して木が成長しないようにする
+                    root.clear()
+                    if record is not None:
+                        yield record
+    
+    def parse_record(self, record_elem, policy_published: 'PolicyPublished',
+                     report_metadata: Optional[Dict[str, str]] = None) -> Optional['DMARCRecord']:
+        """個別レコードを1回の走査でパース"""
+        try:
+            record = DMARCRecord(policy_published, report_metadata)
             
-            # レコードデータを作成
-            record_data = {
-                'source_ip': source_ip,
-                'count': count,
-                'header_from': header_from,
-                'envelope_from': envelope_from,
-                'policy_evaluated': policy_evaluated,
-                'spf_results': spf_results,
-                'dkim_results': dkim_results,
-                'policy_published': policy_published
-            }
+            for section in record_elem:
+                section_tag = local_name(section.tag)
+                
+                if section_tag == 'row':
+                    # 基本情報とpolicy_evaluated情報
+                    for child in section:
+                        child_tag = local_name(child.tag)
+                        if child_tag == 'source_ip':
+                            record.source_ip = intern(element_text(child))
+                        elif child_tag == 'count':
+                            record.count = int(element_text(child) or 1)
+                        elif child_tag == 'policy_evaluated':
+                            policy_evaluated = child_texts(child, ('disposition', 'dkim', 'spf'))
+                            record.disposition = intern(policy_evaluated['disposition'])
+                            record.policy_dkim = intern(policy_evaluated['dkim'])
+                            record.policy_spf = intern(policy_evaluated['spf'])
+                
+                elif section_tag == 'identifiers':
+                    identifiers = child_texts(section, ('header_from', 'envelope_from'))
+                    record.header_from = intern(identifiers['header_from'])
+                    record.envelope_from = intern(identifiers['envelope_from'])
+                
+                elif section_tag == 'auth_results':
+                    # SPF/DKIM結果
+                    spf_results = []
+                    dkim_results = []
+                    for result in section:
+                        result_tag = local_name(result.tag)
+                        if result_tag == 'spf':
+                            spf_results.append(AuthResult.from_element(result))
+                        elif result_tag == 'dkim':
+                            dkim_results.append(AuthResult.from_element(result))
+                    record.spf_results = tuple(spf_results)
+                    record.dkim_results = tuple(dkim_results)
             
-            return record_data
+            return record
             
         except Exception as e:
             print(f"❌ レコード解析エラー: {e}")
             return None
     
+    def process_source(self, source: ReportSource) -> 'ProcessedReport':
+        """1ファイル分のレコードを逐次評価し、統合済みレコードを返す
+        
+        stats にはレコード数・評価数・解凍後のバイト数と、パース・評価・統合それぞれの
+        実時間と CPU 時間（--profile で集計する）を記録する。
+        """
+        report_metadata = {}
+        digest = hashlib.blake2b(digest_size=16)
+        cache = self.evaluation_cache
+        records_before, evaluations_before = cache.records, cache.evaluations
+        stats = {}
+        timer = StageTimer()
+        try:
+            # 一定件数ずつ評価して統合するため、ファイル全体を保持しない
+            consolidated = {}
+            dispositions = {}  # (Header From, 受信側の処置) -> メッセージ数（統合キーに含まれないため別に数える）
+            for batch in iter_batches(self.iter_records(source, report_metadata, digest, stats),
+                                      EVALUATION_BATCH_SIZE):
+                timer.lap('parse')
+                evaluated = self.evaluate_batch(batch)
+                timer.lap('evaluate')
+                self.consolidate_into(consolidated, evaluated)
+                for record in batch:
+                    key = (record.header_from, record.disposition)
+                    dispositions[key] = dispositions.get(key, 0) + record.count
+                timer.lap('consolidate_file')
+            # 最後のバッチの後のファイル末尾までの読み込み
+            timer.lap('parse')
+        except Exception as e:
+            print(f"❌ XML解析エラー {source.name}: {e}")
+            self.failed_sources.add(source.path)
+            return ProcessedReport([], report_metadata, None, {})
+        stats.update(
+            records=cache.records - records_before,
+            evaluations=cache.evaluations - evaluations_before,
+            timings=timer.timings,
+        )
+        report_metadata['dispositions'] = [[header_from, disposition, messages]
+                                           for (header_from, disposition), messages in dispositions.items()]
+        report_metadata['records'] = stats['records']
+        return ProcessedReport(list(consolidated.values()), report_metadata, digest.hexdigest(), stats)
+    
+    def process_sources(self, sources: List[ReportSource]) -> Iterator[List['EvaluatedRecord']]:
+        """キャッシュ済みのファイルは読み込み、それ以外を処理してファイル順に1ファイルずつ返す（sources と1対1）
+        （キャッシュ済みのレコードも順番が来てから読み込むため、全ファイル分を保持しない）"""
+        cached = {}  # sources の番号 -> 内容ハッシュ
+        known_failures = set()  # 前回解析に失敗し、その後変更のない sources の番号
+        if self.cache:
+            for index, source in enumerate(sources):
+                if self.cache.failed(source):
+                    known_failures.add(index)
+                    continue
+                digest = self.cache.digest_for(source)
+                if digest is None:
+                    continue
+                # ストアに未登録のレポートはストアに書き込むため、処置の内訳を記録していない古い
+                # エントリはメトリクスに加えるため処理し直す
+                if self.store is not None and not self.store.has(digest, self.cache.identity_for(digest)):
+                    continue
+                if self.metrics is not None and 'dispositions' not in self.cache.metadata_for(digest):
+                    continue
+                cached[index] = digest
+            if cached:
+                print(f"💾 キャッシュ利用: {len(cached)}件, 新規処理: "
+                      f"{len(sources) - len(cached) - len(known_failures)}件")
+            self.warn_known_failures([sources[index] for index in sorted(known_failures)])
+        
+        pending_sources = [source for index, source in enumerate(sources)
+                           if index not in cached and index not in known_failures]
+        if self.jobs > 1 and len(pending_sources) > 1:
+            processed = self.process_parallel(pending_sources)
+        else:
+            processed = map(self.process_source, pending_sources)
+        
+        evaluated_records = evaluations = 0
+        try:
+            for index, source in enumerate(sources):
+                if index in known_failures:
+                    yield []
+                    continue
+                if index in cached:
+                    with self.stage('load_cache') as counters:
+                        records = self.cache.load(source)
+                        counters['records'] = len(records or ())
+                    if records is not None:
+                        if self.profiler:
+                            self.profiler.cached_files += 1
+                        if self.metrics:
+                            self.metrics.add_report(records, self.cache.metadata_for(cached[index]))
+                        yield records
+                        continue
+                    # 確認後にキャッシュが読めなくなった場合はここで処理する
+                    report = self.process_source(source)
+                else:
+                    report = next(processed)
+                if self.profiler:
+                    self.profiler.add_file(source, report)
+                # 解析に失敗した読み込み元は digest が None のため保存されない
+                if self.cache:
+                    self.cache.store(source, report)
+                if self.store:
+                    self.store.add(source, report)
+                evaluated_records += report.stats.get('records', 0)
+                evaluations += report.stats.get('evaluations', 0)
+                # レポートIDがなく事前に判定できなかった重複は、内容ハッシュが分かった時点で除く
+                if report.digest is None:
+                    self.forget_source(source)
+                original = self.seen_digests.setdefault(report.digest, source) if report.digest else source
+                if original.location != source.location:
+                    print(f"♻️  {source.name}: {original.name} と同じ内容のため集計から除外しました")
+                    yield []
+                    continue
+                if self.metrics and report.digest:
+                    self.metrics.add_report(report.records, report.report_metadata)
+                yield report.records
+            
+            if evaluated_records:
+                hit_rate = (evaluated_records - evaluations) / evaluated_records * 100
+                print(f"🧮 DMARC評価: {evaluated_records}件のレコードを{evaluations}通りの組み合わせで評価"
+                      f" (キャッシュヒット率 {hit_rate:.1f}%)")
+        finally:
+            if self.cache:
+                self.cache.save()
+            if self.store:
+                self.store.commit()
+    
+    def warn_known_failures(self, sources: List[ReportSource]) -> None:
+        """前回解析に失敗し、その後変更のないファイルを解析せずに除くことを表示"""
+        if not sources:
+            return
+        # アーカイブの削除対象からは外す
+        self.failed_sources.update(source.path for source in sources)
+        names = ', '.join(source.name for source in sources[:DUPLICATE_DISPLAY_LIMIT])
+        if len(sources) > DUPLICATE_DISPLAY_LIMIT:
+            names += f" ほか{len(sources) - DUPLICATE_DISPLAY_LIMIT}件"
+        print(f"⚠️  前回解析に失敗し、その後変更のないファイル {len(sources)}件を除外しました: {names}")
+    
+    def report_key(self, source: ReportSource) -> tuple:
+        """読み込み元の (内容ハッシュ, report_identity())。不明な値は None
+        
+        キャッシュ済みのファイルはインデックスから、それ以外は report_metadata だけを読んで求める。
+        """
+        if self.cache and self.cache.failed(source):
+            # 解析できないファイルは、変更されるまで読み直さない
+            return None, None
+        digest = self.cache.digest_for(source) if self.cache else None
+        identity = self.cache.identity_for(digest) if digest else None
+        if identity is None:
+            metadata = read_report_metadata(source)
+            identity = report_identity(metadata)
+            if digest and metadata:
+                # 期間を記録していない古いキャッシュのエントリを補う
+                self.cache.remember_metadata(digest, metadata)
+        return digest, identity
+    
+    def forget_source(self, source: ReportSource) -> None:
+        """解析に失敗した読み込み元を重複判定から外す（書き込み途中だったファイルを完成後に処理できるように）"""
+        for seen in (self.seen_digests, self.seen_reports):
+            for key in [key for key, original in seen.items() if original.location == source.location]:
+                del seen[key]
+    
+    def skip_duplicates(self, sources: List[ReportSource],
+                        keys: Optional[List[tuple]] = None) -> List[ReportSource]:
+        """同じ内容のファイルと、送信元組織・レポートID・期間が同じ再送レポートを除いた一覧を返す
+        
+        report_key() で判定するため、重複分のレコードは解析しない（keys には求め済みの値を渡せる）。
+        最初に現れたもの（監視モードでは先に処理したもの）を残す。
+        """
+        unique = []
+        duplicates = []  # (重複した読み込み元, 残した読み込み元, 同じ内容か)
+        with self.stage('dedup'):
+            for index, source in enumerate(sources):
+                digest, identity = keys[index] if keys is not None else self.report_key(source)
+                
+                # 同じ読み込み元（書き換えられたファイルなど）は自分自身の重複とはみなさない
+                original = self.seen_digests.get(digest) if digest else None
+                if original is not None and original.location != source.location:
+                    duplicates.append((source, original, True))
+                    continue
+                original = self.seen_reports.get(identity) if identity else None
+                if original is not None and original.location != source.location:
+                    duplicates.append((source, original, False))
+                    continue
+                if digest:
+                    self.seen_digests[digest] = source
+                if identity:
+                    self.seen_reports[identity] = source
+                unique.append(source)
+        
+        if self.cache and self.cache.dirty:
+            self.cache.save()
+        if duplicates:
+            print(f"♻️  重複レポート {len(duplicates)}件をスキップしました（解析せずに除外）")
+            for source, original, same_content in duplicates[:DUPLICATE_DISPLAY_LIMIT]:
+                reason = "同じ内容" if same_content else "同じ送信元組織・レポートID・期間"
+                print(f"  - {source.name}: {original.name} と{reason}")
+            if len(duplicates) > DUPLICATE_DISPLAY_LIMIT:
+                print(f"  … 他 {len(duplicates) - DUPLICATE_DISPLAY_LIMIT}件")
+        return unique
+    
+    def create_executor(self, jobs: int):
+        """ファイルを処理するワーカープロセスのプールを作る"""
+        from concurrent.futures import ProcessPoolExecutor
+        
+        return ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                   initargs=(self.dmarc_dir, _public_suffix_list_path, _public_suffix_list_cache_dir,
+                                             self.writer is not None))
+    
+    def process_parallel(self, sources: List[ReportSource]) -> Iterator['ProcessedReport']:
+        """複数プロセスでファイルを処理し、ファイル順に結果を返す"""
+        jobs = min(self.jobs, len(sources))
+        chunksize = max(1, len(sources) // (jobs * 4))
+        
+        # 監視モードではワーカー（と各ワーカーの評価キャッシュ）を使い回す
+        executor = self.executor or self.create_executor(jobs)
+        try:
+            # map() は入力順に結果を返すため、直列処理と同じ統合順序になる
+            for source, (report, failed) in zip(sources, executor.map(
+                    _process_source_in_worker, sources, chunksize=chunksize)):
+                if failed:
+                    self.failed_sources.add(source.path)
+                yield report
+        finally:
+            if executor is not self.executor:
+                executor.shutdown(cancel_futures=True)
+    
     def check_alignment(self, domain1: str, domain2: str, alignment_mode: str = 'r') -> bool:
         """ドメインアライメントをチェック"""
         if not domain1 or not domain2:
@@ -239,155 +3007,117 @@ class DMARCAnalyzer:
         
         # relaxed alignment (組織ドメインレベルでの一致)
         if alignment_mode == 'r':
-            # サブドメインを除いた組織ドメインで比較
-            org_domain1 = '.'.join(domain1.lower().split('.')[-2:]) if '.' in domain1 else domain1.lower()
-            org_domain2 = '.'.join(domain2.lower().split('.')[-2:]) if '.' in domain2 else domain2.lower()
-            return org_domain1 == org_domain2
+            # Public Suffix List に基づく組織ドメインで比較（co.jp なども正しく扱う）
+            return org_domain(domain1) == org_domain(domain2)
         
         return False
     
-    def evaluate_dmarc(self, record_data: Dict[str, Any]) -> Dict[str, Any]:
+    def evaluate_dmarc(self, record: 'DMARCRecord') -> 'EvaluatedRecord':
         """DMARC結果を評価"""
-        header_from = record_data['header_from']
-        policy_evaluated = record_data.get('policy_evaluated', {})
-        policy_published = record_data.get('policy_published', {})
-        
         # policy_evaluatedが存在する場合はそれを優先
-        if policy_evaluated.get('dkim') and policy_evaluated.get('spf'):
-            dmarc_result = 'pass' if (policy_evaluated.get('dkim') == 'pass' or 
-                                    policy_evaluated.get('spf') == 'pass') else 'fail'
+        if record.policy_dkim and record.policy_spf:
+            dmarc_result = 'pass' if (record.policy_dkim == 'pass' or
+                                    record.policy_spf == 'pass') else 'fail'
             note = 'policy_evaluated'
+        else:
+            # 手動評価
+            spf_dmarc_result = self.evaluate_spf_alignment(record)
+            dkim_dmarc_result = self.evaluate_dkim_alignment(record)
             
-            # 表示用のSPF/DKIM情報を構築
-            spf_info = self.build_spf_info(record_data)
-            dkim_info = self.build_dkim_info(record_data)
-            
-            return {
-                'source_ip': record_data['source_ip'],
-                'count': record_data['count'],
-                'header_from': header_from,
-                'spf_domain': spf_info.get('domain', ''),
-                'spf_result': spf_info.get('result', ''),
-                'dkim_domain': dkim_info.get('domain', ''),
-                'dkim_result': dkim_info.get('result', ''),
-                'dkim_selector': dkim_info.get('selector', ''),
-                'dmarc_result': dmarc_result,
-                'note': note
-            }
+            # 最終DMARC結果
+            dmarc_result = 'pass' if (spf_dmarc_result == 'pass' or dkim_dmarc_result == 'pass') else 'fail'
+            note = 'manual_evaluation'
         
-        # 手動評価
-        spf_dmarc_result = self.evaluate_spf_alignment(record_data)
-        dkim_dmarc_result = self.evaluate_dkim_alignment(record_data)
+        # 表示用のSPF/DKIM情報を構築
+        spf_info = self.build_spf_info(record)
+        dkim_info = self.build_dkim_info(record)
         
-        # 最終DMARC結果
-        dmarc_result = 'pass' if (spf_dmarc_result == 'pass' or dkim_dmarc_result == 'pass') else 'fail'
+        return EvaluatedRecord(
+            record.source_ip, record.count, record.header_from,
+            spf_info.domain, spf_info.result,
+            dkim_info.domain, dkim_info.result, dkim_info.selector,
+            dmarc_result, note
+        )
+    
+    def evaluate_batch(self, records: List['DMARCRecord']) -> List['EvaluatedRecord']:
+        """認証情報の組み合わせごとに1回だけ評価し、結果を各レコードに展開"""
+        cache = self.evaluation_cache
+        outcomes = {}  # バッチ内の組み合わせ → 評価結果
+        evaluated = []
         
-        # 表示用のSPF/DKIM情報を構築
-        spf_info = self.build_spf_info(record_data)
-        dkim_info = self.build_dkim_info(record_data)
+        for record in records:
+            key = evaluation_key(record)
+            outcome = outcomes.get(key)
+            if outcome is None:
+                outcome = cache.get(key)
+                if outcome is None:
+                    # 未評価の組み合わせのみ実際に評価する
+                    outcome = self.evaluate_dmarc(record).as_tuple()[2:]
+                    cache.put(key, outcome)
+                    cache.evaluations += 1
+                outcomes[key] = outcome
+            evaluated.append(EvaluatedRecord(record.source_ip, record.count, *outcome))
         
-        return {
-            'source_ip': record_data['source_ip'],
-            'count': record_data['count'],
-            'header_from': header_from,
-            'spf_domain': spf_info.get('domain', ''),
-            'spf_result': spf_info.get('result', ''),
-            'dkim_domain': dkim_info.get('domain', ''),
-            'dkim_result': dkim_info.get('result', ''),
-            'dkim_selector': dkim_info.get('selector', ''),
-            'dmarc_result': dmarc_result,
-            'note': 'manual_evaluation'
-        }
+        cache.records += len(records)
+        return evaluated
     
-    def build_spf_info(self, record_data: Dict[str, Any]) -> Dict[str, str]:
+    def build_spf_info(self, record: 'DMARCRecord') -> 'AuthResult':
         """SPF表示情報を構築"""
-        spf_results = record_data.get('spf_results', [])
-        if spf_results:
+        if record.spf_results:
             # 最初のSPF結果を使用
-            return spf_results[0]
-        return {'domain': '', 'result': ''}
+            return record.spf_results[0]
+        return EMPTY_AUTH_RESULT
     
-    def build_dkim_info(self, record_data: Dict[str, Any]) -> Dict[str, str]:
+    def build_dkim_info(self, record: 'DMARCRecord') -> 'AuthResult':
         """DKIM表示情報を構築"""
-        dkim_results = record_data.get('dkim_results', [])
-        if dkim_results:
+        if record.dkim_results:
             # passの結果があればそれを優先、なければ最初の結果を使用
-            for dkim in dkim_results:
-                if dkim.get('result') == 'pass':
+            for dkim in record.dkim_results:
+                if dkim.result == 'pass':
                     return dkim
-            return dkim_results[0]
-        return {'domain': '', 'result': '', 'selector': ''}
+            return record.dkim_results[0]
+        return EMPTY_AUTH_RESULT
     
-    def evaluate_spf_alignment(self, record_data: Dict[str, Any]) -> str:
+    def evaluate_spf_alignment(self, record: 'DMARCRecord') -> str:
         """SPFアライメントを評価"""
-        header_from = record_data['header_from']
-        spf_results = record_data.get('spf_results', [])
-        policy_published = record_data.get('policy_published', {})
-        aspf = policy_published.get('aspf', 'r')  # デフォルトはrelaxed
-        
-        for spf in spf_results:
-            if spf.get('result') == 'pass':
-                if self.check_alignment(spf.get('domain', ''), header_from, aspf):
+        aspf = record.policy_published.aspf
+        
+        for spf in record.spf_results:
+            if spf.result == 'pass':
+                if self.check_alignment(spf.domain, record.header_from, aspf):
                     return 'pass'
         
         return 'fail'
     
-    def evaluate_dkim_alignment(self, record_data: Dict[str, Any]) -> str:
+    def evaluate_dkim_alignment(self, record: 'DMARCRecord') -> str:
         """DKIMアライメントを評価"""
-        header_from = record_data['header_from']
-        dkim_results = record_data.get('dkim_results', [])
-        policy_published = record_data.get('policy_published', {})
-        adkim = policy_published.get('adkim', 'r')  # デフォルトはrelaxed
-        
-        for dkim in dkim_results:
-            if dkim.get('result') == 'pass':
-                if self.check_alignment(dkim.get('domain', ''), header_from, adkim):
+        adkim = record.policy_published.adkim
+        
+        for dkim in record.dkim_results:
+            if dkim.result == 'pass':
+                if self.check_alignment(dkim.domain, record.header_from, adkim):
                     return 'pass'
         
         return 'fail'
     
-    def consolidate_records(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def consolidate_records(self, records: Iterable['EvaluatedRecord']) -> List['EvaluatedRecord']:
         """同じIP・同じレコード内容のものを統合"""
-        consolidated = {}
-        
+        return list(self.consolidate_into({}, records).values())
+    
+    def consolidate_into(self, consolidated: Dict[tuple, 'EvaluatedRecord'],
+                         records: Iterable['EvaluatedRecord']) -> Dict[tuple, 'EvaluatedRecord']:
+        """統合キーごとの辞書 consolidated に records を加えて返す"""
         for record in records:
-            key = (
-                record['source_ip'],
-                record['header_from'],
-                record['spf_domain'],
-                record['spf_result'],
-                record['dkim_domain'],
-                record['dkim_result'],
-                record['dkim_selector'],
-                record['dmarc_result']
-            )
+            key = consolidation_key(record)
             
             if key in consolidated:
-                consolidated[key]['count'] += record['count']
+                consolidated[key].count += record.count
             else:
                 consolidated[key] = record.copy()
         
-        return list(consolidated.values())
+        return consolidated
     
-    def filter_error_records(self, records: List[Dict[str, Any]]) -> tuple[List[Dict[str, Any]], int]:
-        """エラーのあるレコードのみを抽出"""
-        error_records = []
-        total_count = len(records)
-        
-        for record in records:
-            has_error = (
-                record['spf_result'] != 'pass' or
-                record['dkim_result'] != 'pass' or
-                record['dmarc_result'] != 'pass'
-            )
-            
-            if has_error:
-                error_records.append(record)
-        
-        clean_count = total_count - len(error_records)
-        return error_records, clean_count
-    
-    def format_table(self, records: List[Dict[str, Any]], show_colors: bool = True) -> str:
+    def format_table(self, records: List['EvaluatedRecord'], show_colors: bool = True) -> str:
         """レコードをテーブル形式でフォーマット"""
         if not records:
             return ""
@@ -396,30 +3126,39 @@ class DMARCAnalyzer:
         terminal_width = self.get_terminal_width()
         
         headers = [
-            'Source IP', 'Count', 'Header From', 'SPF Domain', 
+            'Source Network' if self.networks else 'Source IP', 'Count', 'Header From', 'SPF Domain', 
             'SPF Result', 'DKIM Domain', 'DKIM Result', 
             'DKIM Selector', 'DMARC Result'
         ]
         
+        ptr_names = None
+        if self.resolver:
+            ptr_names = self.resolver.resolve(record.source_ip for record in records)
+            headers.insert(1, 'PTR')
+        
         # 各列の最適幅を計算
         col_widths = self.calculate_column_widths(records, headers, terminal_width)
+        if ptr_names is not None:
+            ptr_width = col_widths.pop(1)
         
         table_data = []
         for record in records:
             row = [
-                self.truncate_text(record['source_ip'], col_widths[0]),
-                str(record['count']),
-                self.truncate_text(record['header_from'], col_widths[2]),
-                self.truncate_text(record['spf_domain'], col_widths[3]),
-                self.colorize_result(record['spf_result'], show_colors),
-                self.truncate_text(record['dkim_domain'], col_widths[5]),
-                self.colorize_result(record['dkim_result'], show_colors),
-                self.truncate_text(record['dkim_selector'], col_widths[7]),
-                self.colorize_result(record['dmarc_result'], show_colors)
+                self.truncate_text(record.source_ip, col_widths[0]),
+                str(record.count),
+                self.truncate_text(record.header_from, col_widths[2]),
+                self.truncate_text(record.spf_domain, col_widths[3]),
+                self.colorize_result(record.spf_result, show_colors),
+                self.truncate_text(record.dkim_domain, col_widths[5]),
+                self.colorize_result(record.dkim_result, show_colors),
+                self.truncate_text(record.dkim_selector, col_widths[7]),
+                self.colorize_result(record.dmarc_result, show_colors)
             ]
+            if ptr_names is not None:
+                row.insert(1, self.truncate_text(ptr_names.get(record.source_ip, ''), ptr_width))
             table_data.append(row)
         
-        return tabulate(table_data, headers=headers, tablefmt='grid')
+        return require('tabulate').tabulate(table_data, headers=headers, tablefmt='grid')
     
     def get_terminal_width(self) -> int:
         """ターミナル幅を取得"""
@@ -428,7 +3167,7 @@ class DMARCAnalyzer:
         except Exception:
             return 120  # デフォルト幅
     
-    def calculate_column_widths(self, records: List[Dict[str, Any]], headers: List[str], terminal_width: int) -> List[int]:
+    def calculate_column_widths(self, records: List['EvaluatedRecord'], headers: List[str], terminal_width: int) -> List[int]:
         """各列の最適幅を計算"""
         # より保守的な固定幅設定
         fixed_widths = {
@@ -469,10 +3208,6 @@ class DMARCAnalyzer:
                 else:
                     col_widths.append(base_width)
         
-        # デバッグ情報
-        total_estimated = sum(col_widths) + grid_overhead
-        print(f"🖥️ ターミナル幅: {terminal_width}, 推定テーブル幅: {total_estimated}")
-        
         return col_widths
     
     def truncate_text(self, text: str, max_width: int) -> str:
@@ -492,7 +3227,8 @@ class DMARCAnalyzer:
         """結果に色を付ける"""
         if not show_colors:
             return result
-            
+        
+        Fore, Style = load_colorama()
         if result.lower() == 'pass':
             return f"{Fore.GREEN}{result}{Style.RESET_ALL}"
         elif result.lower() == 'fail':
@@ -504,31 +3240,325 @@ class DMARCAnalyzer:
         """メイン分析処理"""
         print("🔍 DMARC レポート分析を開始します...")
         
-        # ファイル解凍
-        xml_files = self.extract_files()
-        if not xml_files:
+        # 読み込み元の検出
+        with self.stage('extract'):
+            sources = self.collect_all_sources()
+        if not sources:
             print("❌ 処理対象のXMLファイルが見つかりません")
             return
         
-        print(f"📄 {len(xml_files)}個のXMLファイルを処理します")
+        print(f"📄 {len(sources)}個のXMLファイルを処理します")
+        unique_sources = self.skip_duplicates(sources)
         
-        # 全レコードを収集
-        all_records = []
-        for xml_file in xml_files:
-            records = self.parse_xml(xml_file)
-            
-            # DMARC評価
-            for record_data in records:
-                evaluated_record = self.evaluate_dmarc(record_data)
-                all_records.append(evaluated_record)
+        # 前回と同じファイル構成なら統合・集計済みの結果を使う
+        digests = self.source_digests(unique_sources)
+        with self.stage('load_result'):
+            result = self.cache.load_result(digests, self.result_variant()) if digests else None
+        if result is not None:
+            print("💾 前回から変更がないため、キャッシュ済みの分析結果を表示します")
+            self.warn_known_failures([source for source in unique_sources if self.cache.failed(source)])
+        else:
+            # ファイルごとに逐次パース・評価・統合した結果を収集
+            all_records = []
+            for partial in self.process_sources(unique_sources):
+                all_records.extend(partial)
+        
+        # 明示的に指定された場合のみ処理済みアーカイブを削除
+        if self.delete_archives:
+            self.remove_archives(sources)
+        
+        if result is None:
+            if not all_records:
+                print("❌ 処理可能なレコードが見つかりません")
+                return
+            result = self.build_result(all_records, self.source_digests(unique_sources))
+        
+        self.show_result(result, show_all)
+    
+    def stage(self, name: str):
+        """--profile 指定時は段階 name の計測区間（それ以外は何もしない）"""
+        return self.profiler.stage(name) if self.profiler else contextlib.nullcontext({})
+    
+    def collect_all_sources(self) -> List[ReportSource]:
+        """ディレクトリとメールボックスから読み込み元を集める"""
+        sources = self.collect_sources() if self.scan_directory else []
+        seen_ids = set()
+        for mailbox_path in self.mailboxes:
+            sources.extend(self.collect_mail_sources(mailbox_path, seen_ids))
+        return sources
+    
+    def update_store(self) -> None:
+        """新しいレポートを処理してストアに追加（表示はしない）"""
+        sources = self.collect_all_sources()
+        for _ in self.process_sources(self.skip_duplicates(sources)):
+            pass
+        if self.delete_archives:
+            self.remove_archives(sources)
+    
+    def analyze_store(self, show_all: bool = False, query: Optional[RecordQuery] = None,
+                      update: bool = False) -> None:
+        """SQLite ストアに蓄積したレコードから分析結果を表示（update の場合は先に新しいレポートを追加）"""
+        print("🔍 DMARC レポート分析を開始します...")
+        if update:
+            self.update_store()
+        print(f"🗄️  {self.store.path}: 保存済みレポート {self.store.report_count()}件")
+        if query is not None:
+            print(f"🔎 検索条件: {query.describe()}")
+        
+        with self.stage('load_store') as counters:
+            records = list(self.store.iter_records(query))
+            counters['records'] = len(records)
+        if not records:
+            print("❌ 条件に合うレコードが見つかりません" if query else "❌ 処理可能なレコードが見つかりません")
+            return
+        self.show_result(self.build_result(records), show_all)
+    
+    def export(self, show_all: bool = False, query: Optional[RecordQuery] = None,
+               from_store: bool = False, update: bool = False) -> None:
+        """レコードを処理した順に書き出し、最後に統計を書き出す
+        
+        1ファイル（ストアの場合は一定件数）ずつ書き出すため、レコード全体は保持しない。
+        統計には統合キーの集合だけを保持する。
+        """
+        print("🔍 DMARC レポート分析を開始します...")
+        if from_store:
+            if update:
+                self.update_store()
+            if query is not None:
+                print(f"🔎 検索条件: {query.describe()}")
+            batches = iter_batches(self.store.iter_records(query), EVALUATION_BATCH_SIZE)
+        else:
+            with self.stage('extract'):
+                sources = self.collect_all_sources()
+            if not sources:
+                print("❌ 処理対象のXMLファイルが見つかりません")
+                return
+            print(f"📄 {len(sources)}個のXMLファイルを処理します")
+            batches = self.process_sources(self.skip_duplicates(sources))
+        
+        statistics = StatisticsAggregator()
+        for records in batches:
+            if self.networks:
+                self.networks.regroup(records)
+            with self.stage('detailed_analysis') as counters:
+                statistics.update(records)
+                counters['records'] = len(records)
+            with self.stage('render') as counters:
+                self.writer.write(records if show_all else filter(is_error_record, records))
+                counters['records'] = len(records)
+        
+        if not from_store and self.delete_archives:
+            self.remove_archives(sources)
+        
+        self.writer.write_summary(statistics.as_dict())
+        if statistics.total_records:
+            with self.stage('detailed_analysis'):
+                self.print_statistics(statistics.as_dict())
+        else:
+            print("❌ 処理可能なレコードが見つかりません")
+    
+    def source_label(self, source: ReportSource) -> str:
+        """ホストをまたいで同じ読み込み元を指す名前（--dir からの相対パスとZIPメンバー名）"""
+        label = os.path.relpath(source.path, self.dmarc_dir)
+        return f"{label}#{source.member}" if source.member is not None else label
+    
+    def map_shard(self, output_path: str, shard: tuple = (1, 1)) -> None:
+        """読み込み元のうちシャード K/N に割り当てたものを処理し、部分集計ファイルに書き出す
+        
+        シャードはレポートの識別情報（なければ内容ハッシュ）で決めるため、同じ一覧を
+        各ホストで分割しても、再送・二重ダウンロードされたレポートは同じシャードに入って
+        重複として除かれる。レコードはシャード内で統合し、一覧での初出位置（ファイル番号,
+        ファイル内の位置）を付けて保存する。merge はこの位置で並べ直すため、1台で処理した
+        場合と同じ順序の表になる。
+        """
+        import platform
+        
+        print("🔍 DMARC レポート分析を開始します...")
+        with self.stage('extract'):
+            sources = self.collect_all_sources()
+        index, count = shard
+        listing = hashlib.blake2b(digest_size=16)
+        for source in sources:
+            listing.update(self.source_label(source).encode() + b'\0')
+        
+        keys = None
+        if count > 1:
+            with self.stage('dedup'):
+                keys = [self.report_key(source) for source in sources]
+        positions = {}  # 読み込み元の id -> 一覧での番号
+        selected, selected_keys = [], []
+        for position, source in enumerate(sources):
+            if keys is not None:
+                digest, identity = keys[position]
+                if identity:
+                    shard_key = json.dumps(identity)
+                else:
+                    # レポートIDのないレポートは、同じ内容のコピーが同じシャードに入るよう内容ハッシュで振り分ける
+                    if digest is None and not (self.cache and self.cache.failed(source)):
+                        with self.stage('dedup'):
+                            digest = content_digest(source)
+                        keys[position] = (digest, identity)
+                    shard_key = digest or self.source_label(source)
+                if shard_index(shard_key, count) != index - 1:
+                    continue
+                selected_keys.append(keys[position])
+            positions[id(source)] = position
+            selected.append(source)
+        print(f"🧩 シャード {index}/{count}: {len(sources)}件中 {len(selected)}件を処理します")
+        unique_sources = self.skip_duplicates(selected, selected_keys if keys is not None else None)
+        
+        consolidated = {}  # 統合キー -> [レコード, ファイル番号, ファイル内の位置]
+        for source, records in zip(unique_sources, self.process_sources(unique_sources)):
+            file_index = positions[id(source)]
+            for offset, record in enumerate(records):
+                key = consolidation_key(record)
+                entry = consolidated.get(key)
+                if entry is None:
+                    consolidated[key] = [record.copy(), file_index, offset]
+                else:
+                    entry[0].count += record.count
+        
+        if self.delete_archives:
+            self.remove_archives(selected)
+        
+        with self.stage('detailed_analysis'):
+            statistics = StatisticsAggregator().update(entry[0] for entry in consolidated.values())
+        partial = {
+            'format': PARTIAL_FORMAT,
+            'version': PARTIAL_VERSION,
+            'evaluation_version': EVALUATION_VERSION,
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'host': platform.node(),
+            'listing': listing.hexdigest(),
+            'shard': [index, count],
+            'sources': len(selected),
+            'duplicates': len(selected) - len(unique_sources),
+            'digests': list(self.seen_digests),
+            'identities': [list(identity) for identity in self.seen_reports],
+            # 各行は RECORD_COLUMNS の値の後に初出位置（ファイル番号, ファイル内の位置）
+            'records': [record.as_tuple() + (file_index, offset)
+                        for record, file_index, offset in consolidated.values()],
+            # 統合キーも含めるため、merge では StatisticsAggregator.merge() で合算できる
+            'statistics': statistics.to_state(),
+        }
+        try:
+            write_partial(output_path, partial)
+        except OSError as e:
+            print(f"❌ 部分集計の書き込みエラー {output_path}: {e}")
+            return
+        print(f"📦 部分集計を書き出しました: {output_path} "
+              f"(レコード {len(consolidated)}件, メッセージ {statistics.messages}通)")
+    
+    def merge_partials(self, paths: List[str], show_all: bool = False) -> None:
+        """map で作った部分集計を統合し、1台で処理した場合と同じ表と詳細分析を表示
+        
+        すべての部分集計が同じ読み込み元の一覧から作られていれば、初出位置で並べ直して
+        1台で処理した場合と同じ順序にする。一覧が異なる場合は指定した順に連結する。
+        同じレポートが複数の部分集計に含まれる場合は件数が重複するため統合しない。
+        """
+        print("🔍 部分集計を統合します...")
+        partials = []
+        for path in paths:
+            with self.stage('load_result') as counters:
+                partial = load_partial(path)
+                counters['records'] = len(partial['records'])
+            partials.append(partial)
+            index, count = partial['shard']
+            print(f"📦 {path}: {partial['host'] or '-'} シャード {index}/{count}, "
+                  f"ファイル {partial['sources']}件 (重複 {partial['duplicates']}件), "
+                  f"レコード {len(partial['records'])}件, メッセージ {partial['statistics']['messages']}通")
+        
+        # 同じレポートを含む部分集計（シャードの指定ミスや同じファイルの二重指定）は統合しない
+        owners = {}
+        overlaps = set()
+        for number, partial in enumerate(partials):
+            for key in partial['digests'] + [json.dumps(identity) for identity in partial['identities']]:
+                if owners.setdefault(key, number) != number:
+                    overlaps.add((owners[key], number))
+        if overlaps:
+            print(f"❌ 同じレポートが複数の部分集計に含まれているため統合できません: "
+                  + ", ".join(f"{paths[a]} と {paths[b]}" for a, b in sorted(overlaps)))
+            return
+        
+        same_listing = len({partial['listing'] for partial in partials}) == 1
+        if same_listing:
+            counts = {partial['shard'][1] for partial in partials}
+            missing = [index for index in range(1, max(counts) + 1)
+                       if index not in {partial['shard'][0] for partial in partials}]
+            if len(counts) == 1 and missing:
+                print(f"⚠️  シャード {', '.join(f'{index}/{max(counts)}' for index in missing)} が指定されていません")
         
-        if not all_records:
+        rows = []
+        for number, partial in enumerate(partials):
+            for row in partial['records']:
+                *values, file_index, offset = row
+                order = (file_index, offset) if same_listing else (number, file_index, offset)
+                rows.append((order, EvaluatedRecord(*values)))
+        rows.sort(key=lambda row: row[0])
+        records = [record for _, record in rows]
+        if not records:
             print("❌ 処理可能なレコードが見つかりません")
             return
         
-        # レコード統合
-        consolidated_records = self.consolidate_records(all_records)
+        # 統計は部分集計を合算する（ネットワーク単位にまとめる場合は統合キーが変わるため集計し直す）
+        statistics = None
+        if not self.networks:
+            with self.stage('detailed_analysis'):
+                aggregator = StatisticsAggregator()
+                for partial in partials:
+                    aggregator.merge(StatisticsAggregator.from_state(partial['statistics']))
+                statistics = aggregator.reorder(records).as_dict()
+        result = self.build_result(records, statistics=statistics)
+        if self.writer:
+            with self.stage('render') as counters:
+                shown = result.records if show_all else result.error_records
+                self.writer.write(shown)
+                counters['records'] = len(shown)
+            self.writer.write_summary(result.statistics)
+            with self.stage('detailed_analysis'):
+                self.print_statistics(result.statistics)
+        else:
+            self.show_result(result, show_all)
+    
+    def show_trend(self, period: str = 'day', group_by: Optional[str] = None,
+                   query: Optional[RecordQuery] = None, update: bool = False) -> None:
+        """期間別の集計から、メッセージ数と SPF/DKIM/DMARC 失敗数の推移を表示"""
+        print("🔍 DMARC レポート分析を開始します...")
+        if update:
+            self.update_store()
+        query = query or RecordQuery()
+        if query.describe():
+            print(f"🔎 検索条件: {query.describe()}")
+        
+        rows = self.store.rollups(period, group_by, query.header_from, query.since, query.until)
+        if not rows:
+            print("❌ 条件に合うレコードが見つかりません")
+            return
+        
+        label = {'day': '日', 'week': '週'}[period]
+        headers = [f'{label} (UTC)', 'Messages', 'SPF Fail', 'DKIM Fail', 'DMARC Fail', 'Records']
+        if group_by:
+            headers.insert(1, {'header_from': 'Header From', 'org_name': 'Reporter'}[group_by])
+        
+        def rate(fails: int, messages: int) -> str:
+            return f"{fails} ({fails / messages * 100:.1f}%)" if messages else str(fails)
+        
+        table_data = []
+        for bucket, group, records, messages, spf_fails, dkim_fails, dmarc_fails in rows:
+            row = [datetime.fromtimestamp(bucket, timezone.utc).strftime('%Y-%m-%d'), messages,
+                   rate(spf_fails, messages), rate(dkim_fails, messages), rate(dmarc_fails, messages), records]
+            if group_by:
+                row.insert(1, group)
+            table_data.append(row)
         
+        print("\n" + "="*80)
+        print(f"📈 {label}別の推移（Messages は count で重み付けしたメッセージ数）")
+        print("="*80)
+        print(require('tabulate').tabulate(table_data, headers=headers, tablefmt='grid'))
+    
+    def show_result(self, result: AnalysisResult, show_all: bool = False) -> None:
+        """レコード表（全件またはエラーのみ）と詳細分析を表示"""
+        consolidated_records = result.records
         print(f"\n📊 分析結果: 総レコード数 {len(consolidated_records)}件")
         
         if show_all:
@@ -536,18 +3566,23 @@ class DMARCAnalyzer:
             print("\n" + "="*80)
             print("📋 全レコード表示")
             print("="*80)
-            table = self.format_table(consolidated_records)
-            print(table)
+            with self.stage('render') as counters:
+                table = self.format_table(consolidated_records)
+                print(table)
+                counters['records'] = len(consolidated_records)
         else:
             # エラーレコードのみ表示
-            error_records, clean_count = self.filter_error_records(consolidated_records)
+            error_records = result.error_records
+            clean_count = len(consolidated_records) - len(error_records)
             
             if error_records:
                 print("\n" + "="*80)
                 print("⚠️  エラーのあるレコード")
                 print("="*80)
-                table = self.format_table(error_records)
-                print(table)
+                with self.stage('render') as counters:
+                    table = self.format_table(error_records)
+                    print(table)
+                    counters['records'] = len(error_records)
                 
                 print(f"\n❌ {len(error_records)}件のレコードでエラーが発生しました。")
                 if clean_count > 0:
@@ -556,19 +3591,209 @@ class DMARCAnalyzer:
                 print("\n✅ 全てのレコードでエラーがありませんでした")
         
         # 詳細分析を常に表示
-        self.show_detailed_analysis(consolidated_records)
+        with self.stage('detailed_analysis'):
+            self.print_statistics(result.statistics)
+    
+    def watch(self, show_all: bool = False, interval: float = 2.0, debounce: float = 1.0,
+              batch_size: int = 100) -> None:
+        """ディレクトリを監視し、追加されたレポートだけを処理して累計を更新し続ける"""
+        if not os.path.isdir(self.dmarc_dir):
+            print(f"❌ ディレクトリが見つかりません: {self.dmarc_dir}")
+            return
+        
+        watcher = DirectoryWatcher(self.dmarc_dir, interval, debounce)
+        statistics = StatisticsAggregator()  # 累計
+        if self.jobs > 1:
+            self.executor = self.create_executor(self.jobs)
+        
+        try:
+            backend = watcher.start()
+            print(f"👀 {self.dmarc_dir} を監視します（{backend}、Ctrl+C で終了）")
+            
+            # 既存のファイルを先に処理
+            sources = self.collect_sources()
+            watcher.mark_seen(dict.fromkeys(source.path for source in sources))
+            for batch in iter_batches(sources, batch_size):
+                self.ingest(batch, statistics, show_all)
+            
+            while True:
+                paths = watcher.wait(batch_size)
+                backlog = watcher.backlog()
+                print(f"\n📥 新しいファイル {len(paths)}件を処理します"
+                      + (f"（待機中 {backlog}件）" if backlog else ""))
+                sources = [source for path in paths for source in self.sources_for_path(path)]
+                self.ingest(sources, statistics, show_all)
+        except KeyboardInterrupt:
+            print("\n\n👋 監視を終了します")
+        finally:
+            watcher.stop()
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+                self.executor = None
+        
+        if self.writer:
+            self.writer.write_summary(statistics.as_dict())
+        if statistics.total_records:
+            self.print_statistics(statistics.as_dict())
+    
+    def ingest(self, sources: List[ReportSource], statistics: StatisticsAggregator,
+               show_all: bool = False) -> None:
+        """ファイルを処理して累計に加え、今回分のエラーレコードを表示"""
+        if not sources:
+            return
+        
+        new_records = []
+        for records in self.process_sources(self.skip_duplicates(sources)):
+            if self.networks:
+                self.networks.regroup(records)
+            with self.stage('detailed_analysis') as counters:
+                statistics.update(records)
+                counters['records'] = len(records)
+            new_records.extend(records)
+        
+        if self.delete_archives:
+            self.remove_archives(sources)
+        
+        with self.stage('consolidate') as counters:
+            counters['records'] = len(new_records)
+            new_records = self.consolidate_records(new_records)
+        shown = new_records if show_all else [r for r in new_records if is_error_record(r)]
+        with self.stage('render') as counters:
+            counters['records'] = len(shown)
+            if self.writer:
+                self.writer.write(shown)
+                self.writer.stream.flush()
+            elif shown:
+                print(self.format_table(shown))
+        
+        errors = sum(map(is_error_record, new_records))
+        print(f"📊 今回: {len(new_records)}件 (エラー {errors}件) / 累計: {statistics.total_records}件 "
+              f"(SPF失敗 {statistics.spf_fails}件, DKIM失敗 {statistics.dkim_fails}件, "
+              f"DMARC失敗 {statistics.dmarc_fails}件)")
+    
+    def serve(self, host: str = '127.0.0.1', port: int = 8080, interval: float = 2.0,
+              debounce: float = 1.0, batch_size: int = 100, metrics_max_labels: int = 100) -> None:
+        """集計結果を JSON API（と Prometheus 形式のメトリクス）で提供し、ディレクトリに追加された
+        レポートの分だけ集計を更新し続ける"""
+        from http.server import ThreadingHTTPServer
+        
+        if not os.path.isdir(self.dmarc_dir):
+            print(f"❌ ディレクトリが見つかりません: {self.dmarc_dir}")
+            return
+        
+        self.metrics = ReportMetrics(metrics_max_labels)
+        api = AnalysisAPI(self)
+        try:
+            server = ThreadingHTTPServer((host, port), make_api_handler(api))
+        except OSError as e:
+            print(f"❌ {host}:{port} で待ち受けできません: {e}")
+            return
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"🌐 http://{host}:{server.server_port}/api/ で集計結果を提供します（Ctrl+C で終了）")
+        
+        # サービスとして動かす場合の SIGTERM でも Ctrl+C と同じく終了処理を行う
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        watcher = DirectoryWatcher(self.dmarc_dir, interval, debounce)
+        if self.jobs > 1:
+            self.executor = self.create_executor(self.jobs)
+        try:
+            backend = watcher.start()
+            
+            # 既存のファイルを集計してから（それまでは 503 を返す）新しいファイルを待つ
+            sources = self.collect_sources()
+            watcher.mark_seen(dict.fromkeys(source.path for source in sources))
+            self.refresh(api, sources)
+            print(f"👀 {self.dmarc_dir} を監視します（{backend}）")
+            
+            while True:
+                paths = watcher.wait(batch_size)
+                sources = [source for path in paths for source in self.sources_for_path(path)]
+                self.refresh(api, sources)
+        except KeyboardInterrupt:
+            print("\n\n👋 サーバーを終了します")
+        finally:
+            server.shutdown()
+            server.server_close()
+            watcher.stop()
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+                self.executor = None
+    
+    def refresh(self, api: AnalysisAPI, sources: List[ReportSource]) -> None:
+        """ファイルを処理して API の集計に加える"""
+        def batches():
+            for records in self.process_sources(self.skip_duplicates(sources)):
+                if self.networks:
+                    self.networks.regroup(records)
+                yield records
+        
+        added = api.update(batches())
+        if self.delete_archives:
+            self.remove_archives(sources)
+        aggregate = api.aggregate
+        print(f"📊 {len(sources)}件のファイルを反映しました（新規レコード {added}件 / 統合後 "
+              f"{len(aggregate.consolidated)}件, うちエラー {len(aggregate.errors)}件, 世代 {api.generation}）")
+    
+    def source_digests(self, sources: List[ReportSource]) -> Optional[List[str]]:
+        """全ファイルがキャッシュ済みで変更がなければ、内容ハッシュの一覧を返す"""
+        if not self.cache:
+            return None
+        digests = []
+        for source in sources:
+            # 解析に失敗したファイルは、変更されていなければ分析結果に影響しないため除く
+            if self.cache.failed(source):
+                continue
+            digest = self.cache.digest_for(source)
+            if digest is None or (self.store and not self.store.has(digest, self.cache.identity_for(digest))):
+                return None
+            digests.append(digest)
+        return digests
     
-    def show_detailed_analysis(self, records: List[Dict[str, Any]]) -> None:
+    def result_variant(self) -> str:
+        """分析結果キャッシュのキーに含める集計方法"""
+        return f"networks:{self.networks.signature}" if self.networks else ''
+    
+    def build_result(self, records: List['EvaluatedRecord'], digests: Optional[List[str]] = None,
+                     statistics: Optional[Dict[str, Any]] = None) -> AnalysisResult:
+        """ファイル間でレコードを統合し、エラー抽出と統計計算を行う（statistics には集計済みの値を渡せる）"""
+        if self.networks:
+            self.networks.regroup(records)
+        with self.stage('consolidate') as counters:
+            counters['records'] = len(records)
+            consolidated_records = self.consolidate_records(records)
+            error_indexes = [index for index, record in enumerate(consolidated_records)
+                             if is_error_record(record)]
+        if statistics is None:
+            with self.stage('detailed_analysis') as counters:
+                counters['records'] = len(records)
+                statistics = StatisticsAggregator().update(records).as_dict()
+        result = AnalysisResult(
+            consolidated_records,
+            [consolidated_records[i] for i in error_indexes],
+            statistics,
+        )
+        
+        # 次回、ファイル構成が変わっていなければこの結果をそのまま表示する
+        if self.cache and digests:
+            self.cache.store_result(digests, result, error_indexes, self.result_variant())
+        return result
+    
+    def show_detailed_analysis(self, records: Iterable['EvaluatedRecord']) -> None:
         """詳細分析結果を表示"""
+        self.print_statistics(StatisticsAggregator().update(records).as_dict())
+    
+    def print_statistics(self, statistics: Dict[str, Any]) -> None:
+        """StatisticsAggregator.as_dict() の統計を表示"""
         print("\n" + "="*80)
         print("🔍 詳細分析結果")
         print("="*80)
         
         # 統計情報
-        total_records = len(records)
-        spf_fails = sum(1 for r in records if r['spf_result'] != 'pass')
-        dkim_fails = sum(1 for r in records if r['dkim_result'] != 'pass')
-        dmarc_fails = sum(1 for r in records if r['dmarc_result'] != 'pass')
+        total_records = statistics['total_records']
+        spf_fails = statistics['spf_fails']
+        dkim_fails = statistics['dkim_fails']
+        dmarc_fails = statistics['dmarc_fails']
         
         print(f"📊 統計情報:")
         print(f"  - 総レコード数: {total_records}")
@@ -576,76 +3801,37 @@ class DMARCAnalyzer:
         print(f"  - DKIM失敗: {dkim_fails}件 ({dkim_fails/total_records*100:.1f}%)")
         print(f"  - DMARC失敗: {dmarc_fails}件 ({dmarc_fails/total_records*100:.1f}%)")
         
-        # Header From ドメイン別分析
-        header_domains = {}
-        for record in records:
-            domain = record['header_from']
-            if domain not in header_domains:
-                header_domains[domain] = {'total': 0, 'fails': 0}
-            header_domains[domain]['total'] += 1
-            if record['dmarc_result'] != 'pass':
-                header_domains[domain]['fails'] += 1
+        # count で重み付けしたメッセージ数
+        messages = statistics['messages']
+        print(f"\n📨 メッセージ数（count の合計）:")
+        print(f"  - 総メッセージ数: {messages}")
+        for label, name in (('SPF', 'spf'), ('DKIM', 'dkim'), ('DMARC', 'dmarc')):
+            fails = statistics[f'{name}_fail_messages']
+            print(f"  - {label}失敗: {fails}通 ({fails/messages*100 if messages else 0:.1f}%)")
         
+        # Header From ドメイン別分析
         print(f"\n📋 Header From ドメイン別分析:")
-        for domain, stats in header_domains.items():
+        for domain, stats in statistics['header_domains'].items():
             fail_rate = stats['fails'] / stats['total'] * 100
-            print(f"  - {domain}: {stats['total']}件中{stats['fails']}件失敗 ({fail_rate:.1f}%)")
+            message_rate = stats['fail_messages'] / stats['messages'] * 100 if stats['messages'] else 0
+            print(f"  - {domain}: {stats['total']}件中{stats['fails']}件失敗 ({fail_rate:.1f}%), "
+                  f"{stats['messages']}通中{stats['fail_messages']}通失敗 ({message_rate:.1f}%)")
         
         # 外部ドメインの分析（passも含む）
-        external_domains = {}
-        
-        for record in records:
-            # SPFドメイン（Header Fromと異なる場合のみ外部ドメインとして扱う）
-            if record['spf_domain'] and record['spf_domain'] != record['header_from']:
-                domain = record['spf_domain']
-                if domain not in external_domains:
-                    external_domains[domain] = {
-                        'spf_pass': 0, 'spf_softfail': 0, 'spf_fail': 0, 'spf_none': 0, 'spf_other': 0,
-                        'dkim_pass': 0, 'dkim_fail': 0, 'dkim_other': 0
-                    }
-                
-                # SPF結果を分類
-                spf_result = record['spf_result'].lower()
-                if spf_result == 'pass':
-                    external_domains[domain]['spf_pass'] += 1
-                elif spf_result == 'softfail':
-                    external_domains[domain]['spf_softfail'] += 1
-                elif spf_result == 'fail':
-                    external_domains[domain]['spf_fail'] += 1
-                elif spf_result == 'none':
-                    external_domains[domain]['spf_none'] += 1
-                else:
-                    external_domains[domain]['spf_other'] += 1
-            
-            # DKIMドメイン（Header Fromと異なる場合のみ外部ドメインとして扱う）
-            if record['dkim_domain'] and record['dkim_domain'] != record['header_from']:
-                domain = record['dkim_domain']
-                if domain not in external_domains:
-                    external_domains[domain] = {
-                        'spf_pass': 0, 'spf_softfail': 0, 'spf_fail': 0, 'spf_none': 0, 'spf_other': 0,
-                        'dkim_pass': 0, 'dkim_fail': 0, 'dkim_other': 0
-                    }
-                
-                # DKIM結果を分類
-                dkim_result = record['dkim_result'].lower()
-                if dkim_result == 'pass':
-                    external_domains[domain]['dkim_pass'] += 1
-                elif dkim_result == 'fail':
-                    external_domains[domain]['dkim_fail'] += 1
-                else:
-                    external_domains[domain]['dkim_other'] += 1
+        external_domains = statistics['external_domains']
         
         if external_domains:
-            print("\nドメイン一覧 (完全表示):")
-            # ドメインをグループ化
-            grouped_domains = self.group_similar_domains(external_domains)
-            
-            # 総件数でソート
-            sorted_domains = sorted(grouped_domains.items(), 
-                                  key=lambda x: sum(x[1].values()), 
-                                  reverse=True)
+            # ドメインをグループ化し、件数の多い順に（上位のみの場合は全体を並べ替えずに）取り出す
+            groups = self.group_similar_domains(external_domains)
+            order = lambda group: (group.volume, -group.first_seen)
+            if self.top_domains and len(groups) > self.top_domains:
+                print(f"\nドメイン一覧 (上位{self.top_domains}件):")
+                shown = heapq.nlargest(self.top_domains, groups, key=order)
+            else:
+                print("\nドメイン一覧 (完全表示):")
+                shown = sorted(groups, key=order, reverse=True)
             
-            for domain, stats in sorted_domains:
+            for domain, stats, _, _ in shown:
                 parts = []
                 
                 # SPF統計
@@ -678,81 +3864,88 @@ class DMARCAnalyzer:
                 
                 total_count = spf_total + dkim_total
                 print(f"  {domain} {', '.join(parts)} 計{total_count}件")
+            
+            if len(shown) < len(groups):
+                rest = sum(group.volume for group in groups) - sum(group.volume for group in shown)
+                print(f"  … 他 {len(groups) - len(shown)}件 計{rest}件")
     
-    def group_similar_domains(self, external_domains: Dict[str, Dict]) -> Dict[str, Dict]:
-        """類似ドメインをグループ化"""
-        # まず、共通サフィックスでグループ分け
-        suffix_groups = {}
-        
+    def group_similar_domains(self, external_domains: Dict[str, Dict]) -> List[DomainGroup]:
+        """類似ドメインをグループ化（外部ドメインの出現順）"""
+        trie = DomainTrie()
         for domain, stats in external_domains.items():
-            # ドメインの構造を解析
-            parts = domain.split('.')
-            
-            # 3レベル以上のサブドメインがある場合のみグループ化対象
-            if len(parts) >= 4:
-                # 下位2レベル（例：salesforce.com）を基準にグループ化
-                suffix = '.'.join(parts[-2:])
-                
-                if suffix not in suffix_groups:
-                    suffix_groups[suffix] = {}
-                
-                # さらに3レベル目も考慮（例：bnc.salesforce.com）
-                three_level_suffix = '.'.join(parts[-3:]) if len(parts) >= 3 else suffix
-                
-                if three_level_suffix not in suffix_groups[suffix]:
-                    suffix_groups[suffix][three_level_suffix] = []
-                
-                suffix_groups[suffix][three_level_suffix].append((domain, stats))
-            else:
-                # グループ化対象外のドメインはそのまま保持
-                if 'individual' not in suffix_groups:
-                    suffix_groups['individual'] = {}
-                suffix_groups['individual'][domain] = [(domain, stats)]
-        
-        # グループ化結果を構築
-        grouped_domains = {}
-        
-        for suffix, three_level_groups in suffix_groups.items():
-            if suffix == 'individual':
-                # 個別ドメインはそのまま追加
-                for domain, domain_list in three_level_groups.items():
-                    domain_name, stats = domain_list[0]
-                    grouped_domains[domain_name] = stats
-            else:
-                for three_level_suffix, domain_list in three_level_groups.items():
-                    if len(domain_list) >= 3:  # 3個以上ある場合はまとめる
-                        # 統計を合計
-                        merged_stats = {
-                            'spf_pass': 0, 'spf_softfail': 0, 'spf_fail': 0, 'spf_none': 0, 'spf_other': 0,
-                            'dkim_pass': 0, 'dkim_fail': 0, 'dkim_other': 0
-                        }
-                        
-                        for _, stats in domain_list:
-                            for key in merged_stats:
-                                merged_stats[key] += stats[key]
-                        
-                        # ワイルドカード形式で表示
-                        grouped_name = f"*.{three_level_suffix}"
-                        grouped_domains[grouped_name] = merged_stats
-                    else:
-                        # 3個未満の場合は個別に表示
-                        for domain_name, stats in domain_list:
-                            grouped_domains[domain_name] = stats
-        
-        return grouped_domains
-    
-    def cleanup(self) -> None:
-        """一時ファイルをクリーンアップ"""
-        for temp_file in self.temp_files:
-            if os.path.exists(temp_file):
-                try:
-                    os.remove(temp_file)
-                except Exception as e:
-                    print(f"❌ ファイル削除エラー {temp_file}: {e}")
+            trie.insert(domain, stats)
+        groups = trie.groups(self.group_min_domains, self.group_tail_volume)
+        groups.sort(key=attrgetter('first_seen'))
+        return groups
+    
+    def remove_archives(self, sources: List[ReportSource]) -> None:
+        """解析に成功したZIP/GZアーカイブを削除"""
+        archive_paths = dict.fromkeys(s.path for s in sources if s.is_archive)
+        for archive_path in archive_paths:
+            if archive_path in self.failed_sources:
+                continue
+            try:
+                os.remove(archive_path)
+            except Exception as e:
+                print(f"❌ ファイル削除エラー {archive_path}: {e}")
+
+# ワーカープロセスごとの分析インスタンス
+_worker_analyzer: Optional[DMARCAnalyzer] = None
+
+def _init_worker(dmarc_dir: str, public_suffix_list_path: Optional[str], public_suffix_list_cache_dir: Optional[str],
+                 stdout_to_stderr: bool = False) -> None:
+    """ワーカープロセスの初期化"""
+    global _worker_analyzer
+    # Ctrl+C は親プロセスで受けてプールを停止する
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if stdout_to_stderr:
+        # 標準出力は親プロセスが書き出すレコード専用
+        sys.stdout = sys.stderr
+    configure_public_suffix_list(public_suffix_list_path, public_suffix_list_cache_dir)
+    _worker_analyzer = DMARCAnalyzer(dmarc_dir)
+
+def _process_source_in_worker(source: ReportSource) -> tuple[ProcessedReport, bool]:
+    """ワーカープロセスで1ファイルを処理し、処理結果と失敗有無を返す"""
+    report = _worker_analyzer.process_source(source)
+    return report, source.path in _worker_analyzer.failed_sources
+
+def build_query(parser: argparse.ArgumentParser, args: argparse.Namespace) -> Optional[RecordQuery]:
+    """検索オプションから検索条件を作る（指定がなければ None）"""
+    options = {name: getattr(args, name) for name in RecordQuery._fields}
+    if all(value is None for value in options.values()):
+        return None
+    
+    if args.ip is not None and ip_key(args.ip) is None:
+        parser.error(f'--ip に不正なIPアドレスが指定されました: {args.ip}')
+    if args.cidr is not None:
+        try:
+            ipaddress.ip_network(args.cidr, strict=False)
+        except ValueError:
+            parser.error(f'--cidr に不正なアドレス範囲が指定されました: {args.cidr}')
+    for name in ('since', 'until'):
+        if options[name] is None:
+            continue
+        try:
+            timestamp = parse_date(options[name])
+        except ValueError:
+            parser.error(f'--{name} に不正な日時が指定されました: {options[name]}')
+        # 日付だけの --until はその日の終わりまで含める
+        if name == 'until' and len(options[name]) == 10:
+            timestamp += 86400
+        options[name] = timestamp
+    return RecordQuery(**options)
 
 def main():
     """メイン関数"""
-    parser = argparse.ArgumentParser(description='DMARC レポート分析ツール')
+    parser = argparse.ArgumentParser(
+        description='DMARC レポート分析ツール',
+        epilog='複数のホストで分担する場合: 各ホストで "map --output PATH [--shard K/N]" を実行し、'
+               '"merge PARTIAL..." で部分集計をまとめて表示する')
+    parser.add_argument('command', nargs='?', choices=['map', 'merge', 'serve'],
+                       help='map: 読み込み元を処理して部分集計ファイルに書き出す / merge: 部分集計を統合して表示する / '
+                            'serve: 集計結果を JSON API で提供し、追加されたレポートを反映し続ける')
+    parser.add_argument('partials', nargs='*', metavar='PARTIAL',
+                       help='merge で統合する部分集計ファイル')
     parser.add_argument('--all', action='store_true', 
                        help='エラーの有無に関わらず全レコードを表示')
     parser.add_argument('--details', action='store_true', 
@@ -761,20 +3954,246 @@ def main():
                        help='DMARCレポートディレクトリのパス (デフォルト: ~/Downloads/DMARC)')
     parser.add_argument('--no-color', action='store_true', 
                        help='カラー表示を無効にする')
+    parser.add_argument('--delete-archives', action='store_true', 
+                       help='処理に成功したZIP/GZファイルを削除する')
+    parser.add_argument('--jobs', type=int, default=1, metavar='N',
+                       help='並列処理するプロセス数 (0 でCPUコア数, デフォルト: 1)')
+    parser.add_argument('--cache-dir', type=str, default=default_cache_dir(),
+                       help='評価済みレコードのキャッシュディレクトリ (デフォルト: ~/.cache/dmarc-analyzer)')
+    parser.add_argument('--no-cache', action='store_true', 
+                       help='キャッシュを使わずに全ファイルを解析する')
+    parser.add_argument('--mailbox', action='append', metavar='PATH',
+                       help='レポートを受信した Maildir ディレクトリまたは mbox ファイル（複数指定可）')
+    parser.add_argument('--db', type=str, metavar='PATH',
+                       help='評価済みレコードを蓄積する SQLite データベースのパス')
+    parser.add_argument('--from-db', action='store_true', 
+                       help='XMLを読まずに --db に蓄積したレコードから分析結果を表示する')
+    query_group = parser.add_argument_group('検索オプション（--db に蓄積したレコードをインデックスで検索）')
+    query_group.add_argument('--ip', type=str, help='送信元IPアドレス')
+    query_group.add_argument('--cidr', type=str, help='送信元IPアドレスの範囲 (例: 192.0.2.0/24, 2001:db8::/32)')
+    query_group.add_argument('--header-from', type=str, help='Header From ドメイン')
+    query_group.add_argument('--spf-domain', type=str, help='SPF ドメイン')
+    query_group.add_argument('--dkim-selector', type=str, help='DKIM セレクタ')
+    query_group.add_argument('--since', type=str, metavar='DATE',
+                             help='この日時以降を含むレポート (YYYY-MM-DD, UTC)')
+    query_group.add_argument('--until', type=str, metavar='DATE',
+                             help='この日時以前を含むレポート (YYYY-MM-DD の場合はその日の終わりまで, UTC)')
+    query_group.add_argument('--result', choices=['pass', 'fail'], help='DMARC 結果')
+    parser.add_argument('--trend', choices=['day', 'week'], 
+                       help='--db の期間別集計から日別/週別の推移を表示する')
+    parser.add_argument('--trend-by', choices=['header_from', 'org_name'], 
+                       help='--trend の推移を Header From または送信元組織ごとに分けて表示する')
+    parser.add_argument('--watch', action='store_true', 
+                       help='ディレクトリを監視し、追加されたレポートを処理し続ける')
+    parser.add_argument('--watch-interval', type=float, default=2.0, metavar='SEC',
+                       help='--watch でポーリングする間隔（秒, デフォルト: 2.0）')
+    parser.add_argument('--debounce', type=float, default=1.0, metavar='SEC',
+                       help='--watch でファイルの変化が止まってから処理するまでの秒数 (デフォルト: 1.0)')
+    parser.add_argument('--watch-batch', type=int, default=100, metavar='N',
+                       help='--watch で1回に処理する最大ファイル数 (デフォルト: 100)')
+    network_group = parser.add_argument_group('ネットワーク単位の集計（送信元IPアドレスを最長一致するネットワークにまとめる）')
+    network_group.add_argument('--by-network', action='store_true',
+                               help='送信元IPアドレスをネットワーク単位にまとめて表示する')
+    network_group.add_argument('--network-list', action='append', metavar='FILE',
+                               help='"CIDR [ラベル]" 形式または pfx2as 形式のネットワーク一覧（複数指定可, --by-network を含む）')
+    network_group.add_argument('--ipv4-prefix', type=int, default=24, metavar='N',
+                               help='一覧にないIPv4アドレスをまとめるプレフィックス長 (デフォルト: 24)')
+    network_group.add_argument('--ipv6-prefix', type=int, default=64, metavar='N',
+                               help='一覧にないIPv6アドレスをまとめるプレフィックス長 (デフォルト: 64)')
+    rdns_group = parser.add_argument_group('逆引き（表の送信元IPアドレスに PTR レコードのホスト名を加える）')
+    rdns_group.add_argument('--rdns', action='store_true',
+                            help='表の送信元IPアドレスを逆引きして PTR 列に表示する（結果は TTL までキャッシュ）')
+    rdns_group.add_argument('--dns-server', type=str, metavar='HOST[:PORT]',
+                            help='問い合わせ先のDNSサーバー (デフォルト: /etc/resolv.conf の nameserver)')
+    rdns_group.add_argument('--dns-timeout', type=float, default=2.0, metavar='SEC',
+                            help='1件あたりの問い合わせタイムアウト（秒, デフォルト: 2.0）')
+    rdns_group.add_argument('--dns-concurrency', type=int, default=50, metavar='N',
+                            help='同時に問い合わせる最大件数 (デフォルト: 50)')
+    domain_group = parser.add_argument_group('ドメイン一覧（詳細分析の外部ドメイン）')
+    domain_group.add_argument('--group-min-domains', type=int, default=3, metavar='N',
+                              help='同じサフィックスの下にこの行数以上あれば "*.サフィックス" にまとめる (デフォルト: 3)')
+    domain_group.add_argument('--group-tail-volume', type=int, default=0, metavar='N',
+                              help='件数の合計がこれ以下のサブドメインは2行からまとめる (デフォルト: 0 = しない)')
+    domain_group.add_argument('--top-domains', type=int, default=0, metavar='N',
+                              help='件数の多い上位 N 行だけを表示する (デフォルト: 0 = 全件)')
+    parser.add_argument('--format', choices=['table', 'jsonl', 'csv'], default='table',
+                       help='出力形式。jsonl / csv はレコードを処理した順に標準出力へ書き出し、'
+                            '進捗と詳細分析は標準エラー出力に表示する (デフォルト: table)')
+    parser.add_argument('--summary', type=str, metavar='PATH',
+                       help='--format jsonl / csv で統計を JSON ファイルにも書き出す')
+    shard_group = parser.add_argument_group('分散処理（map / merge）')
+    shard_group.add_argument('--output', '-o', type=str, metavar='PATH',
+                             help='map で書き出す部分集計ファイル（gzip 圧縮した JSON）')
+    shard_group.add_argument('--shard', type=str, metavar='K/N',
+                             help='map で読み込み元を N 個に分けた K 番目だけを処理する（レポートの識別情報で振り分け）')
+    serve_group = parser.add_argument_group('JSON API（serve。新しいレポートの検出には --watch-interval などを使う）')
+    serve_group.add_argument('--host', type=str, default='127.0.0.1',
+                             help='serve で待ち受けるアドレス (デフォルト: 127.0.0.1)')
+    serve_group.add_argument('--port', type=int, default=8080,
+                             help='serve で待ち受けるポート (デフォルト: 8080)')
+    serve_group.add_argument('--metrics-max-labels', type=int, default=100, metavar='N',
+                             help='/metrics の Header From・送信元組織のラベルに使う値の上限。超えた後の値は '
+                                  f'{METRIC_OTHER_LABEL} にまとめる (デフォルト: 100)')
+    profile_group = parser.add_argument_group('プロファイル（処理時間・スループット・メモリの計測）')
+    profile_group.add_argument('--profile', type=str, metavar='PATH',
+                               help='段階ごとの実時間・CPU時間・件数/秒・解凍バイト数・最大メモリと、'
+                                    '処理時間の外れ値のファイルを JSON で書き出す（- で標準エラー出力）')
+    profile_group.add_argument('--cprofile', type=str, metavar='PATH',
+                               help='cProfile の計測結果を書き出す（pstats 形式、並列処理のワーカーは含まない）')
+    parser.add_argument('--psl', type=str, 
+                       help='Public Suffix List ファイルのパス (デフォルト: 同梱の data/public_suffix_list.dat)')
+    
+    args = parser.parse_intermixed_args()
+    if args.jobs < 0:
+        parser.error('--jobs には 0 以上の値を指定してください')
+    if args.from_db and not args.db:
+        parser.error('--from-db には --db の指定が必要です')
+    query = build_query(parser, args)
+    if query is not None and not args.db:
+        parser.error('検索オプションには --db の指定が必要です')
+    if args.trend and not args.db:
+        parser.error('--trend には --db の指定が必要です')
+    if args.trend_by and not args.trend:
+        parser.error('--trend-by は --trend と同時に指定してください')
+    if args.trend and query is not None and any(
+            value is not None for name, value in query._asdict().items()
+            if name not in ('header_from', 'since', 'until')):
+        parser.error('--trend で使える検索オプションは --header-from, --since, --until です')
+    if args.watch and args.mailbox:
+        parser.error('--watch と --mailbox は同時に指定できません')
+    if args.watch_interval <= 0 or args.debounce < 0 or args.watch_batch < 1:
+        parser.error('--watch-interval は正の値、--debounce は 0 以上、--watch-batch は 1 以上を指定してください')
     
-    args = parser.parse_args()
+    if not 0 <= args.ipv4_prefix <= 32 or not 0 <= args.ipv6_prefix <= 128:
+        parser.error('--ipv4-prefix は 0〜32、--ipv6-prefix は 0〜128 を指定してください')
+    if (args.by_network or args.network_list) and args.trend:
+        parser.error('--by-network/--network-list と --trend は同時に指定できません')
+    
+    if args.group_min_domains < 2 or args.group_tail_volume < 0 or args.top_domains < 0:
+        parser.error('--group-min-domains は 2 以上、--group-tail-volume と --top-domains は 0 以上を指定してください')
+    if args.format != 'table' and (args.trend or args.rdns):
+        parser.error('--format jsonl / csv と --trend / --rdns は同時に指定できません')
+    if args.summary and args.format == 'table':
+        parser.error('--summary は --format jsonl / csv と同時に指定してください')
+    if args.dns_timeout <= 0 or args.dns_concurrency < 1:
+        parser.error('--dns-timeout は正の値、--dns-concurrency は 1 以上を指定してください')
+    if args.dns_server is not None:
+        try:
+            parse_dns_server(args.dns_server)
+        except ValueError:
+            parser.error(f'--dns-server に不正なポート番号が指定されました: {args.dns_server}')
+    
+    if args.partials and args.command != 'merge':
+        parser.error(f'不明な引数です: {" ".join(args.partials)}')
+    if args.command is not None and (args.watch or args.trend or args.from_db or query is not None):
+        parser.error(f'{args.command} と --watch / --trend / --from-db / 検索オプションは同時に指定できません')
+    if args.command == 'map':
+        if not args.output:
+            parser.error('map には --output の指定が必要です')
+        if args.format != 'table':
+            parser.error('map と --format は同時に指定できません（統合時に merge で指定してください）')
+    elif args.output or args.shard:
+        parser.error('--output / --shard は map と同時に指定してください')
+    if args.shard:
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError:
+            parser.error(f'--shard には 1 <= K <= N の "K/N" を指定してください: {args.shard}')
+    if args.command == 'serve':
+        if args.mailbox or args.format != 'table':
+            parser.error('serve と --mailbox / --format は同時に指定できません')
+        if not 0 <= args.port <= 65535:
+            parser.error('--port には 0〜65535 を指定してください')
+        if args.metrics_max_labels < 1:
+            parser.error('--metrics-max-labels には1以上を指定してください')
+    if args.command == 'merge':
+        if not args.partials:
+            parser.error('merge には部分集計ファイルを1つ以上指定してください')
+        if args.dir or args.mailbox or args.db or args.delete_archives:
+            parser.error('merge と --dir / --mailbox / --db / --delete-archives は同時に指定できません')
     
-    # 分析実行
-    analyzer = DMARCAnalyzer(args.dir)
+    # コンパイル済みの Public Suffix List も評価済みレコードと同じキャッシュディレクトリに置く
+    configure_public_suffix_list(args.psl, None if args.no_cache else args.cache_dir)
     
+    # 分析実行（jsonl / csv では標準出力をレコード専用にし、それ以外の表示は標準エラー出力へ）
+    writer = None
+    if args.format != 'table':
+        writer = RecordWriter(sys.stdout, args.format, args.summary)
+    with contextlib.redirect_stdout(sys.stderr if writer else sys.stdout):
+        run_analysis(args, query, writer)
+
+def run_analysis(args: argparse.Namespace, query: Optional[RecordQuery], writer: Optional[RecordWriter]) -> None:
+    """オプションに応じた分析を実行（--profile / --cprofile 指定時は計測結果も書き出す）"""
+    profiler = None
+    if args.profile:
+        profiler = Profiler(args.profile, args.jobs or os.cpu_count() or 1, args.cprofile)
+    cprofile = None
+    if args.cprofile:
+        import cProfile
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+    try:
+        run_analyzer(args, query, writer, profiler)
+    finally:
+        if cprofile is not None:
+            cprofile.disable()
+            try:
+                cprofile.dump_stats(args.cprofile)
+                print(f"📈 cProfile の計測結果を書き出しました: {args.cprofile}")
+            except OSError as e:
+                print(f"⚠️  プロファイル書き込みエラー: {e}")
+        if profiler is not None:
+            profiler.write()
+
+def run_analyzer(args: argparse.Namespace, query: Optional[RecordQuery], writer: Optional[RecordWriter],
+                 profiler: Optional[Profiler] = None) -> None:
+    """オプションに応じて DMARCAnalyzer を作り、分析を実行"""
     try:
-        analyzer.analyze(show_all=args.all, show_details=args.details)
+        cache_dir = None if args.no_cache else args.cache_dir
+        networks = None
+        if args.by_network or args.network_list:
+            networks = NetworkGrouping.load(args.network_list, args.ipv4_prefix, args.ipv6_prefix, cache_dir)
+        resolver = None
+        if args.rdns:
+            resolver = ReverseDNSResolver(args.dns_server, args.dns_timeout, args.dns_concurrency,
+                                          os.path.join(cache_dir, 'rdns.json') if cache_dir else None)
+        analyzer = DMARCAnalyzer(args.dir, delete_archives=args.delete_archives, jobs=args.jobs,
+                                 cache_dir=cache_dir, mailboxes=args.mailbox, store_path=args.db,
+                                 networks=networks, resolver=resolver, writer=writer,
+                                 group_min_domains=args.group_min_domains,
+                                 group_tail_volume=args.group_tail_volume, top_domains=args.top_domains,
+                                 profiler=profiler)
+        if args.command == 'map':
+            analyzer.map_shard(args.output, args.shard or (1, 1))
+        elif args.command == 'merge':
+            analyzer.merge_partials(args.partials, show_all=args.all)
+        elif args.command == 'serve':
+            analyzer.serve(args.host, args.port, interval=args.watch_interval,
+                           debounce=args.debounce, batch_size=args.watch_batch,
+                           metrics_max_labels=args.metrics_max_labels)
+        elif args.trend:
+            analyzer.show_trend(args.trend, args.trend_by, query, update=not args.from_db)
+        elif writer is not None and not args.watch:
+            analyzer.export(show_all=args.all, query=query, from_store=args.from_db or query is not None,
+                            update=not args.from_db)
+        elif args.from_db or query is not None:
+            # 検索時は新しいレポートをストアに追加してから検索する
+            analyzer.analyze_store(show_all=args.all, query=query, update=not args.from_db)
+        elif args.watch:
+            analyzer.watch(show_all=args.all, interval=args.watch_interval,
+                           debounce=args.debounce, batch_size=args.watch_batch)
+        else:
+            analyzer.analyze(show_all=args.all, show_details=args.details)
     except KeyboardInterrupt:
         print("\n\n⚠️  処理が中断されました")
+    except BrokenPipeError:
+        # 出力先（| head など）が先に閉じられた場合は何も表示せずに終了する
+        # （終了時の標準出力のフラッシュで再び失敗しないよう、出力先を /dev/null に差し替える）
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.__stdout__.fileno())
+        sys.exit(1)
     except Exception as e:
         print(f"\n❌ エラーが発生しました: {e}")
-    finally:
-        analyzer.cleanup()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
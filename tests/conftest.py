@@ -0,0 +1,38 @@
+"""
+テスト共通のフィクスチャ
+
+ハイフン付きのスクリプトをモジュールとして読み込み、benchmarks/ の合成レポート生成ツールで
+テスト用のレポートを作ります。
+"""
+
+import importlib.util
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_PATH = os.path.join(ROOT_DIR, 'dmarc-analyzer.py')
+
+sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmarks'))
+
+
+@pytest.fixture(scope='session')
+def dm():
+    """dmarc-analyzer.py のモジュール"""
+    spec = importlib.util.spec_from_file_location('dmarc_analyzer', SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def run_cli():
+    """スクリプトを別プロセスで実行し、標準出力を返す（終了コードが 0 以外なら失敗）"""
+    def run(*args: str) -> str:
+        completed = subprocess.run([sys.executable, SCRIPT_PATH, *args], capture_output=True,
+                                   text=True, env={**os.environ, 'COLUMNS': '200'})
+        assert completed.returncode == 0, completed.stdout + completed.stderr
+        return completed.stdout
+    return run
@@ -0,0 +1,78 @@
+"""map でシャードに分けて merge した結果が、1台で処理した結果と一致するか"""
+
+import gzip
+import json
+import os
+import re
+import shutil
+
+import pytest
+
+from generate_reports import generate_reports
+
+
+@pytest.fixture(scope='module')
+def report_dir(tmp_path_factory):
+    """再送・二重ダウンロードされたレポートと、レポートIDのないレポートを含むディレクトリ"""
+    dmarc_dir = str(tmp_path_factory.mktemp('map-merge'))
+    paths = generate_reports(dmarc_dir, files=12, records=60, seed=5, ips=60)
+    xml_paths = [path for path in paths if path.endswith('.xml') and not path.endswith('.xml.gz')]
+    # 同じ内容のコピー
+    shutil.copy(paths[1], os.path.join(dmarc_dir, 'copy-' + os.path.basename(paths[1])))
+    # レポートIDのないレポートと、そのコピー（別の名前の XML と GZ）
+    for number, path in enumerate(xml_paths[:3]):
+        with open(path, encoding='utf-8') as f:
+            content = re.sub(r'<report_id>[^<]*</report_id>', '<report_id></report_id>', f.read())
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        shutil.copy(path, os.path.join(dmarc_dir, f'noid-copy-{number}.xml'))
+        with gzip.open(os.path.join(dmarc_dir, f'noid-copy-{number}.xml.gz'), 'wt', encoding='utf-8') as f:
+            f.write(content)
+    return dmarc_dir
+
+
+def map_merge(run_cli, report_dir, tmp_path, shards, *options):
+    """各シャードを map して merge した出力"""
+    partials = []
+    for index in range(1, shards + 1):
+        partial = str(tmp_path / f'part{index}.json.gz')
+        run_cli('map', '--dir', report_dir, '--no-cache', '--shard', f'{index}/{shards}', '--output', partial)
+        partials.append(partial)
+    return run_cli('merge', *partials, *options)
+
+
+def analysis_output(output):
+    """表と詳細分析（読み込み元の一覧などの進捗表示は除く）"""
+    return output[output.index('📊 分析結果'):]
+
+
+def jsonl_summary(output):
+    return [json.loads(line) for line in output.splitlines() if '"type": "summary"' in line]
+
+
+@pytest.mark.parametrize('options', [['--all'], ['--all', '--by-network']], ids=['records', 'by-network'])
+@pytest.mark.parametrize('shards', [2, 3])
+def test_map_merge_matches_single_run(run_cli, report_dir, tmp_path, shards, options):
+    expected = run_cli('--dir', report_dir, '--no-cache', '--no-color', *options)
+    actual = map_merge(run_cli, report_dir, tmp_path, shards, '--no-color', *options)
+    assert analysis_output(actual) == analysis_output(expected)
+
+
+def test_map_merge_summary_matches_single_run(run_cli, report_dir, tmp_path):
+    # analyze の JSON Lines はファイルごとに書き出すため、件数は最後の summary 行で比べる
+    expected = jsonl_summary(run_cli('--dir', report_dir, '--no-cache', '--format', 'jsonl'))
+    actual = jsonl_summary(map_merge(run_cli, report_dir, tmp_path, 3, '--format', 'jsonl'))
+    assert len(expected) == 1 and expected[0]['total_records'] > 0
+    assert actual == expected
+
+
+def test_copies_without_report_id_share_a_shard(dm, report_dir):
+    analyzer = dm.DMARCAnalyzer(report_dir)
+    shards = {}
+    for source in analyzer.collect_sources():
+        digest, identity = analyzer.report_key(source)
+        if identity is None:
+            digest = dm.content_digest(source)
+            shards.setdefault(digest, set()).add(dm.shard_index(digest, 3))
+    assert len(shards) == 3
+    assert all(len(indexes) == 1 for indexes in shards.values())
@@ -0,0 +1,62 @@
+"""Public Suffix List のワイルドカード（*.）・例外（!）ルールで組織ドメインを求められるか"""
+
+import pytest
+
+RULES = '''
+// コメント行と空行は無視する
+
+com
+jp
+kawasaki.jp
+*.kawasaki.jp
+!city.kawasaki.jp
+co.uk
+*.ck
+!www.ck
+'''
+
+
+@pytest.fixture
+def psl(dm):
+    return dm.PublicSuffixList(dm.PublicSuffixList.build_trie(RULES.splitlines()))
+
+
+@pytest.mark.parametrize('domain, expected', [
+    ('example.com', 'example.com'),
+    ('mail.example.com', 'example.com'),
+    ('Mail.Example.COM.', 'example.com'),
+    ('example.co.uk', 'example.co.uk'),
+    ('a.b.example.co.uk', 'example.co.uk'),
+    # *.kawasaki.jp: kawasaki.jp の下のラベルまでがパブリックサフィックス
+    ('foo.kawasaki.jp', 'foo.kawasaki.jp'),
+    ('www.example.foo.kawasaki.jp', 'example.foo.kawasaki.jp'),
+    # !city.kawasaki.jp: 例外ルールはワイルドカードより優先される
+    ('city.kawasaki.jp', 'city.kawasaki.jp'),
+    ('www.city.kawasaki.jp', 'city.kawasaki.jp'),
+    ('www.ck', 'www.ck'),
+    ('mail.www.ck', 'www.ck'),
+    ('mail.example.co.ck', 'example.co.ck'),
+    # どのルールにも一致しない TLD は "*" として扱う
+    ('mail.example.invalid', 'example.invalid'),
+    ('com', 'com'),
+])
+def test_org_domain(psl, domain, expected):
+    assert psl.org_domain(domain) == expected
+
+
+def test_snapshot_matches_source_list(dm, tmp_path):
+    path = tmp_path / 'public_suffix_list.dat'
+    path.write_text(RULES, encoding='utf-8')
+    cache_dir = tmp_path / 'cache'
+    built = dm.PublicSuffixList.load(str(path), str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 1
+    loaded = dm.PublicSuffixList.load(str(path), str(cache_dir))
+    assert loaded.trie == built.trie
+    assert loaded.org_domain('www.city.kawasaki.jp') == 'city.kawasaki.jp'
+
+
+def test_bundled_list(dm):
+    psl = dm.PublicSuffixList.load(dm.default_public_suffix_list_path())
+    assert psl.org_domain('mail.example.co.jp') == 'example.co.jp'
+    assert psl.org_domain('www.city.kawasaki.jp') == 'city.kawasaki.jp'
+    assert psl.org_domain('www.example.foo.kawasaki.jp') == 'example.foo.kawasaki.jp'
@@ -0,0 +1,61 @@
+"""ZIP / GZ の読み込み元が、展開せずに読んでも plain XML と同じ結果になるか"""
+
+import json
+import os
+
+import pytest
+
+from generate_reports import generate_reports
+
+
+@pytest.fixture(scope='module')
+def report_dirs(tmp_path_factory):
+    """同じ内容のレポートを xml / zip / gz の各形式で生成したディレクトリ"""
+    base = tmp_path_factory.mktemp('packaging')
+    dirs = {}
+    for packaging in ('xml', 'zip', 'gz'):
+        dirs[packaging] = str(base / packaging)
+        generate_reports(dirs[packaging], files=3, records=200, packaging=packaging, seed=7, ips=50)
+    return dirs
+
+
+def process_all(dm, dmarc_dir):
+    """レポートID -> (統合済みレコード, メタデータ, 内容ハッシュ)"""
+    analyzer = dm.DMARCAnalyzer(dmarc_dir)
+    results = {}
+    for source in analyzer.collect_sources():
+        report = analyzer.process_source(source)
+        records = [record.as_tuple() for record in report.records]
+        results[report.report_metadata['report_id']] = (records, report.report_metadata, report.digest)
+        assert report.digest == dm.content_digest(source)
+    return results
+
+
+@pytest.mark.parametrize('packaging', ['zip', 'gz'])
+def test_archive_matches_plain_xml(dm, report_dirs, packaging):
+    expected = process_all(dm, report_dirs['xml'])
+    actual = process_all(dm, report_dirs[packaging])
+    assert len(expected) == 3
+    assert actual == expected
+
+
+def jsonl_result(output):
+    """--format jsonl の出力を (レコード行の集合, summary 行) にする（ファイルの検出順には依存しない）"""
+    lines = [json.loads(line) for line in output.splitlines()]
+    records = sorted(json.dumps(line, sort_keys=True) for line in lines if line['type'] == 'record')
+    summary = [line for line in lines if line['type'] == 'summary']
+    return records, summary
+
+
+@pytest.mark.parametrize('packaging', ['zip', 'gz'])
+def test_archive_report_totals_match_plain_xml(run_cli, report_dirs, packaging):
+    expected = jsonl_result(run_cli('--dir', report_dirs['xml'], '--no-cache', '--format', 'jsonl', '--all'))
+    actual = jsonl_result(run_cli('--dir', report_dirs[packaging], '--no-cache', '--format', 'jsonl', '--all'))
+    assert len(expected[0]) > 0 and len(expected[1]) == 1
+    assert actual == expected
+
+
+def test_archives_are_not_extracted(dm, report_dirs):
+    before = sorted(os.listdir(report_dirs['zip']))
+    process_all(dm, report_dirs['zip'])
+    assert sorted(os.listdir(report_dirs['zip'])) == before
@@ -0,0 +1,66 @@
+"""StatisticsAggregator の merge() が、1回の走査で集計した結果と一致するか"""
+
+import json
+
+import pytest
+
+from generate_reports import generate_reports
+
+
+@pytest.fixture(scope='module')
+def file_records(dm, tmp_path_factory):
+    """ファイルごとの統合済みレコード（ファイル間で同じ統合キーが現れるよう送信元IPを少なくする）"""
+    dmarc_dir = str(tmp_path_factory.mktemp('statistics'))
+    generate_reports(dmarc_dir, files=6, records=150, seed=3, ips=40)
+    analyzer = dm.DMARCAnalyzer(dmarc_dir)
+    return [analyzer.process_source(source).records for source in sorted(
+        analyzer.collect_sources(), key=lambda source: source.name)]
+
+
+def aggregate(dm, files):
+    aggregator = dm.StatisticsAggregator()
+    for records in files:
+        aggregator.update(records)
+    return aggregator
+
+
+def dump(aggregator):
+    """ドメインの並びも含めて比較できる形"""
+    return json.dumps(aggregator.to_state())
+
+
+def test_merge_matches_single_pass(dm, file_records):
+    expected = dump(aggregate(dm, file_records))
+    merged = dm.StatisticsAggregator()
+    for records in file_records:
+        merged.merge(aggregate(dm, [records]))
+    assert dump(merged) == expected
+
+
+def test_merge_is_associative(dm, file_records):
+    a, b, c = file_records[:2], file_records[2:4], file_records[4:]
+    left = aggregate(dm, a).merge(aggregate(dm, b)).merge(aggregate(dm, c))
+    right = aggregate(dm, a).merge(aggregate(dm, b).merge(aggregate(dm, c)))
+    assert dump(left) == dump(right) == dump(aggregate(dm, file_records))
+
+
+def test_merge_does_not_double_count_shared_keys(dm, file_records):
+    single = aggregate(dm, file_records)
+    merged = aggregate(dm, file_records[:4]).merge(aggregate(dm, file_records[2:]))
+    # 同じファイルを2回合算するとメッセージ数は増えるが、行数は統合キーごとに1回だけ数える
+    assert merged.total_records == single.total_records
+    assert merged.messages > single.messages
+
+
+def test_state_round_trip(dm, file_records):
+    merged = dm.StatisticsAggregator()
+    for records in file_records:
+        state = json.loads(json.dumps(aggregate(dm, [records]).to_state()))
+        merged.merge(dm.StatisticsAggregator.from_state(state))
+    assert dump(merged) == dump(aggregate(dm, file_records))
+
+
+def test_reorder_restores_first_appearance(dm, file_records):
+    records = [record for records in file_records for record in records]
+    merged = aggregate(dm, file_records[3:]).merge(aggregate(dm, file_records[:3]))
+    assert dump(merged.reorder(records)) == dump(aggregate(dm, file_records))
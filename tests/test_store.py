@@ -0,0 +1,97 @@
+"""ReportStore のスキーマ移行（バージョン0 → 2）"""
+
+import sqlite3
+
+import pytest
+
+# バージョン0のストア: ip_key 列がなく、header_from の索引が大文字小文字を区別する
+VERSION_0_SCHEMA = '''
+CREATE TABLE reports (
+    id INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL UNIQUE,
+    org_name TEXT NOT NULL,
+    report_id TEXT NOT NULL,
+    date_begin INTEGER,
+    date_end INTEGER,
+    source TEXT NOT NULL,
+    evaluation_version INTEGER NOT NULL
+);
+CREATE TABLE records (
+    report INTEGER NOT NULL REFERENCES reports(id),
+    source_ip TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    header_from TEXT NOT NULL,
+    spf_domain TEXT NOT NULL,
+    spf_result TEXT NOT NULL,
+    dkim_domain TEXT NOT NULL,
+    dkim_result TEXT NOT NULL,
+    dkim_selector TEXT NOT NULL,
+    dmarc_result TEXT NOT NULL,
+    note TEXT NOT NULL
+);
+CREATE INDEX records_source_ip ON records(source_ip);
+CREATE INDEX records_header_from ON records(header_from);
+INSERT INTO reports VALUES (1, 'digest-1', 'google.com', 'r1', 86400, 172799, 'a.xml', 3);
+INSERT INTO records VALUES (1, '192.0.2.1', 3, 'example.com', 'example.com', 'pass',
+                            'example.com', 'fail', 's1', 'pass', '');
+INSERT INTO records VALUES (1, '2001:db8::1', 2, 'Example.com', 'example.com', 'fail',
+                            'example.com', 'fail', 's1', 'fail', '');
+'''
+
+
+@pytest.fixture
+def version_0_path(tmp_path):
+    path = str(tmp_path / 'reports.db')
+    connection = sqlite3.connect(path)
+    connection.executescript(VERSION_0_SCHEMA)
+    connection.close()
+    return path
+
+
+def schema(path):
+    connection = sqlite3.connect(path)
+    try:
+        return (connection.execute('PRAGMA user_version').fetchone()[0],
+                [row[1] for row in connection.execute('PRAGMA table_info(records)')],
+                sorted(row[0] for row in connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type IN ('table', 'index')")))
+    finally:
+        connection.close()
+
+
+def test_migrates_version_0(dm, version_0_path):
+    store = dm.ReportStore(version_0_path)
+    connection = store.connection
+    assert connection.execute('PRAGMA user_version').fetchone()[0] == dm.STORE_VERSION == 2
+    assert connection.execute('SELECT source_ip, ip_key FROM records ORDER BY rowid').fetchall() == [
+        ('192.0.2.1', dm.ip_key('192.0.2.1')), ('2001:db8::1', dm.ip_key('2001:db8::1'))]
+    indexes = dict(connection.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index'"))
+    assert 'records_source_ip' not in indexes
+    assert 'NOCASE' in indexes['records_header_from']
+    # 既存のレコードから期間別の集計を作る
+    assert store.rollups('day') == [(86400, '', 2, 5, 2, 5, 2)]
+    assert store.has('digest-1', ('google.com', 'r1', 86400, 172799))
+
+
+def test_interrupted_migration_leaves_version_0(dm, version_0_path, monkeypatch):
+    before = schema(version_0_path)
+
+    def interrupt(self, report_id=None):
+        raise RuntimeError('interrupted')
+
+    monkeypatch.setattr(dm.ReportStore, 'update_rollups', interrupt)
+    with pytest.raises(RuntimeError):
+        dm.ReportStore(version_0_path)
+    assert schema(version_0_path) == before
+
+    monkeypatch.undo()
+    dm.ReportStore(version_0_path).connection.close()
+    version, columns, _ = schema(version_0_path)
+    assert version == 2 and 'ip_key' in columns
+
+
+def test_new_store_is_current(dm, tmp_path):
+    path = str(tmp_path / 'new.db')
+    dm.ReportStore(path).connection.close()
+    version, columns, names = schema(path)
+    assert version == 2 and 'ip_key' in columns and 'rollups' in names